@@ -1,14 +1,64 @@
-from flask import Flask, send_from_directory, jsonify, request, send_file
+from flask import Flask, Response, g, send_from_directory, jsonify, request, send_file
 from flask_cors import CORS
+from werkzeug.formparser import FormDataParser
+import cProfile
+import collections
+import contextlib
+import csv
+import difflib
+import functools
+import glob
+import hashlib
+import io
+import itertools
+import json
+import logging
+import mimetypes
 import os
+import pstats
+import queue
 import random
+import re
 import shutil
+import tempfile
+import threading
+import time
 import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
 
+from comfyui_qwenDatasetManager.dataset_core import (
+    CONTROL_FOLDERS, IMAGE_EXTENSIONS, IMG_FOLDER, LAYOUT_FOLDERS, META_DIRNAME, Dataset, atomic_write_text,
+)
+from comfyui_qwenDatasetManager.controls import CONTROL_KINDS, control_cache_path, control_variant, generate_control_batch
+from comfyui_qwenDatasetManager.pack import PACK_DATA, PackReader, has_pack, pack_dataset, unpack_dataset
+from comfyui_qwenDatasetManager.quality import QUALITY_METRICS, score_image_batch
+from comfyui_qwenDatasetManager.storage import IMAGE_SAVE_FORMATS, StoragePolicy, encoder_pool
+
+try:
+    # Optional: native filesystem events (inotify/FSEvents/ReadDirectoryChangesW)
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+try:
+    # Optional: statistical profiler for ?profile=pyinstrument
+    from pyinstrument import Profiler as InstrumentProfiler
+except ImportError:
+    InstrumentProfiler = None
+
+try:
+    # Optional: copy-on-write clones for snapshot blobs (Linux)
+    import fcntl
+except ImportError:
+    fcntl = None
+
 app = Flask(__name__, static_folder='static')
 CORS(app)
 
+logger = logging.getLogger('qwen_dataset_manager')
+
 # Base directory for datasets
 BASE_DIR = Path(__file__).parent
 DATASETS_DIR = BASE_DIR / 'Datasets'
@@ -16,15 +66,275 @@ DATASETS_DIR = BASE_DIR / 'Datasets'
 # Ensure Datasets directory exists
 DATASETS_DIR.mkdir(exist_ok=True)
 
+def parse_dataset_roots(value):
+    """Parse QDM_DATASET_ROOTS: os.pathsep-separated `name=path` (or bare path) entries"""
+    roots = {}
+    for item in value.split(os.pathsep):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, path = item.partition('=')
+        if not sep:
+            path = name
+            name = Path(path).name
+        roots[name.strip()] = Path(path.strip()).expanduser()
+    return roots
+
+# Extra dataset roots (e.g. ComfyUI's output dir, a NAS mount). Datasets in them are
+# addressed as "<root>:<relative path>"; plain paths refer to DATASETS_DIR.
+EXTRA_DATASET_ROOTS = parse_dataset_roots(os.environ.get('QDM_DATASET_ROOTS', ''))
+ROOT_SEPARATOR = ':'
+
+def get_dataset_roots():
+    """Ordered {name: path} of all dataset roots, the default root first under ''"""
+    roots = {'': DATASETS_DIR}
+    roots.update((name, path) for name, path in EXTRA_DATASET_ROOTS.items() if name)
+    return roots
+
+def resolve_dataset(folder):
+    """Map a dataset id from the API ("<root>:<path>" or "<path>") to its directory"""
+    folder = folder or ''
+    roots = get_dataset_roots()
+    root_name, sep, rel_path = folder.partition(ROOT_SEPARATOR)
+    if not sep or root_name not in roots:
+        root_name, rel_path = '', folder
+    root = roots[root_name]
+    rel_path = rel_path.replace('\\', '/').strip('/')
+    if not rel_path:
+        return root
+    normalized = os.path.normpath(rel_path)
+    if os.path.isabs(normalized) or normalized == '..' or normalized.startswith('..' + os.sep):
+        raise ValueError(f'Invalid dataset path: {folder}')
+    return root / normalized
+
+def dataset_id(root_name, dataset_dir, root):
+    """Inverse of resolve_dataset()"""
+    rel_path = dataset_dir.relative_to(root).as_posix()
+    return f"{root_name}{ROOT_SEPARATOR}{rel_path}" if root_name else rel_path
+
+def display_path(path):
+    """Path relative to the app dir when possible (other roots are shown in full)"""
+    try:
+        return str(Path(path).relative_to(BASE_DIR))
+    except ValueError:
+        return str(path)
+
+class Metrics:
+    """In-process request latency histograms and hot-path counters.
+
+    Exported by /api/metrics in Prometheus text format or as JSON.
+    """
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    COUNTERS = {
+        'files_scanned': 'Directory entries examined while listing datasets',
+        'bytes_read': 'Bytes read from dataset files',
+        'bytes_written': 'Bytes written to dataset files',
+        'images_decoded': 'Images decoded with Pillow',
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.requests = {}  # (endpoint, method, status) -> count
+        self.latency = {}   # endpoint -> {'buckets': [...], 'sum': seconds, 'count': n}
+        self.profiles = collections.deque(maxlen=20)
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, endpoint, method, status, seconds):
+        with self.lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            hist = self.latency.setdefault(endpoint, {
+                'buckets': [0] * len(self.LATENCY_BUCKETS), 'sum': 0.0, 'count': 0
+            })
+            # Buckets are cumulative, as in Prometheus
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist['buckets'][i] += 1
+            hist['sum'] += seconds
+            hist['count'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'requests': [
+                    {'endpoint': e, 'method': m, 'status': s, 'count': c}
+                    for (e, m, s), c in sorted(self.requests.items())
+                ],
+                'latency': {
+                    endpoint: {
+                        'count': h['count'],
+                        'sumSeconds': round(h['sum'], 6),
+                        'meanMs': round(h['sum'] / h['count'] * 1000, 3) if h['count'] else 0,
+                        'buckets': {str(b): n for b, n in zip(self.LATENCY_BUCKETS, h['buckets'])}
+                    }
+                    for endpoint, h in sorted(self.latency.items())
+                },
+                'profiles': [{k: p[k] for k in ('id', 'endpoint', 'profiler', 'seconds')} for p in self.profiles]
+            }
+
+    def prometheus(self):
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+        lines = []
+        with self.lock:
+            for name, help_text in self.COUNTERS.items():
+                lines.append(f"# HELP qdm_{name}_total {help_text}")
+                lines.append(f"# TYPE qdm_{name}_total counter")
+                lines.append(f"qdm_{name}_total {self.counters[name]}")
+
+            lines.append('# HELP qdm_http_requests_total HTTP requests by endpoint, method and status')
+            lines.append('# TYPE qdm_http_requests_total counter')
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'qdm_http_requests_total{{endpoint="{label(endpoint)}",method="{method}",'
+                             f'status="{status}"}} {count}')
+
+            lines.append('# HELP qdm_http_request_duration_seconds Request latency by endpoint')
+            lines.append('# TYPE qdm_http_request_duration_seconds histogram')
+            for endpoint, h in sorted(self.latency.items()):
+                ep = label(endpoint)
+                for bound, count in zip(self.LATENCY_BUCKETS, h['buckets']):
+                    lines.append(f'qdm_http_request_duration_seconds_bucket{{endpoint="{ep}",le="{bound}"}} {count}')
+                lines.append(f'qdm_http_request_duration_seconds_bucket{{endpoint="{ep}",le="+Inf"}} {h["count"]}')
+                lines.append(f'qdm_http_request_duration_seconds_sum{{endpoint="{ep}"}} {h["sum"]:.6f}')
+                lines.append(f'qdm_http_request_duration_seconds_count{{endpoint="{ep}"}} {h["count"]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def open_dataset(folder):
+    """Dataset for an API folder id; its directory listings are counted in the metrics"""
+    return Dataset(resolve_dataset(folder), on_scan=lambda count: metrics.inc('files_scanned', count))
+
+dataset_locks = collections.defaultdict(threading.Lock)  # dataset dir -> lock
+dataset_locks_lock = threading.Lock()
+
+def dataset_lock(dataset_dir):
+    """Lock held while samples are added to or restored into a dataset"""
+    with dataset_locks_lock:
+        return dataset_locks[Path(dataset_dir)]
+
+# Only one profiler can be active per process
+profile_lock = threading.Lock()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+    # Opt-in sampling of a single request: ?profile=cprofile|pyinstrument or X-Profile header
+    profiler_name = request.args.get('profile') or request.headers.get('X-Profile')
+    if not profiler_name or not profile_lock.acquire(blocking=False):
+        return
+    if profiler_name == 'pyinstrument' and InstrumentProfiler is not None:
+        profiler = InstrumentProfiler()
+    else:
+        profiler_name = 'cprofile'
+        profiler = cProfile.Profile()
+    g.profiler = (profiler_name, profiler)
+    if profiler_name == 'pyinstrument':
+        profiler.start()
+    else:
+        profiler.enable()
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.get('request_start', time.perf_counter())
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe(endpoint, request.method, response.status_code, elapsed)
+
+    if g.get('profiler'):
+        profiler_name, profiler = g.pop('profiler')
+        try:
+            if profiler_name == 'pyinstrument':
+                profiler.stop()
+                report = profiler.output_text(unicode=True)
+            else:
+                profiler.disable()
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+                report = out.getvalue()
+        finally:
+            profile_lock.release()
+        profile_id = uuid.uuid4().hex[:12]
+        metrics.profiles.append({
+            'id': profile_id, 'endpoint': endpoint, 'profiler': profiler_name,
+            'seconds': round(elapsed, 6), 'report': report
+        })
+        response.headers['X-Profile-Id'] = profile_id
+
+    if response.status_code >= 500 and response.is_json:
+        logger.error("%s %s failed after %.3fs: %s", request.method, request.path, elapsed,
+                     (response.get_json(silent=True) or {}).get('error'))
+    else:
+        logger.debug("%s %s %s %.3fs", request.method, request.path, response.status_code, elapsed)
+    return response
+
+@app.teardown_request
+def stop_abandoned_profiler(exc):
+    # after_request is skipped when a view raises; never leave the profiler running
+    if g.get('profiler'):
+        profiler_name, profiler = g.pop('profiler')
+        if profiler_name == 'pyinstrument':
+            profiler.stop()
+        else:
+            profiler.disable()
+        profile_lock.release()
+
+@app.route('/api/metrics')
+def get_metrics():
+    """Request latency histograms and I/O counters (Prometheus text, or JSON with ?format=json)"""
+    wants_json = request.args.get('format') == 'json' or \
+        request.accept_mimetypes.best_match(['text/plain', 'application/json']) == 'application/json'
+    if wants_json:
+        return jsonify(metrics.snapshot())
+    return Response(metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/metrics/profile/<profile_id>')
+def get_profile(profile_id):
+    """Return the report of a profiled request (id from the X-Profile-Id response header)"""
+    for profile in metrics.profiles:
+        if profile['id'] == profile_id:
+            return Response(profile['report'], mimetype='text/plain')
+    return jsonify({'error': 'Profile not found'}), 404
+
 @app.route('/')
 def index():
     """Serve the main HTML page"""
     return send_from_directory('static', 'index.html')
 
+def file_version(path):
+    """Opaque version tag for a file (mtime + size), also used as its ETag"""
+    stat = Path(path).stat()
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def save_image_file(img, save_path, tmp_path, policy=None):
+    """Encode img into tmp_path using the format implied by save_path's extension,
+    with the encoder options of the dataset's storage policy"""
+    policy = policy or StoragePolicy.load(save_path.parent.parent)
+    policy.encode(img, tmp_path, extension=save_path.suffix)
+
+def replace_image(save_path, tmp_path, action):
+    """Move the previous version of save_path to the trash, then swap tmp_path in"""
+    trash_id = None
+    if save_path.exists():
+        entry, _ = move_to_trash(save_path.parent.parent, [save_path], action)
+        trash_id = entry['id'] if entry else None
+    os.replace(tmp_path, save_path)
+    metrics.inc('bytes_written', save_path.stat().st_size)
+    return trash_id
+
 @app.route('/api/save/<filename>', methods=['POST'])
 def save_image(filename):
     """Save an edited image to the dataset"""
     try:
+        from PIL import Image
+        
         folder = request.args.get('folder')
         if not folder:
             return jsonify({'error': 'Folder parameter is required'}), 400
@@ -38,40 +348,223 @@ def save_image(filename):
             
         # Construct path
         # We are saving to the 'img' subfolder of the dataset
-        save_path = DATASETS_DIR / folder / 'img' / filename
+        save_path = resolve_dataset(folder) / 'img' / filename
+        
+        if save_path.suffix.lower() not in IMAGE_SAVE_FORMATS:
+            return jsonify({'error': f'Unsupported image extension: {save_path.suffix}'}), 400
         
         if not save_path.parent.exists():
             return jsonify({'error': 'Dataset folder not found'}), 404
+        
+        # Optional staleness check, as for /api/save-patch
+        base_version = request.form.get('baseVersion') or request.headers.get('If-Match', '').strip('"')
+        if base_version and save_path.exists() and base_version != file_version(save_path):
+            return jsonify({'error': 'Image was modified since it was loaded', 'version': file_version(save_path)}), 409
             
-        file.save(save_path)
+        tmp_path = save_path.with_name(f".{save_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            data = file.read()
+            img = Image.open(io.BytesIO(data))
+            image_format, _ = IMAGE_SAVE_FORMATS[save_path.suffix.lower()]
+            has_policy = os.path.isfile(StoragePolicy.path_for(save_path.parent.parent))
+            if img.format == image_format and not has_policy:
+                # Already encoded in the file's own format, store as-is
+                tmp_path.write_bytes(data)
+            else:
+                # e.g. the editor uploads PNG for a .jpg sample, or the dataset has a storage policy
+                img.load()
+                metrics.inc('images_decoded')
+                save_image_file(img, save_path, tmp_path)
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
         
-        return jsonify({'success': True})
+        # Keep the previous version in the dataset trash
+        trash_id = replace_image(save_path, tmp_path, 'save')
+        version = file_version(save_path)
+        
+        response = jsonify({'success': True, 'trashId': trash_id, 'version': version})
+        response.headers['ETag'] = f'"{version}"'
+        return response
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/save-patch/<filename>', methods=['POST'])
+def save_image_patch(filename):
+    """Composite edited regions into an existing image instead of re-uploading all of it.
+
+    Multipart body: one or more `patch` image files plus a `rects` JSON list with
+    the {x, y} offset of each patch, in the same order. An optional `baseVersion`
+    field (or If-Match header) makes the save fail with 409 if the file changed
+    since the editor loaded it.
+    """
+    try:
+        from PIL import Image
+        
+        folder = request.args.get('folder')
+        if not folder:
+            return jsonify({'error': 'Folder parameter is required'}), 400
+        
+        patches = request.files.getlist('patch')
+        if not patches:
+            return jsonify({'error': 'No patch part'}), 400
+        
+        try:
+            rects = json.loads(request.form.get('rects', '[]'))
+        except ValueError:
+            return jsonify({'error': 'Invalid rects'}), 400
+        if not isinstance(rects, list) or len(rects) != len(patches):
+            return jsonify({'error': 'Expected one rect per patch'}), 400
+        
+        save_path = resolve_dataset(folder) / 'img' / filename
+        
+        if save_path.suffix.lower() not in IMAGE_SAVE_FORMATS:
+            return jsonify({'error': f'Unsupported image extension: {save_path.suffix}'}), 400
+        
+        if not save_path.exists():
+            return jsonify({'error': 'Image not found'}), 404
+        
+        base_version = request.form.get('baseVersion') or request.headers.get('If-Match', '').strip('"')
+        current_version = file_version(save_path)
+        if base_version and base_version != current_version:
+            return jsonify({'error': 'Image was modified since it was loaded', 'version': current_version}), 409
+        
+        img = Image.open(save_path)
+        img.load()
+        metrics.inc('images_decoded')
+        metrics.inc('bytes_read', save_path.stat().st_size)
+        
+        if img.mode in ('P', '1', 'I;16'):
+            # Painting needs a true-colour canvas
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        
+        for patch_file, rect in zip(patches, rects):
+            try:
+                x, y = int(rect['x']), int(rect['y'])
+            except (KeyError, TypeError, ValueError):
+                return jsonify({'error': f'Invalid rect: {rect}'}), 400
+            
+            patch = Image.open(patch_file.stream)
+            patch.load()
+            metrics.inc('images_decoded')
+            
+            if x < 0 or y < 0 or x + patch.width > img.width or y + patch.height > img.height:
+                return jsonify({'error': f'Patch at ({x}, {y}) size {patch.width}x{patch.height} is outside the image'}), 400
+            
+            if patch.mode != img.mode:
+                patch = patch.convert(img.mode)
+            img.paste(patch, (x, y))
+        
+        tmp_path = save_path.with_name(f".{save_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            save_image_file(img, save_path, tmp_path)
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+        
+        # Keep the previous version in the dataset trash
+        trash_id = replace_image(save_path, tmp_path, 'save')
+        version = file_version(save_path)
+        
+        response = jsonify({'success': True, 'trashId': trash_id, 'version': version, 'patches': len(patches)})
+        response.headers['ETag'] = f'"{version}"'
+        return response
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+class DatasetCatalog:
+    """Recursive dataset discovery across all roots.
+
+    Sub-directory listings are cached per directory mtime, and per-dataset summary
+    counts per mtime of the dataset's img/ControlN folders, so a refresh only
+    stats directories unless something changed.
+    """
+
+    REQUIRED_FOLDERS = ('img', 'Control1', 'Control2')
+    MAX_DEPTH = int(os.environ.get('QDM_DISCOVERY_DEPTH', '4'))
+
+    def __init__(self):
+        self.listings = {}  # dir -> (mtime_ns, [sub-directory names])
+        self.summaries = {}  # dataset dir -> (signature, summary counts)
+        self.lock = threading.Lock()
+
+    def list_datasets(self):
+        with self.lock:
+            folders = []
+            seen = set()
+            for root_name, root in get_dataset_roots().items():
+                if root.is_dir():
+                    self.walk(root_name, root, root, 0, folders, seen)
+            # Drop cache entries of directories that disappeared
+            for cache in (self.listings, self.summaries):
+                for path in [p for p in cache if p not in seen]:
+                    del cache[path]
+            return folders
+
+    def sub_dirs(self, path):
+        mtime = path.stat().st_mtime_ns
+        cached = self.listings.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        names = []
+        with os.scandir(path) as it:
+            for entry in it:
+                metrics.inc('files_scanned')
+                if not entry.name.startswith('.') and entry.is_dir():
+                    names.append(entry.name)
+        names.sort(key=str.lower)
+        self.listings[path] = (mtime, names)
+        return names
+
+    def walk(self, root_name, root, path, depth, folders, seen):
+        seen.add(path)
+        names = self.sub_dirs(path)
+        if path != root and all(name in names for name in self.REQUIRED_FOLDERS):
+            folders.append({
+                'name': path.relative_to(root).as_posix(),
+                'path': dataset_id(root_name, path, root),
+                'root': root_name,
+                **self.summary(path, names),
+            })
+            return
+        if depth >= self.MAX_DEPTH:
+            return
+        for name in names:
+            self.walk(root_name, root, path / name, depth + 1, folders, seen)
+
+    def summary(self, dataset_dir, names):
+        folders = [name for name in LAYOUT_FOLDERS if name in names]
+        signature = tuple((dataset_dir / name).stat().st_mtime_ns for name in folders)
+        cached = self.summaries.get(dataset_dir)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        dataset = Dataset(dataset_dir, on_scan=lambda count: metrics.inc('files_scanned', count))
+        counts = {
+            'images': len(dataset.files(IMG_FOLDER)),
+            'captions': len(dataset.captions()),
+            'controls': {name: len(dataset.files(name)) for name in folders if name != IMG_FOLDER},
+        }
+        self.summaries[dataset_dir] = (signature, counts)
+        return counts
+
+dataset_catalog = DatasetCatalog()
+
 @app.route('/api/folders')
 def get_folders():
-    """Get list of available dataset folders"""
-    try:
-        folders = []
-        for item in DATASETS_DIR.iterdir():
-            if item.is_dir() and not item.name.startswith('.'):
-                # Check if it has img, Control1, Control2 subdirectories
-                img_dir = item / 'img'
-                control1_dir = item / 'Control1'
-                control2_dir = item / 'Control2'
-                
-                if img_dir.exists() and control1_dir.exists() and control2_dir.exists():
-                    folders.append({
-                        'name': item.name,
-                        'path': str(item.relative_to(DATASETS_DIR))
-                    })
+    """Get list of available dataset folders (recursively, across all dataset roots)"""
+    try:
+        folders = dataset_catalog.list_datasets()
         
-        # Sort folders alphabetically
-        folders.sort(key=lambda x: x['name'].lower())
+        # Default root first, then extra roots in configured order; alphabetical inside
+        root_order = {name: i for i, name in enumerate(get_dataset_roots())}
+        folders.sort(key=lambda x: (root_order.get(x['root'], 0), x['name'].lower()))
         
-        return jsonify({'folders': folders})
+        return jsonify({'folders': folders, 'roots': [name or 'Datasets' for name in root_order]})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -104,150 +597,2881 @@ def create_dataset():
         return jsonify({
             'success': True,
             'name': name,
-            'path': str(dataset_dir.relative_to(BASE_DIR))
+            'path': display_path(dataset_dir)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Import of external folders: one background job per dataset, polled via /api/import/<id>
+IMPORT_WORKERS = int(os.environ.get('QDM_IMPORT_WORKERS', str(min(8, os.cpu_count() or 1))))
+IMPORT_CAPTION_PART = 'caption'
+
+def list_import_sources(spec, extensions, duplicates=None):
+    """{stem: path} for a source folder (searched recursively) or glob pattern.
+
+    The first path (sorted) wins per stem; the other paths with that stem are
+    appended to `duplicates` so the import can report them.
+    """
+    spec = os.path.expanduser(spec)
+    if os.path.isdir(spec):
+        paths = glob.glob(os.path.join(glob.escape(spec), '**', '*'), recursive=True)
+    else:
+        paths = glob.glob(spec, recursive=True)
+    by_stem = {}
+    for path in sorted(paths):
+        stem, ext = os.path.splitext(os.path.basename(path))
+        if ext.lower() in extensions and os.path.isfile(path):
+            if stem not in by_stem:
+                by_stem[stem] = path
+            elif duplicates is not None:
+                duplicates.append(path)
+    metrics.inc('files_scanned', len(paths))
+    return by_stem
+
+def read_import_mapping(path):
+    """Rows of {part: path} from a CSV file with a header or a JSON list of objects.
+
+    Columns are img (or target), Control1-3 and caption; relative paths are
+    resolved against the mapping file's folder.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        entries = json.load(f) if path.lower().endswith('.json') else list(csv.DictReader(f))
+    rows = []
+    for entry in entries:
+        entry = {key.strip(): (value or '').strip() for key, value in entry.items() if key}
+        row = {}
+        for part in (IMG_FOLDER, *CONTROL_FOLDERS, IMPORT_CAPTION_PART):
+            value = entry.get(part) or (entry.get('target') if part == IMG_FOLDER else None)
+            if value:
+                row[part] = os.path.join(base, os.path.expanduser(value))
+        if IMG_FOLDER in row:
+            rows.append(row)
+    return rows
+
+def plan_import(spec):
+    """Pair the sources of an import spec by stem (or read its mapping file).
+
+    Returns (rows, unpaired, duplicates): rows are {part: source path},
+    unpaired counts targets skipped because a requested control was missing,
+    duplicates lists source files not imported because another file in the
+    same source had their stem (e.g. a/001.png and b/001.png).
+    """
+    duplicates = []
+    if spec.get('mapping'):
+        rows = read_import_mapping(os.path.expanduser(spec['mapping']))
+    else:
+        targets = list_import_sources(spec['target'], IMAGE_EXTENSIONS, duplicates)
+        controls = {folder: list_import_sources(pattern, IMAGE_EXTENSIONS, duplicates)
+                    for folder, pattern in (spec.get('controls') or {}).items() if pattern}
+        captions = list_import_sources(spec['captions'], ('.txt',), duplicates) if spec.get('captions') else None
+        rows = []
+        for stem, path in targets.items():
+            row = {IMG_FOLDER: path}
+            for folder, by_stem in controls.items():
+                if stem in by_stem:
+                    row[folder] = by_stem[stem]
+            if captions is not None:
+                caption = captions.get(stem)
+            else:
+                # Captions next to the target images
+                caption = os.path.splitext(path)[0] + '.txt'
+                caption = caption if os.path.isfile(caption) else None
+            if caption:
+                row[IMPORT_CAPTION_PART] = caption
+            rows.append(row)
+
+    if spec.get('allowMissing'):
+        return rows, 0, duplicates
+    wanted = [folder for folder in CONTROL_FOLDERS if (spec.get('controls') or {}).get(folder)]
+    if spec.get('mapping'):
+        wanted = [folder for folder in CONTROL_FOLDERS if any(folder in row for row in rows)]
+    paired = [row for row in rows if all(folder in row for folder in wanted)]
+    return paired, len(rows) - len(paired), duplicates
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class BackgroundJob:
+    """A dataset job that runs in a daemon thread and is polled over HTTP.
+
+    Subclasses set NAME (thread and endpoint prefix), TITLE (used in messages),
+    COUNTS (the counters, guarded by self.lock) and PROCESSED (those counters
+    that make up the progress), and implement work(). Items are fed to a pool
+    with run_pool(), which hands finished futures to the subclass's collect().
+    """
+
+    NAME = 'job'
+    TITLE = 'Job'
+    COUNTS = ('total', 'failed')
+    PROCESSED = ('failed',)
+    MAX_ERRORS = 100
+
+    def __init__(self, dataset_dir, spec, workers):
+        self.id = uuid.uuid4().hex[:12]
+        self.dataset_dir = dataset_dir
+        self.spec = spec
+        self.workers = max(1, int(spec.get('workers') or workers))
+        self.status = 'planning'
+        self.counts = dict.fromkeys(self.COUNTS, 0)
+        self.errors = []
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+        self.started = time.time()
+        self.finished = None
+        self.thread = threading.Thread(target=self.run, name=f'{self.NAME}:{dataset_dir.name}', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_running(self):
+        return self.thread.is_alive()
+
+    def details(self):
+        """Job specific fields of to_dict()"""
+        return {}
+
+    def to_dict(self):
+        with self.lock:
+            counts = dict(self.counts)
+            errors = list(self.errors)
+        elapsed = (self.finished or time.time()) - self.started
+        processed = sum(counts[key] for key in self.PROCESSED)
+        rate = processed / elapsed if elapsed > 0 else 0
+        remaining = max(counts['total'] - processed, 0)
+        return {
+            'id': self.id,
+            'folder': display_path(self.dataset_dir),
+            'status': self.status,
+            **self.details(),
+            **counts,
+            'processed': processed,
+            'seconds': round(elapsed, 2),
+            'rate': round(rate, 1),
+            'etaSeconds': round(remaining / rate, 1) if rate and self.status == 'running' else None,
+            'errors': errors,
+        }
+
+    def count(self, key, source=None, error=None):
+        with self.lock:
+            self.counts[key] += 1
+            if error is not None and len(self.errors) < self.MAX_ERRORS:
+                self.errors.append({'source': source, 'error': str(error)})
+
+    def run(self):
+        try:
+            self.work()
+            self.status = self.final_status()
+        except Exception as e:
+            logger.error("%s of %s failed: %s", self.TITLE, self.dataset_dir, e)
+            with self.lock:
+                self.errors.append({'source': None, 'error': str(e)})
+            self.status = 'failed'
+        finally:
+            self.finished = time.time()
+
+    def work(self):
+        raise NotImplementedError
+
+    def final_status(self):
+        return 'cancelled' if self.cancel_event.is_set() else 'done'
+
+    def process_pool(self, tasks):
+        """Process pool with at most one worker per task"""
+        import multiprocessing
+        # spawn: forking a threaded server process could copy held locks into the workers
+        context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(min(self.workers, max(1, tasks)), mp_context=context)
+
+    def run_pool(self, pool, items, submit, backlog):
+        """Submit items until cancelled; submit(pool, item) returns a future or None to skip the item.
+
+        At most backlog futures are pending at a time; finished ones are passed
+        to collect(done, pending), which pops them from pending ({future: item}).
+        """
+        pending = {}
+        for item in items:
+            if self.cancel_event.is_set():
+                break
+            future = submit(pool, item)
+            if future is None:
+                continue
+            pending[future] = item
+            if len(pending) >= backlog:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                self.collect(done, pending)
+        self.collect(wait(pending)[0], pending)
+
+    def collect(self, done, pending):
+        raise NotImplementedError
+
+def job_routes(rule, job_class):
+    """Register a BackgroundJob's endpoints: POST rule starts it, GET rule/<id> polls it, POST rule/<id>/cancel.
+
+    The decorated function gets (dataset_dir, folder_path, spec) and returns
+    the job to start, or an error response. Only one job of the class runs
+    per dataset at a time.
+    """
+    jobs = {}  # job id -> job
+    jobs_lock = threading.Lock()
+
+    def find(job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            return None, (jsonify({'error': f'{job_class.TITLE} job not found'}), 404)
+        return job, None
+
+    def get_job(job_id):
+        job, error = find(job_id)
+        return error or jsonify(job.to_dict())
+
+    def cancel_job(job_id):
+        job, error = find(job_id)
+        if error:
+            return error
+        job.cancel()
+        return jsonify({'success': True, **job.to_dict()})
+
+    def decorator(create):
+        @functools.wraps(create)
+        def start_job():
+            folder_path = request.args.get('folder', '')
+            spec = request.get_json(silent=True) or {}
+
+            try:
+                dataset_dir = resolve_dataset(folder_path)
+                job = create(dataset_dir, folder_path, spec)
+                if not isinstance(job, job_class):
+                    return job
+                with jobs_lock:
+                    for running in jobs.values():
+                        if running.dataset_dir == dataset_dir and running.is_running():
+                            return jsonify({'error': f'{job_class.TITLE} is already running for this dataset',
+                                            'jobId': running.id}), 409
+                    jobs[job.id] = job
+                    job.start()
+
+                return jsonify({'success': True, 'jobId': job.id, **job.to_dict()}), 202
+            except Exception as e:
+                return jsonify({'error': str(e)}), 500
+
+        app.add_url_rule(rule, create.__name__, start_job, methods=['POST'])
+        app.add_url_rule(f'{rule}/<job_id>', f'get_{job_class.NAME}_job', get_job)
+        app.add_url_rule(f'{rule}/<job_id>/cancel', f'cancel_{job_class.NAME}_job', cancel_job, methods=['POST'])
+        return start_job
+    return decorator
+
+class ImportJob(BackgroundJob):
+    """Background import of external files into a dataset's img/ControlN layout.
+
+    Samples are processed by a thread pool (file I/O, hashing and Pillow's
+    decode/resize/encode release the GIL). Every imported sample is appended to
+    .qdm/imports.jsonl with the content hash and stat of its source img, so
+    duplicate content is skipped and re-running an interrupted import only
+    processes what is left. Files of a sample are written controls and caption
+    first, img last, each through a temp file + rename.
+    """
+
+    NAME = 'import'
+    TITLE = 'Import'
+    COUNTS = ('total', 'imported', 'skipped', 'failed', 'unpaired', 'duplicates')
+    PROCESSED = ('imported', 'skipped', 'failed')
+    LOG_NAME = 'imports.jsonl'
+    SPEC_NAME = 'import.json'
+
+    def __init__(self, dataset_dir, spec):
+        super().__init__(dataset_dir, spec, IMPORT_WORKERS)
+        self.policy = None  # dataset's storage policy with the spec's format/maxSize, set by work()
+        self.reencode = False
+        self.duplicates = []  # first MAX_ERRORS source files dropped for a repeated stem
+        self.hashes = {}  # content hash of source img -> dataset basename
+        self.sources = {}  # (source path, size, mtime_ns) -> dataset basename
+        self.taken = set()  # basenames present in the dataset or reserved by this job
+
+    @property
+    def log_path(self):
+        return self.dataset_dir / META_DIRNAME / self.LOG_NAME
+
+    def start(self):
+        meta_dir = self.dataset_dir / META_DIRNAME
+        meta_dir.mkdir(parents=True, exist_ok=True)
+        # Kept so that an interrupted import can be resumed with {"resume": true}
+        atomic_write_text(meta_dir / self.SPEC_NAME, json.dumps(self.spec, indent=2))
+        return super().start()
+
+    def details(self):
+        with self.lock:
+            return {'duplicateSources': list(self.duplicates)}
+
+    def load_log(self):
+        if not self.log_path.exists():
+            return
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # partial line from an interrupted run
+                self.hashes[entry['hash']] = entry['name']
+                self.sources[(entry['source'], entry['size'], entry['mtime'])] = entry['name']
+
+    def append_log(self, entry):
+        with self.lock:
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def reserve_name(self, stem):
+        name, n = stem, 1
+        while name in self.taken:
+            n += 1
+            name = f"{stem}_{n}"
+        self.taken.add(name)
+        return name
+
+    def work(self):
+        dataset = Dataset(self.dataset_dir, on_scan=lambda count: metrics.inc('files_scanned', count))
+        dataset.ensure_layout()
+        overrides = {key: self.spec[key] for key in ('format', 'maxSize') if self.spec.get(key)}
+        self.policy = StoragePolicy({**StoragePolicy.load(self.dataset_dir).settings, **overrides})
+        # Without a policy or overrides files are copied as they are, unless renamed
+        self.reencode = bool(overrides) or os.path.isfile(StoragePolicy.path_for(self.dataset_dir))
+        self.load_log()
+        rows, unpaired, duplicates = plan_import(self.spec)
+        if duplicates:
+            logger.warning("Import into %s: %d source files share a stem with another file and were not imported",
+                           self.dataset_dir, len(duplicates))
+        dataset.scan()
+        for folder in LAYOUT_FOLDERS:
+            self.taken.update(os.path.splitext(name)[0] for name in dataset.files(folder))
+        with self.lock:
+            self.counts['total'] = len(rows)
+            self.counts['unpaired'] = unpaired
+            self.counts['duplicates'] = len(duplicates)
+            self.duplicates = duplicates[:self.MAX_ERRORS]
+        self.status = 'running'
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='import') as pool:
+            # Bounded queue: never hold more than a few futures per worker
+            self.run_pool(pool, rows, self.submit, self.workers * 4)
+
+    def submit(self, pool, row):
+        source = row[IMG_FOLDER]
+        try:
+            stat = os.stat(source)
+        except OSError as e:
+            self.count('failed', source, e)
+            return None
+        key = (source, stat.st_size, stat.st_mtime_ns)
+        if key in self.sources:
+            # Imported by an earlier run, no need to read it again
+            self.count('skipped')
+            return None
+        basename = self.reserve_name(os.path.splitext(os.path.basename(source))[0])
+        return pool.submit(self.import_sample, row, basename, key)
+
+    def collect(self, done, pending):
+        for future in done:
+            source = pending.pop(future)[IMG_FOLDER]
+            try:
+                result = future.result()
+            except Exception as e:
+                self.count('failed', source, e)
+                continue
+            self.count(result)
+
+    def import_sample(self, row, basename, key):
+        digest = hash_file(row[IMG_FOLDER])
+        metrics.inc('bytes_read', key[1])
+        with self.lock:
+            if digest in self.hashes:
+                return 'skipped'
+            self.hashes[digest] = basename
+
+        written = []
+        try:
+            for part in (*CONTROL_FOLDERS, IMPORT_CAPTION_PART, IMG_FOLDER):
+                if part in row:
+                    written.append(self.write_part(part, row[part], basename))
+        except BaseException:
+            for path in written:
+                path.unlink(missing_ok=True)
+            with self.lock:
+                self.hashes.pop(digest, None)
+            raise
+
+        self.append_log({'hash': digest, 'name': basename, 'source': key[0], 'size': key[1], 'mtime': key[2],
+                         'files': [path.name for path in written]})
+        return 'imported'
+
+    def write_part(self, part, source, basename):
+        if part == IMPORT_CAPTION_PART:
+            with open(source, 'r', encoding='utf-8', errors='replace') as f:
+                text = f.read()
+            target = self.dataset_dir / IMG_FOLDER / f"{basename}.txt"
+            atomic_write_text(target, text)
+            return target
+
+        source_ext = os.path.splitext(source)[1].lower()
+        target = self.dataset_dir / part / self.policy.filename(f"{basename}{source_ext}")
+        tmp_path = target.with_name(f".{target.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            if self.reencode or target.suffix != source_ext:
+                from PIL import Image, ImageOps
+                with Image.open(source) as img:
+                    img = ImageOps.exif_transpose(img)
+                    metrics.inc('images_decoded')
+                    self.policy.encode(img, tmp_path, extension=target.suffix, resize=True)
+            else:
+                shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, target)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        metrics.inc('bytes_written', target.stat().st_size)
+        return target
+
+@job_routes('/api/import', ImportJob)
+def start_import(dataset_dir, folder_path, spec):
+    """Start importing external folders into a (new or existing) dataset; poll GET /api/import/<id>"""
+    if not folder_path:
+        return jsonify({'error': 'Dataset folder is required'}), 400
+    if spec.get('resume'):
+        spec_path = dataset_dir / META_DIRNAME / ImportJob.SPEC_NAME
+        if not spec_path.exists():
+            return jsonify({'error': 'No import to resume'}), 404
+        spec = json.loads(spec_path.read_text(encoding='utf-8'))
+    if not spec.get('target') and not spec.get('mapping'):
+        return jsonify({'error': 'target (folder or glob pattern) or mapping is required'}), 400
+    if spec.get('format') and spec['format'] not in StoragePolicy.FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(StoragePolicy.FORMATS)}"}), 400
+    unknown = set(spec.get('controls') or {}) - set(CONTROL_FOLDERS)
+    if unknown:
+        return jsonify({'error': f"Unknown control folders: {', '.join(sorted(unknown))}"}), 400
+    if not (dataset_dir / 'img').exists() and not spec.get('create'):
+        return jsonify({'error': 'Dataset not found (pass "create": true to create it)'}), 404
+    return ImportJob(dataset_dir, spec)
+
+# Control generation: derived control images (edges, grayscale, blur, ...) for empty
+# ControlN slots. Batches of samples are rendered with NumPy in a process pool; results
+# are cached by source hash in <root>/.qdm/control_cache and hardlinked into the dataset,
+# so a split or copy of a dataset gets its controls without rendering them again.
+CONTROL_WORKERS = int(os.environ.get('QDM_CONTROL_WORKERS', '0')) or os.cpu_count() or 1
+CONTROL_BATCH_SIZE = 8
+
+def parse_control_spec(controls):
+    """{ControlN: kind name or {"kind": ..., params}} -> {ControlN: (kind, params)}"""
+    parsed = {}
+    for folder, entry in (controls or {}).items():
+        if folder not in CONTROL_FOLDERS:
+            raise ValueError(f"Unknown control folder: {folder}")
+        entry = {'kind': entry} if isinstance(entry, str) else dict(entry or {})
+        kind = entry.pop('kind', None)
+        if kind not in CONTROL_KINDS:
+            raise ValueError(f"{folder}: kind must be one of {', '.join(CONTROL_KINDS)}")
+        unknown = set(entry) - set(CONTROL_KINDS[kind])
+        if unknown:
+            raise ValueError(f"{folder}: unknown {kind} parameters: {', '.join(sorted(unknown))}")
+        parsed[folder] = (kind, {**CONTROL_KINDS[kind], **{key: int(value) for key, value in entry.items()}})
+    return parsed
+
+def link_or_copy(source, target):
+    """Put source's content at target (temp name + rename), as a hardlink where possible"""
+    target = Path(target)
+    try:
+        if os.path.samefile(source, target):
+            # Already linked; renaming a link onto its own file is a no-op that would leave the temp link behind
+            return
+    except FileNotFoundError:
+        pass
+    tmp_path = target.with_name(f".{target.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+class ControlJob(BackgroundJob):
+    """Background generation of control images for the empty slots of a dataset.
+
+    Slots that already hold a file are left alone unless overwrite is set, or
+    replaceBlack is set and the file is all black. Source hashes come from the
+    snapshot store's hash cache when the img is unchanged; a sample whose
+    controls are all cached under that hash is linked without being read.
+    """
+
+    NAME = 'controls'
+    TITLE = 'Control generation'
+    COUNTS = ('total', 'generated', 'cached', 'skipped', 'unsupported', 'failed')
+    PROCESSED = COUNTS[1:]
+
+    def __init__(self, dataset_dir, spec, controls):
+        super().__init__(dataset_dir, spec, CONTROL_WORKERS)
+        self.controls = controls  # ControlN -> (kind, params)
+        self.batch_size = max(1, int(spec.get('batchSize') or CONTROL_BATCH_SIZE))
+
+    def details(self):
+        return {'controls': {folder: {'kind': kind, **params} for folder, (kind, params) in self.controls.items()}}
+
+    def plan(self, dataset):
+        """[(img name, img path, [ControlN to fill], {ControlN: existing control to replace if black})]
+
+        Whether a control is black is checked by the pool workers, not here.
+        """
+        overwrite = bool(self.spec.get('overwrite'))
+        replace_black = bool(self.spec.get('replaceBlack'))
+        samples = []
+        for sample in dataset.samples():
+            name = sample.filename
+            folders = []
+            if_black = {}
+            for folder in self.controls:
+                existing = dataset.find_file(folder, name)
+                if existing and not overwrite:
+                    if not replace_black:
+                        self.count('skipped')
+                        continue
+                    if_black[folder] = existing
+                folders.append(folder)
+            if folders:
+                samples.append((name, sample.img_path, folders, if_black))
+            with self.lock:
+                self.counts['total'] += len(self.controls)
+        return samples
+
+    def work(self):
+        self.dataset = dataset = Dataset(self.dataset_dir, on_scan=lambda count: metrics.inc('files_scanned', count))
+        dataset.scan()
+        self.policy = StoragePolicy.load(self.dataset_dir)
+        self.extension = StoragePolicy.FORMATS[self.policy.settings['format']] or '.png'
+        self.store = store = get_snapshot_store(self.dataset_dir)
+        self.cache_dir = str(store.root / META_DIRNAME / 'control_cache')
+        samples = self.plan(dataset)
+        self.status = 'running'
+
+        with store.lock:
+            store.load_cache()
+        tasks = []
+        for name, img_path, folders, if_black in samples:
+            stat = os.stat(img_path)
+            with store.lock:
+                digest = store.cached_hash(stat)
+            if not if_black and digest and all(os.path.exists(self.cache_path(folder, digest)) for folder in folders):
+                self.place(name, digest, {self.variant(folder): 'cached' for folder in folders}, folders)
+                continue
+            tasks.append({'source': img_path, 'name': name, 'stat': stat, 'folders': folders,
+                          'outputs': [[*self.controls[folder], if_black.get(folder)] for folder in folders]})
+
+        batches = [tasks[start:start + self.batch_size] for start in range(0, len(tasks), self.batch_size)]
+        with self.process_pool(len(batches)) as pool:
+            self.run_pool(pool, batches, self.submit, self.workers * 2)
+        with store.lock:
+            store.save_cache()
+
+    def final_status(self):
+        with self.lock:
+            counts = dict(self.counts)
+        if self.cancel_event.is_set():
+            return 'cancelled'
+        if counts['failed'] and not counts['generated'] + counts['cached']:
+            return 'failed'
+        return 'partial' if counts['failed'] else 'done'
+
+    def variant(self, folder):
+        return control_variant(*self.controls[folder])
+
+    def cache_path(self, folder, digest):
+        return control_cache_path(self.cache_dir, self.variant(folder), digest, self.extension)
+
+    def submit(self, pool, batch):
+        return pool.submit(generate_control_batch, [{'source': task['source'], 'outputs': task['outputs']} for task in batch],
+                           self.cache_dir, self.policy.settings, self.extension)
+
+    def collect(self, done, pending):
+        for future in done:
+            batch = pending.pop(future)
+            try:
+                results = future.result()
+            except Exception as e:
+                for task in batch:
+                    for _ in task['folders']:
+                        self.count('failed', task['source'], e)
+                continue
+            for task, result in zip(batch, results):
+                metrics.inc('bytes_read', result['bytesRead'])
+                metrics.inc('bytes_written', result['bytesWritten'])
+                if 'generated' in result['outputs'].values():
+                    metrics.inc('images_decoded')
+                if result['hash']:
+                    stat = task['stat']
+                    with self.store.lock:
+                        self.store.hash_cache[f"{stat.st_dev}:{stat.st_ino}"] = [stat.st_mtime_ns, stat.st_size, result['hash']]
+                self.place(task['name'], result['hash'], result['outputs'], task['folders'])
+
+    def place(self, name, digest, outputs, folders):
+        """Link the cached controls of one sample into its ControlN slots"""
+        basename = os.path.splitext(name)[0]
+        for folder in folders:
+            status = outputs.get(self.variant(folder), 'not generated')
+            if status == 'kept':
+                self.count('skipped')
+                continue
+            if status == 'unsupported':
+                self.count('unsupported')
+                continue
+            if status not in ('generated', 'cached'):
+                self.count('failed', name, f"{folder}: {status}")
+                continue
+            target = self.dataset_dir / folder / f"{basename}{self.extension}"
+            try:
+                # Datasets created by upload or import often have no folder for unused slots
+                target.parent.mkdir(parents=True, exist_ok=True)
+                replaced = self.dataset.find_all(folder, name)
+                link_or_copy(self.cache_path(folder, digest), target)
+                for path in replaced:
+                    # A replaced control with another extension would leave two files for the sample
+                    if Path(path) != target:
+                        os.remove(path)
+            except Exception as e:
+                self.count('failed', name, e)
+                continue
+            self.count(status)
+
+@job_routes('/api/controls/generate', ControlJob)
+def start_control_generation(dataset_dir, folder_path, spec):
+    """Generate control images for a dataset's empty slots; poll GET /api/controls/generate/<id>"""
+    if not folder_path or not (dataset_dir / 'img').exists():
+        return jsonify({'error': 'Dataset not found'}), 404
+    try:
+        controls = parse_control_spec(spec.get('controls'))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    if not controls:
+        return jsonify({'error': 'controls is required, e.g. {"Control2": "edges"}'}), 400
+    return ControlJob(dataset_dir, spec, controls)
+
+# Quality scores: cheap per-image metrics (see QUALITY_METRICS) for img and control files,
+# kept in <dataset>/.qdm/quality_scores.json by "<folder>/<filename>" with the mtime and size
+# they were computed for. Flags are derived from the stored metrics when they are read.
+QUALITY_SCORES_FILE = 'quality_scores.json'
+QUALITY_WORKERS = int(os.environ.get('QDM_QUALITY_WORKERS', '0')) or os.cpu_count() or 1
+QUALITY_BATCH_SIZE = 32
+QUALITY_MAX_SIDE = 256
+QUALITY_BLUR_THRESHOLD = float(os.environ.get('QDM_BLUR_THRESHOLD', '100'))
+QUALITY_FLAGS = ('black', 'blank', 'blurry', 'overexposed', 'underexposed')
+
+def quality_flags(scores, blur_threshold=QUALITY_BLUR_THRESHOLD):
+    if scores['brightness'] < 2 and scores['contrast'] < 2:
+        return ['black']
+    if scores['contrast'] < 3 or scores['entropy'] < 0.5:
+        return ['blank']  # nearly constant
+    flags = []
+    if scores['sharpness'] < blur_threshold:
+        flags.append('blurry')
+    if scores['bright'] > 0.25:
+        flags.append('overexposed')
+    if scores['dark'] > 0.5:
+        flags.append('underexposed')
+    return flags
+
+quality_scores_cache = {}  # scores file -> (mtime_ns, scores)
+quality_scores_lock = threading.Lock()
+
+def load_quality_scores(dataset_dir):
+    """{"<folder>/<filename>": {mtime, size, <metrics>}} of a dataset, {} if never scored"""
+    path = Path(dataset_dir) / META_DIRNAME / QUALITY_SCORES_FILE
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with quality_scores_lock:
+        cached = quality_scores_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    try:
+        scores = json.loads(path.read_text(encoding='utf-8'))
+    except ValueError:
+        scores = {}  # unreadable, rebuilt by the next scoring run
+    with quality_scores_lock:
+        quality_scores_cache[path] = (mtime, scores)
+    return scores
+
+def quality_key(dataset, name, part):
+    """Score key of img `name`'s file in part: the img itself, or its control (any extension); None if missing"""
+    if part == IMG_FOLDER:
+        return f"{IMG_FOLDER}/{name}"
+    path = dataset.find_file(part, name)
+    return f"{part}/{os.path.basename(path)}" if path else None
+
+def sort_and_filter_by_quality(dataset, names, sort=None, order='asc', flag=None, part=IMG_FOLDER,
+                               blur_threshold=QUALITY_BLUR_THRESHOLD):
+    """img filenames sorted by a metric of their `part` file (unscored last) and/or
+    limited to samples where the img or a control has `flag` ('any' for any flag).
+
+    Scores are looked up by full filename, so a.png and a.jpg in img/ keep their own.
+    """
+    scores = load_quality_scores(dataset.path)
+    # One listing per folder; the lookups below are served from memory
+    dataset.scan()
+    if flag:
+        flagged = set()
+        for key, entry in scores.items():
+            flags = quality_flags(entry, blur_threshold)
+            if flags and (flag == 'any' or flag in flags):
+                flagged.add(key)
+        names = [name for name in names if any(quality_key(dataset, name, folder) in flagged for folder in LAYOUT_FOLDERS)]
+    if sort:
+        values = {}
+        for name in names:
+            entry = scores.get(quality_key(dataset, name, part))
+            if entry is not None:
+                values[name] = entry[sort]
+        scored = sorted((name for name in names if name in values), key=values.get, reverse=order == 'desc')
+        names = scored + [name for name in names if name not in values]
+    return names
+
+class QualityJob(BackgroundJob):
+    """Background scoring of a dataset's img and control files.
+
+    Files whose mtime and size match their stored entry are not read again.
+    Batches are scored in a process pool on downscaled decodes; the scores
+    file is rewritten every few seconds, so a cancelled or interrupted run
+    keeps what it finished.
+    """
+
+    NAME = 'quality'
+    TITLE = 'Quality scoring'
+    COUNTS = ('total', 'scored', 'cached', 'failed')
+    PROCESSED = COUNTS[1:]
+    SAVE_INTERVAL = 5.0
+
+    def __init__(self, dataset_dir, spec):
+        super().__init__(dataset_dir, spec, QUALITY_WORKERS)
+        self.batch_size = max(1, int(spec.get('batchSize') or QUALITY_BATCH_SIZE))
+        self.max_side = max(16, int(spec.get('maxSide') or QUALITY_MAX_SIDE))
+        self.entries = {}
+        self.last_save = None
+
+    @property
+    def scores_path(self):
+        return self.dataset_dir / META_DIRNAME / QUALITY_SCORES_FILE
+
+    def save(self):
+        self.scores_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            text = json.dumps(self.entries, separators=(',', ':'))
+        atomic_write_text(self.scores_path, text)
+        self.last_save = time.time()
+
+    def work(self):
+        dataset = Dataset(self.dataset_dir, on_scan=lambda count: metrics.inc('files_scanned', count))
+        dataset.scan()
+        previous = load_quality_scores(self.dataset_dir)
+        stale = []
+        for folder in LAYOUT_FOLDERS:
+            directory = dataset.folder_path(folder)
+            for name in dataset.file_names(folder):
+                key = f"{folder}/{name}"
+                stat = os.stat(os.path.join(directory, name))
+                entry = previous.get(key)
+                if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                    self.entries[key] = entry
+                else:
+                    stale.append((key, os.path.join(directory, name), stat))
+        with self.lock:
+            self.counts['total'] = len(self.entries) + len(stale)
+            self.counts['cached'] = len(self.entries)
+        self.status = 'running'
+
+        self.last_save = time.time()
+        batches = [stale[start:start + self.batch_size] for start in range(0, len(stale), self.batch_size)]
+        with self.process_pool(len(batches)) as pool:
+            self.run_pool(pool, batches, self.submit, self.workers * 2)
+        # Also drops entries of files that no longer exist
+        self.save()
+
+    def submit(self, pool, batch):
+        return pool.submit(score_image_batch, [path for _, path, _ in batch], self.max_side)
+
+    def collect(self, done, pending):
+        for future in done:
+            batch = pending.pop(future)
+            try:
+                results, bytes_read = future.result()
+            except Exception as e:
+                results, bytes_read = [{'error': str(e)}] * len(batch), 0
+            metrics.inc('bytes_read', bytes_read)
+            for (key, _, stat), result in zip(batch, results):
+                if 'error' in result:
+                    self.count('failed', key, result['error'])
+                    continue
+                metrics.inc('images_decoded')
+                with self.lock:
+                    self.entries[key] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, **result}
+                self.count('scored')
+        if time.time() - self.last_save > self.SAVE_INTERVAL:
+            self.save()
+
+@job_routes('/api/quality/score', QualityJob)
+def start_quality_scoring(dataset_dir, folder_path, spec):
+    """Score the dataset's images in the background; poll GET /api/quality/score/<id>"""
+    if not folder_path or not (dataset_dir / 'img').exists():
+        return jsonify({'error': 'Dataset not found'}), 404
+    return QualityJob(dataset_dir, spec)
+
+@app.route('/api/quality')
+def get_quality():
+    """Stored scores and flags per sample.
+
+    Query: flag (only samples where a file has it, 'any' for any flag),
+    blurThreshold (Laplacian variance below which a file is blurry).
+    """
+    folder_path = request.args.get('folder', '')
+    flag = request.args.get('flag') or None
+    
+    try:
+        dataset = open_dataset(folder_path)
+        if not dataset.exists():
+            return jsonify({'error': 'Dataset not found'}), 404
+        if flag and flag != 'any' and flag not in QUALITY_FLAGS:
+            return jsonify({'error': f"flag must be 'any' or one of {', '.join(QUALITY_FLAGS)}"}), 400
+        blur_threshold = request.args.get('blurThreshold', QUALITY_BLUR_THRESHOLD, type=float)
+        
+        dataset.scan()
+        names = dataset.image_names()
+        scores = load_quality_scores(dataset.path)
+        samples = {}
+        flag_counts = collections.Counter()
+        for name in names:
+            for part in LAYOUT_FOLDERS:
+                entry = scores.get(quality_key(dataset, name, part))
+                if entry is not None:
+                    samples.setdefault(name, {})[part] = {
+                        **{metric: entry[metric] for metric in QUALITY_METRICS},
+                        'flags': quality_flags(entry, blur_threshold),
+                    }
+        for sample in samples.values():
+            flag_counts.update({f for scores in sample.values() for f in scores['flags']})
+        listed = sort_and_filter_by_quality(dataset, names, flag=flag, blur_threshold=blur_threshold) if flag else names
+        
+        return jsonify({
+            'folder': folder_path,
+            'scored': len(samples),
+            'unscored': len(names) - len(samples),
+            'flags': {f: flag_counts[f] for f in QUALITY_FLAGS},
+            'samples': {name: samples[name] for name in listed if name in samples},
         })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Ingest: whole samples pushed by remote workers, named here like the saver node names them.
+# Files are spooled straight into <dataset>/.qdm/uploads (see parse_ingest_form), so placing
+# them is a rename on the same filesystem.
+INGEST_PARTS = (IMG_FOLDER,) + CONTROL_FOLDERS
+INGEST_FORMATS = {'PNG': '.png', 'JPEG': '.jpg', 'WEBP': '.webp'}
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_AGE_HOURS = float(os.environ.get('QDM_UPLOAD_MAX_AGE_HOURS', '24'))
+INGEST_KEYS_LIMIT = 1024
+
+def parse_ingest_form(upload_dir):
+    """(form, files) of the current multipart request, with the files written to upload_dir.
+
+    Parses the stream itself instead of through request.form/request.files, so
+    only the ingest endpoint spools uploads next to the dataset.
+    """
+    def spool(total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile('w+b', dir=upload_dir, prefix='.ingest-', suffix='.part', delete=False)
+    
+    parser = FormDataParser(stream_factory=spool, max_form_memory_size=request.max_form_memory_size,
+                            max_content_length=request.max_content_length, max_form_parts=request.max_form_parts)
+    _, form, files = parser.parse(request.stream, request.mimetype, request.content_length, request.mimetype_params)
+    return form, files
+
+def get_uploads_dir(dataset_dir):
+    return Path(dataset_dir) / META_DIRNAME / 'uploads'
+
+class SampleAllocator:
+    """Hands out image_00001-style basenames per dataset without relisting img/ every time.
+
+    The highest number is taken from one listing, then each allocation only
+    probes that the next name is still free (other writers may add files).
+    """
+
+    def __init__(self):
+        self.counters = {}  # dataset dir -> last number handed out
+
+    def next_basename(self, dataset):
+        """Call with the dataset's dataset_lock() held"""
+        key = Path(dataset.path)
+        number = self.counters.get(key)
+        if number is None:
+            reserved = encoder_pool.reserved_names(dataset.folder_path(IMG_FOLDER))
+            number = int(re.search(r'\d+', dataset.next_filename(reserved)).group()) - 1
+        while True:
+            number += 1
+            basename = f"image_{number:05d}"
+            if dataset.find_file(IMG_FOLDER, basename) is None and dataset.caption_path(basename) is None:
+                self.counters[key] = number
+                return basename
+
+sample_allocator = SampleAllocator()
+ingest_results = collections.OrderedDict()  # (folder, X-Idempotency-Key) -> {'done': Event, 'response': (body, status)}
+ingest_results_lock = threading.Lock()
+INGEST_KEY_WAIT_SECONDS = 60
+
+def reserve_ingest_key(key):
+    """(record, owner) for an idempotency key; only the owner processes the request.
+
+    Other requests with the key wait for the owner's response. A record
+    released without a response (nothing was placed) can be taken over.
+    """
+    while True:
+        with ingest_results_lock:
+            record = ingest_results.get(key)
+            if record is None:
+                record = ingest_results[key] = {'done': threading.Event(), 'response': None}
+                return record, True
+        if not record['done'].wait(INGEST_KEY_WAIT_SECONDS):
+            return record, False
+        if record['response'] is not None:
+            return record, False
+
+def finish_ingest_key(key, record, response):
+    """Keep the response for retries, or release the key when response is None"""
+    with ingest_results_lock:
+        if response is None:
+            ingest_results.pop(key, None)
+        else:
+            record['response'] = response
+            finished = [k for k, r in ingest_results.items() if r['done'].is_set()]
+            for k in finished[:max(0, len(ingest_results) - INGEST_KEYS_LIMIT)]:
+                del ingest_results[k]
+    record['done'].set()
+
+def detect_image_extension(path):
+    """Extension for an uploaded image from its content, or None if unsupported"""
+    from PIL import Image
+    try:
+        with Image.open(path) as img:
+            return INGEST_FORMATS.get(img.format)
+    except Exception:
+        return None
+
+def place_ingested_sample(dataset, policy, reencode, files, caption):
+    """Move one sample's spooled files into the dataset under a new basename.
+
+    files: {part: (path of the spooled upload, extension)}. Every file is first
+    staged under a hidden temp name next to its target, then all are renamed
+    into place, controls and caption before img so the sample is complete once
+    it appears. If anything fails, the files of the sample already in place are
+    removed again and uploads that were moved go back to the uploads folder.
+    """
+    dataset_dir = Path(dataset.path)
+    staged = []  # (temp path, target, upload it was moved from or None)
+    
+    def stage(target):
+        return target.with_name(f".{target.name}.{uuid.uuid4().hex[:8]}.tmp")
+    
+    def stage_file(part, basename):
+        source, extension = files[part]
+        target = dataset_dir / part / policy.filename(f"{basename}{extension}")
+        tmp_path = stage(target)
+        if reencode:
+            from PIL import Image
+            with Image.open(source) as img:
+                metrics.inc('images_decoded')
+                policy.encode(img, tmp_path, extension=target.suffix, resize=True)
+            staged.append((tmp_path, target, None))
+        else:
+            os.replace(source, tmp_path)
+            staged.append((tmp_path, target, source))
+    
+    placed = []
+    with dataset_lock(dataset_dir):
+        try:
+            basename = sample_allocator.next_basename(dataset)
+            for part in CONTROL_FOLDERS:
+                if part in files:
+                    stage_file(part, basename)
+            if caption:
+                target = dataset_dir / IMG_FOLDER / f"{basename}.txt"
+                tmp_path = stage(target)
+                with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                    f.write(caption)
+                staged.append((tmp_path, target, None))
+            stage_file(IMG_FOLDER, basename)
+            for tmp_path, target, _ in staged:
+                os.replace(tmp_path, target)
+                placed.append(target)
+        except BaseException:
+            for tmp_path, target, source in staged:
+                current = target if target in placed else tmp_path
+                try:
+                    if source is not None:
+                        os.replace(current, source)
+                    else:
+                        current.unlink(missing_ok=True)
+                except OSError as e:
+                    logger.warning("Could not roll back %s: %s", current, e)
+            # The basename is free again; the next allocation relists img/
+            sample_allocator.counters.pop(dataset_dir, None)
+            raise
+    
+    if reencode:
+        for source, _ in files.values():
+            Path(source).unlink(missing_ok=True)
+    for target in placed:
+        metrics.inc('bytes_written', target.stat().st_size)
+    files_placed = [target.relative_to(dataset_dir).as_posix() for target in placed]
+    return {'basename': basename, 'filename': placed[-1].name, 'files': files_placed}
+
+def read_upload_meta(dataset_dir, upload_id):
+    if not re.match(r'^[0-9a-f]{32}$', upload_id or ''):
+        return None
+    meta_path = get_uploads_dir(dataset_dir) / f"{upload_id}.json"
+    if not meta_path.exists():
+        return None
+    meta = json.loads(meta_path.read_text(encoding='utf-8'))
+    meta['offset'] = (get_uploads_dir(dataset_dir) / f"{upload_id}.part").stat().st_size
+    return meta
+
+def evict_stale_uploads(uploads_dir):
+    cutoff = time.time() - UPLOAD_MAX_AGE_HOURS * 3600
+    for path in uploads_dir.iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+@app.route('/api/ingest', methods=['POST'])
+def ingest_samples():
+    """Add whole samples (img, Control1-3, caption); the server allocates their names.
+
+    multipart/form-data: files img and Control1-3 plus a caption field; for a
+    batch prefix them with the sample index (0.img, 0.caption, 1.img, ...). An
+    optional checksums field maps field names to sha1 hex digests.
+    application/json: {"samples": [{"img": <upload id>, "Control1": ..., "caption": ...}]}
+    with files sent through /api/uploads beforehand.
+    ?create=1 creates a missing dataset. The X-Idempotency-Key header is reserved
+    (per folder) before anything is placed: requests repeating it get the first
+    request's response, waiting for it while it runs (409 if it takes longer than
+    INGEST_KEY_WAIT_SECONDS). A failure after part of a batch was placed is kept as
+    that response too; a request rejected before placing anything frees the key.
+    """
+    folder_path = request.args.get('folder', '')
+    idempotency_key = request.headers.get('X-Idempotency-Key')
+    key = record = None
+    if idempotency_key:
+        key = (folder_path, idempotency_key)
+        record, owner = reserve_ingest_key(key)
+        if not owner:
+            if record['response'] is None:
+                return jsonify({'error': 'A request with this idempotency key is still in progress'}), 409
+            body, status = record['response']
+            return jsonify(body), status
+    
+    spooled = []
+    placed = []
+    response = None  # (body, status) kept for retries with the same key
+    try:
+        dataset = Dataset(resolve_dataset(folder_path))
+        if not folder_path:
+            return jsonify({'error': 'Dataset folder is required'}), 400
+        if not dataset.exists():
+            if not request.args.get('create'):
+                return jsonify({'error': 'Dataset not found (pass create=1 to create it)'}), 404
+            dataset.ensure_layout()
+        uploads_dir = get_uploads_dir(dataset.path)
+        uploads_dir.mkdir(parents=True, exist_ok=True)
+        
+        samples = {}  # index -> {'files': {part: path}, 'caption': str}
+        if request.is_json:
+            for index, entry in enumerate((request.get_json(silent=True) or {}).get('samples') or []):
+                sample = samples.setdefault(index, {'files': {}, 'caption': entry.get('caption') or ''})
+                for part in INGEST_PARTS:
+                    if entry.get(part):
+                        meta = read_upload_meta(dataset.path, entry[part])
+                        if meta is None or not meta.get('complete'):
+                            return jsonify({'error': f'Upload {entry[part]} not found or incomplete'}), 400
+                        sample['files'][part] = str(uploads_dir / f"{entry[part]}.part")
+        else:
+            # Uploaded files are written to uploads_dir while the form is parsed
+            form, files = parse_ingest_form(str(uploads_dir))
+            spooled = [storage.stream.name for storage in files.values() if hasattr(storage.stream, 'name')]
+            try:
+                checksums = json.loads(form.get('checksums') or '{}')
+            except ValueError:
+                checksums = None
+            if not isinstance(checksums, dict) or not all(isinstance(value, str) for value in checksums.values()):
+                return jsonify({'error': 'checksums must be a JSON object of field name to sha1 hex digest'}), 400
+            for field, storage in files.items():
+                prefix, _, part = field.rpartition('.')
+                if part not in INGEST_PARTS or (prefix and not prefix.isdigit()):
+                    return jsonify({'error': f'Unexpected file field: {field}'}), 400
+                storage.stream.close()
+                path = storage.stream.name
+                if field in checksums and hash_file(path) != checksums[field].lower():
+                    return jsonify({'error': f'Checksum mismatch for {field}'}), 400
+                samples.setdefault(int(prefix or 0), {'files': {}, 'caption': ''})['files'][part] = path
+            for field, value in form.items():
+                prefix, _, part = field.rpartition('.')
+                if part == 'caption' and (not prefix or prefix.isdigit()):
+                    samples.setdefault(int(prefix or 0), {'files': {}, 'caption': ''})['caption'] = value.strip()
+        
+        if not samples:
+            return jsonify({'error': 'No samples in the request'}), 400
+        
+        # Validate everything before placing anything
+        for index, sample in sorted(samples.items()):
+            if IMG_FOLDER not in sample['files']:
+                return jsonify({'error': f'Sample {index} has no img file'}), 400
+            for part, path in sample['files'].items():
+                extension = detect_image_extension(path)
+                if extension is None:
+                    return jsonify({'error': f'Sample {index}: {part} is not a PNG, JPEG or WebP image'}), 400
+                sample['files'][part] = (path, extension)
         
+        policy = StoragePolicy.load(dataset.path)
+        reencode = os.path.isfile(StoragePolicy.path_for(dataset.path))
+        for _, sample in sorted(samples.items()):
+            placed.append(place_ingested_sample(dataset, policy, reencode, sample['files'], sample['caption']))
+        
+        if request.is_json:
+            for entry in (request.get_json(silent=True) or {}).get('samples') or []:
+                for part in INGEST_PARTS:
+                    if entry.get(part):
+                        (uploads_dir / f"{entry[part]}.json").unlink(missing_ok=True)
+        
+        response = ({'success': True, 'folder': folder_path, 'samples': placed}, 200)
+        return jsonify(response[0])
+    except ImportError:
+        return jsonify({'error': 'Pillow library not installed. Run: pip install Pillow'}), 500
+    except Exception as e:
+        if placed:
+            # Part of the batch is in the dataset: a retry must not add it again
+            response = ({'error': str(e), 'folder': folder_path, 'samples': placed, 'partial': True}, 500)
+        return jsonify({'error': str(e), **(response[0] if response else {})}), 500
+    finally:
+        if key:
+            finish_ingest_key(key, record, response)
+        # Spooled files that were not placed (errors, rejected requests)
+        for path in spooled:
+            if os.path.exists(path):
+                os.remove(path)
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload (JSON body: size, sha1 of the whole file)"""
+    folder_path = request.args.get('folder', '')
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        dataset_dir = resolve_dataset(folder_path)
+        if not folder_path or not (dataset_dir / 'img').exists():
+            return jsonify({'error': 'Dataset not found'}), 404
+        size = int(data.get('size', -1))
+        checksum = str(data.get('sha1') or '').lower()
+        if size < 0 or not re.match(r'^[0-9a-f]{40}$', checksum):
+            return jsonify({'error': 'size and sha1 are required'}), 400
+        
+        uploads_dir = get_uploads_dir(dataset_dir)
+        uploads_dir.mkdir(parents=True, exist_ok=True)
+        evict_stale_uploads(uploads_dir)
+        upload_id = uuid.uuid4().hex
+        (uploads_dir / f"{upload_id}.part").touch()
+        atomic_write_text(uploads_dir / f"{upload_id}.json", json.dumps({
+            'id': upload_id, 'size': size, 'sha1': checksum, 'created': time.time(), 'complete': size == 0,
+        }))
+        return jsonify({'uploadId': upload_id, 'offset': 0, 'size': size, 'chunkSize': UPLOAD_CHUNK_SIZE})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>')
+def get_upload(upload_id):
+    """Offset to resume an upload from"""
+    try:
+        meta = read_upload_meta(resolve_dataset(request.args.get('folder', '')), upload_id)
+        if meta is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        return jsonify({'uploadId': upload_id, 'offset': meta['offset'], 'size': meta['size'], 'complete': meta['complete']})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+upload_locks = {}  # upload id -> [lock, requests using it]; only ids with a request in flight
+upload_locks_lock = threading.Lock()
+
+@contextlib.contextmanager
+def upload_lock(upload_id):
+    """Serialize the chunks of one upload; the entry is dropped once no request holds or waits for it"""
+    with upload_locks_lock:
+        entry = upload_locks.setdefault(upload_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with upload_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del upload_locks[upload_id]
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    """Append the raw request body at ?offset=N (must equal the current size).
+
+    The body is streamed to disk. An X-Chunk-SHA1 header is checked against the
+    chunk; the whole file is checked against the upload's sha1 once complete.
+    A rejected chunk is cut off again, so the client can resend it.
+    """
+    try:
+        dataset_dir = resolve_dataset(request.args.get('folder', ''))
+        with upload_lock(upload_id):
+            meta = read_upload_meta(dataset_dir, upload_id)
+            if meta is None:
+                return jsonify({'error': 'Upload not found'}), 404
+            offset = request.args.get('offset', type=int)
+            if offset != meta['offset']:
+                return jsonify({'error': 'Offset does not match the uploaded size', 'offset': meta['offset']}), 409
+            
+            part_path = get_uploads_dir(dataset_dir) / f"{upload_id}.part"
+            digest = hashlib.sha1()
+            written = 0
+            with open(part_path, 'ab') as f:
+                while True:
+                    chunk = request.stream.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    if offset + written > meta['size']:
+                        f.truncate(offset)
+                        return jsonify({'error': 'Chunk exceeds the upload size', 'offset': offset}), 400
+                    digest.update(chunk)
+                    f.write(chunk)
+                expected = request.headers.get('X-Chunk-SHA1')
+                if expected and digest.hexdigest() != expected.lower():
+                    f.truncate(offset)
+                    return jsonify({'error': 'Chunk checksum mismatch', 'offset': offset}), 400
+            metrics.inc('bytes_written', written)
+            
+            offset += written
+            if offset == meta['size']:
+                if hash_file(part_path) != meta['sha1']:
+                    with open(part_path, 'r+b') as f:
+                        f.truncate(0)
+                    return jsonify({'error': 'File checksum mismatch, upload restarted', 'offset': 0}), 400
+                meta['complete'] = True
+                meta.pop('offset')
+                atomic_write_text(get_uploads_dir(dataset_dir) / f"{upload_id}.json", json.dumps(meta))
+            return jsonify({'uploadId': upload_id, 'offset': offset, 'complete': offset == meta['size']})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    try:
+        dataset_dir = resolve_dataset(request.args.get('folder', ''))
+        if read_upload_meta(dataset_dir, upload_id) is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        for suffix in ('.part', '.json'):
+            (get_uploads_dir(dataset_dir) / f"{upload_id}{suffix}").unlink(missing_ok=True)
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/compare-datasets', methods=['POST'])
+def compare_datasets():
+    """Compare two datasets and find orphan files in linked dataset"""
+    try:
+        data = request.get_json() or {}
+        primary_folder = data.get('primaryFolder', '')
+        linked_folder = data.get('linkedFolder', '')
+        
+        if not primary_folder or not linked_folder:
+            return jsonify({'error': 'Primary and linked folders are required'}), 400
+        
+        primary = open_dataset(primary_folder)
+        linked = open_dataset(linked_folder)
+        
+        if not primary.exists():
+            return jsonify({'error': 'Primary dataset not found'}), 404
+        if not linked.exists():
+            return jsonify({'error': 'Linked dataset not found'}), 404
+        
+        # Get basenames from both datasets ({basename: filename})
+        primary_basenames = primary.files(IMG_FOLDER)
+        linked_basenames = linked.files(IMG_FOLDER)
+        
+        # Find orphans (in linked but not in primary)
+        orphans = sorted(linked_basenames[basename] for basename in linked_basenames.keys() - primary_basenames.keys())
+        
+        return jsonify({
+            'orphans': orphans,
+            'primaryCount': len(primary_basenames),
+            'linkedCount': len(linked_basenames),
+            'orphanCount': len(orphans)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/images')
+def get_images():
+    """Get list of images from the img folder.
+
+    Optional quality keys (see /api/quality/score): sort=<metric> with
+    order=asc|desc and part=img|ControlN, flag=<flag>|any to filter.
+    """
+    folder_path = request.args.get('folder', '')
+    sort = request.args.get('sort') or None
+    flag = request.args.get('flag') or None
+    
+    try:
+        dataset = open_dataset(folder_path)
+        pack = get_pack(dataset.path)
+        
+        if not dataset.exists() and pack is None:
+            return jsonify({'error': 'Image directory not found'}), 404
+        if sort and sort not in QUALITY_METRICS:
+            return jsonify({'error': f"sort must be one of {', '.join(QUALITY_METRICS)}"}), 400
+        if flag and flag != 'any' and flag not in QUALITY_FLAGS:
+            return jsonify({'error': f"flag must be 'any' or one of {', '.join(QUALITY_FLAGS)}"}), 400
+        
+        if pack is None:
+            images = dataset.image_names()
+        else:
+            # Loose files plus packed samples; a loose file wins over its packed copy
+            loose = dataset.files(IMG_FOLDER)
+            images = sorted(dataset.image_names() + [
+                record.filename for basename, record in pack.records.items() if basename not in loose])
+        if sort or flag:
+            images = sort_and_filter_by_quality(
+                dataset, images, sort=sort, order=request.args.get('order', 'asc'), flag=flag,
+                part=request.args.get('part', IMG_FOLDER),
+                blur_threshold=request.args.get('blurThreshold', QUALITY_BLUR_THRESHOLD, type=float))
+        return jsonify({'images': images})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+class DatasetWatcher:
+    """Watches one dataset folder and pushes coalesced change batches to subscribers.
+
+    Uses watchdog (inotify on Linux) when it is installed, otherwise polls the
+    dataset folders. Changes are reported as img filenames, the same names
+    /api/images returns: a new caption or control counts as 'modified'.
+    """
+
+    FLUSH_INTERVAL = 0.25
+    POLL_INTERVAL = 2.0
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = Path(dataset_dir)
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.images = set()   # current img filenames
+        self.stems = {}       # stem -> img filename, to map captions/controls back to their image
+        self.touched = {}     # filename -> existed at start of the current batch
+        self.observer = None
+        self.thread = None
+
+    def start(self):
+        self.set_images(self.scan_images())
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(WatchdogHandler(self), str(self.dataset_dir), recursive=True)
+            self.observer.start()
+            target = self.flush_loop
+        else:
+            target = self.poll_loop
+        self.thread = threading.Thread(target=target, name=f'watch:{self.dataset_dir.name}', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.observer is not None:
+            self.observer.stop()
+
+    def scan_images(self):
+        img_dir = self.dataset_dir / 'img'
+        if not img_dir.exists():
+            return []
+        with os.scandir(img_dir) as entries:
+            return [e.name for e in entries
+                    if not e.name.startswith('.') and os.path.splitext(e.name)[1].lower() in IMAGE_EXTENSIONS]
+
+    def set_images(self, names):
+        self.images = set(names)
+        self.stems = {os.path.splitext(name)[0]: name for name in self.images}
+
+    def on_path_changed(self, path, exists):
+        """Record a change of one file somewhere under the dataset folder"""
+        try:
+            rel = Path(path).relative_to(self.dataset_dir)
+        except ValueError:
+            return
+        if len(rel.parts) != 2 or rel.name.startswith('.'):
+            return
+        subfolder, name = rel.parts
+        stem, ext = os.path.splitext(name)
+        ext = ext.lower()
+
+        with self.lock:
+            if subfolder == 'img' and ext in IMAGE_EXTENSIONS:
+                self.touched.setdefault(name, name in self.images)
+                if exists:
+                    self.images.add(name)
+                    self.stems[stem] = name
+                else:
+                    self.images.discard(name)
+                    if self.stems.get(stem) == name:
+                        del self.stems[stem]
+            elif (subfolder == 'img' and ext == '.txt') or \
+                    (subfolder in CONTROL_FOLDERS and ext in IMAGE_EXTENSIONS):
+                image_name = self.stems.get(stem)
+                if image_name:
+                    self.touched.setdefault(image_name, True)
+
+    def take_batch(self):
+        with self.lock:
+            touched, self.touched = self.touched, {}
+            added, removed, modified = [], [], []
+            for name, existed in touched.items():
+                exists = name in self.images
+                if exists and not existed:
+                    added.append(name)
+                elif existed and not exists:
+                    removed.append(name)
+                elif exists:
+                    modified.append(name)
+        return added, removed, modified
+
+    def flush_loop(self):
+        while not self.stop_event.wait(self.FLUSH_INTERVAL):
+            self.publish(*self.take_batch())
+
+    def poll_loop(self):
+        previous = self.poll_signatures()
+        while not self.stop_event.wait(self.POLL_INTERVAL):
+            try:
+                current = self.poll_signatures()
+            except OSError:
+                continue
+            added = sorted(current.keys() - previous.keys())
+            removed = sorted(previous.keys() - current.keys())
+            modified = sorted(n for n in current.keys() & previous.keys() if current[n] != previous[n])
+            with self.lock:
+                self.set_images(current)
+            previous = current
+            self.publish(added, removed, modified)
+
+    def poll_signatures(self):
+        """Map each img filename to the (mtime, size) of every file in its sample"""
+        stats = {}
+        for subfolder in LAYOUT_FOLDERS:
+            folder = self.dataset_dir / subfolder
+            if not folder.exists():
+                continue
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    metrics.inc('files_scanned')
+                    if entry.name.startswith('.') or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    stats[(subfolder, entry.name)] = (st.st_mtime_ns, st.st_size)
+
+        signatures = {}
+        for (subfolder, name), stat in stats.items():
+            stem, ext = os.path.splitext(name)
+            if subfolder != 'img' or ext.lower() not in IMAGE_EXTENSIONS:
+                continue
+            related = [stats.get(('img', f"{stem}.txt"))]
+            for control in CONTROL_FOLDERS:
+                related.append(stats.get((control, name)))
+            signatures[name] = (stat, tuple(related))
+        return signatures
+
+    def publish(self, added, removed, modified):
+        if not (added or removed or modified):
+            return
+        change = {'added': sorted(added), 'removed': sorted(removed), 'modified': sorted(modified)}
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(change)
+            except queue.Full:
+                # Client fell behind: drop its backlog and ask it to reload the list
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait({'resync': True})
+
+if Observer is not None:
+    class WatchdogHandler(FileSystemEventHandler):
+        """Forwards watchdog events to a DatasetWatcher"""
+
+        def __init__(self, watcher):
+            super().__init__()
+            self.watcher = watcher
+
+        def on_any_event(self, event):
+            if event.is_directory:
+                return
+            if event.event_type == 'moved':
+                self.watcher.on_path_changed(event.src_path, False)
+                self.watcher.on_path_changed(event.dest_path, True)
+            elif event.event_type in ('created', 'modified', 'closed'):
+                self.watcher.on_path_changed(event.src_path, True)
+            elif event.event_type == 'deleted':
+                self.watcher.on_path_changed(event.src_path, False)
+
+# Active watchers keyed by dataset path; a watcher lives as long as it has subscribers
+watchers = {}
+watchers_lock = threading.Lock()
+
+def subscribe_dataset_events(dataset_dir):
+    q = queue.Queue(maxsize=256)
+    key = str(dataset_dir.resolve())
+    with watchers_lock:
+        watcher = watchers.get(key)
+        if watcher is None:
+            watcher = DatasetWatcher(dataset_dir)
+            watcher.start()
+            watchers[key] = watcher
+        with watcher.lock:
+            watcher.subscribers.add(q)
+    return q
+
+def unsubscribe_dataset_events(dataset_dir, q):
+    key = str(dataset_dir.resolve())
+    with watchers_lock:
+        watcher = watchers.get(key)
+        if watcher is None:
+            return
+        with watcher.lock:
+            watcher.subscribers.discard(q)
+            idle = not watcher.subscribers
+        if idle:
+            watcher.stop()
+            del watchers[key]
+
+@app.route('/api/events')
+def dataset_events():
+    """Server-sent events stream of added/removed/modified images in a dataset"""
+    folder_path = request.args.get('folder', '')
+    dataset_dir = resolve_dataset(folder_path)
+
+    if not folder_path or not (dataset_dir / 'img').exists():
+        return jsonify({'error': 'Image directory not found'}), 404
+
+    q = subscribe_dataset_events(dataset_dir)
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    change = q.get(timeout=15)
+                except queue.Empty:
+                    # Keep proxies from closing the connection; also detects closed clients
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"data: {json.dumps(change)}\n\n"
+        finally:
+            unsubscribe_dataset_events(dataset_dir, q)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+pack_readers = {}
+pack_missing = {}  # dataset dir -> its mtime when it was seen without a pack
+pack_readers_lock = threading.Lock()
+
+def get_pack(dataset_dir):
+    """Shared PackReader of a dataset, refreshed on every call; None without a pack.
+
+    Creating the pack index changes the dataset folder's mtime, so an unpacked
+    dataset is only checked again once its folder has changed.
+    """
+    key = str(dataset_dir)
+    try:
+        mtime = os.stat(key).st_mtime_ns
+    except OSError:
+        return None
+    with pack_readers_lock:
+        if pack_missing.get(key) == mtime:
+            return None
+        if not has_pack(dataset_dir):
+            pack_missing[key] = mtime
+            reader = pack_readers.pop(key, None)
+            if reader is not None:
+                reader.close()
+            return None
+        pack_missing.pop(key, None)
+        reader = pack_readers.get(key)
+        if reader is None:
+            reader = pack_readers[key] = PackReader(dataset_dir)
+        else:
+            reader.refresh()
+        return reader
+
+def send_packed_file(dataset_dir, part, filename):
+    """Serve a file of a packed sample as a zero-copy slice of the mmapped pack, or None"""
+    pack = get_pack(dataset_dir)
+    record = pack.get(filename) if pack else None
+    view = pack.view(record, part) if record else None
+    if view is None:
+        return None
+    
+    stored_name, offset, length = record.parts[part]
+    metrics.inc('bytes_read', length)
+    mimetype = mimetypes.guess_type(stored_name)[0] or 'application/octet-stream'
+    response = Response([view], mimetype=mimetype, direct_passthrough=True)
+    response.content_length = length
+    response.cache_control.no_cache = True
+    # Bytes at an offset never change while the pack file exists (append-only)
+    response.set_etag(f"pack-{pack.identity[1]:x}-{offset:x}-{length:x}")
+    return response.make_conditional(request)
+
+@app.route('/api/image/<image_type>/<filename>')
+def get_image(image_type, filename):
+    """Serve individual image from specified folder type"""
+    folder_path = request.args.get('folder', '')
+    
+    try:
+        dataset_dir = resolve_dataset(folder_path)
+        
+        # Validate image_type
+        if image_type not in LAYOUT_FOLDERS:
+            return jsonify({'error': 'Invalid image type'}), 400
+        
+        image_dir = dataset_dir / image_type
+        image_path = image_dir / filename
+        
+        if not image_path.exists():
+            # Not on disk as a loose file: try the dataset pack
+            packed = send_packed_file(dataset_dir, image_type, filename)
+            if packed is not None:
+                return packed
+            return jsonify({'error': 'Image not found'}), 404
+        
+        metrics.inc('bytes_read', image_path.stat().st_size)
+        response = send_file(image_path)
+        # The editor sends this back as baseVersion when saving
+        response.headers['X-File-Version'] = file_version(image_path)
+        return response
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+class PreviewCache:
+    """Byte-bounded LRU of rendered previews, keyed by (basenames, mtimes, size, ...)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.total_bytes -= len(old)
+
+preview_cache = PreviewCache(int(float(os.environ.get('QDM_PREVIEW_CACHE_MB', '128')) * 1024 * 1024))
+
+PREVIEW_MODES = ('single', 'side', 'overlay', 'diff')
+PREVIEW_FORMATS = {'jpeg': ('JPEG', 'image/jpeg'), 'png': ('PNG', 'image/png'), 'webp': ('WEBP', 'image/webp')}
+PREVIEW_MAX_SIZE = 4096
+
+# Colour stops for the diff heatmap (black -> purple -> red -> yellow -> white)
+HEATMAP_STOPS = (
+    (0, (0, 0, 0)),
+    (64, (80, 18, 123)),
+    (128, (206, 54, 74)),
+    (192, (252, 165, 10)),
+    (255, (252, 255, 164)),
+)
+
+def find_preview_source(dataset, folder, filename):
+    """(source, cache token) of an image: a Path, or a memoryview into the dataset pack"""
+    path = dataset.find_file(folder, filename)
+    if path is not None:
+        path = Path(path)
+        return path, (str(path), path.stat().st_mtime_ns)
+    pack = get_pack(dataset.path)
+    record = pack.get(filename) if pack else None
+    view = pack.view(record, folder) if record else None
+    if view is None:
+        return None, None
+    return view, ('pack', dataset.path, pack.identity, record.parts[folder][1])
+
+def load_preview_image(source, box):
+    """Decode source as RGB, downscaled to fit box (JPEGs are decoded at reduced scale)"""
+    from PIL import Image
+    
+    if isinstance(source, memoryview):
+        size = source.nbytes
+        img = Image.open(io.BytesIO(source))
+    else:
+        size = source.stat().st_size
+        img = Image.open(source)
+    img.draft('RGB', box)
+    img = img.convert('RGB')
+    img.thumbnail(box, Image.Resampling.BILINEAR, reducing_gap=2.0)
+    metrics.inc('images_decoded')
+    metrics.inc('bytes_read', size)
+    return img
+
+def render_preview(mode, target, control, width, height, alpha, gain):
+    """Render a preview as a uint8 RGB array.
+
+    single: target fitted into the box
+    side: target and control next to each other, each fitted into half of the box
+    overlay: target blended over control with the given alpha
+    diff: per-pixel max channel difference, scaled by gain and mapped to a heatmap
+    """
+    import numpy as np
+    from PIL import Image
+    
+    if mode == 'single':
+        return np.asarray(load_preview_image(target, (width, height)))
+    
+    if mode == 'side':
+        box = (max(1, width // 2), height)
+        halves = [np.asarray(load_preview_image(p, box)) for p in (target, control)]
+        canvas_h = max(h.shape[0] for h in halves)
+        out = np.zeros((canvas_h, sum(h.shape[1] for h in halves), 3), dtype=np.uint8)
+        x = 0
+        for half in halves:
+            top = (canvas_h - half.shape[0]) // 2
+            out[top:top + half.shape[0], x:x + half.shape[1]] = half
+            x += half.shape[1]
+        return out
+    
+    target = load_preview_image(target, (width, height))
+    control = load_preview_image(control, (width, height))
+    if control.size != target.size:
+        # Compare pixel-for-pixel at the target's display size
+        control = control.resize(target.size, Image.Resampling.BILINEAR)
+    a = np.asarray(target)
+    b = np.asarray(control)
+    
+    if mode == 'overlay':
+        out = a.astype(np.float32) * alpha + b.astype(np.float32) * (1.0 - alpha)
+        return np.clip(out + 0.5, 0, 255).astype(np.uint8)
+    
+    diff = np.abs(a.astype(np.int16) - b.astype(np.int16)).max(axis=2)
+    levels = np.clip(diff * gain, 0, 255).astype(np.uint8)
+    return heatmap_lut()[levels]
+
+_heatmap_lut = None
+
+def heatmap_lut():
+    """256x3 lookup table interpolated from HEATMAP_STOPS"""
+    global _heatmap_lut
+    if _heatmap_lut is None:
+        import numpy as np
+        positions = [stop for stop, _ in HEATMAP_STOPS]
+        colors = np.array([color for _, color in HEATMAP_STOPS], dtype=np.float32)
+        x = np.arange(256)
+        _heatmap_lut = np.stack([np.interp(x, positions, colors[:, c]) for c in range(3)], axis=1).round().astype(np.uint8)
+    return _heatmap_lut
+
+@app.route('/api/preview/<filename>')
+def get_preview(filename):
+    """Render a downscaled preview, side-by-side/overlay composite or diff heatmap of a sample.
+
+    Query: mode (single|side|overlay|diff), layer (single mode: img or ControlN),
+    control (ControlN to compare against), w/h (display box), alpha (overlay),
+    gain (diff amplification), format (jpeg|png|webp).
+    """
+    folder_path = request.args.get('folder', '')
+    
+    try:
+        from PIL import Image
+        
+        mode = request.args.get('mode', 'single')
+        layer = request.args.get('layer', 'img')
+        control = request.args.get('control', 'Control1')
+        output = request.args.get('format', 'jpeg').lower()
+        
+        if mode not in PREVIEW_MODES:
+            return jsonify({'error': f'Invalid mode, expected one of {", ".join(PREVIEW_MODES)}'}), 400
+        if layer not in LAYOUT_FOLDERS or control not in CONTROL_FOLDERS:
+            return jsonify({'error': 'Invalid image type'}), 400
+        if output not in PREVIEW_FORMATS:
+            return jsonify({'error': 'Invalid format'}), 400
+        
+        try:
+            width = min(PREVIEW_MAX_SIZE, max(16, int(request.args.get('w', 512))))
+            height = min(PREVIEW_MAX_SIZE, max(16, int(request.args.get('h', width))))
+            alpha = min(1.0, max(0.0, float(request.args.get('alpha', 0.5))))
+            gain = min(64.0, max(0.1, float(request.args.get('gain', 4))))
+        except ValueError:
+            return jsonify({'error': 'Invalid size, alpha or gain'}), 400
+        
+        dataset = open_dataset(folder_path)
+        target, target_token = find_preview_source(dataset, layer if mode == 'single' else IMG_FOLDER, filename)
+        if target is None:
+            return jsonify({'error': 'Image not found'}), 404
+        
+        sources = [target]
+        tokens = [target_token]
+        if mode != 'single':
+            control_source, control_token = find_preview_source(dataset, control, filename)
+            if control_source is None:
+                return jsonify({'error': f'{control} image not found'}), 404
+            sources.append(control_source)
+            tokens.append(control_token)
+        
+        key = (tuple(tokens), mode, width, height,
+               alpha if mode == 'overlay' else None, gain if mode == 'diff' else None, output)
+        etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        
+        data = preview_cache.get(key)
+        if data is None:
+            pixels = render_preview(mode, sources[0], sources[1] if len(sources) > 1 else None, width, height, alpha, gain)
+            image_format, _ = PREVIEW_FORMATS[output]
+            buf = io.BytesIO()
+            Image.fromarray(pixels).save(buf, image_format, **({'quality': 85} if output != 'png' else {}))
+            data = buf.getvalue()
+            preview_cache.put(key, data)
+        
+        response = Response(data, mimetype=PREVIEW_FORMATS[output][1])
+        response.headers['Cache-Control'] = 'no-cache'
+        response.set_etag(etag)
+        return response.make_conditional(request)
+        
+    except ImportError:
+        return jsonify({'error': 'Pillow and NumPy are required. Run: pip install Pillow numpy'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/caption/<filename>')
+def get_caption(filename):
+    """Get caption text for an image"""
+    folder_path = request.args.get('folder', '')
+    try:
+        dataset = open_dataset(folder_path)
+        txt_path = dataset.caption_path(filename)
+        
+        if txt_path is None:
+            pack = get_pack(dataset.path)
+            record = pack.get(filename) if pack else None
+            caption = pack.read_caption(record) if record else ''
+            metrics.inc('bytes_read', len(caption.encode('utf-8')))
+            return jsonify({'caption': caption})
+            
+        with open(txt_path, 'r', encoding='utf-8') as f:
+            caption = f.read()
+        metrics.inc('bytes_read', len(caption.encode('utf-8')))
+            
+        return jsonify({'caption': caption})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/caption/<filename>', methods=['POST'])
+def save_caption(filename):
+    """Save caption text for an image"""
+    folder_path = request.args.get('folder', '')
+    try:
+        data = request.get_json() or {}
+        caption = data.get('caption', '')
+        
+        dataset_dir = resolve_dataset(folder_path)
+        basename = os.path.splitext(filename)[0]
+        txt_path = dataset_dir / 'img' / f"{basename}.txt"
+        
+        # Ensure img directory exists
+        (dataset_dir / 'img').mkdir(parents=True, exist_ok=True)
+        
+        # Replace instead of rewriting in place: snapshot blobs may be hardlinks of this file
+        atomic_write_text(txt_path, caption)
+        metrics.inc('bytes_written', len(caption.encode('utf-8')))
+            
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def build_caption_transform(options):
+    """Compile bulk caption options into a single caption -> caption function.
+
+    Steps run in a fixed order: find/replace, prepend/append trigger tokens,
+    tag dedupe, whitespace trim. Raises re.error for an invalid pattern or
+    replacement template.
+    """
+    find = options.get('find') or ''
+    replace = options.get('replace') or ''
+    prepend = (options.get('prepend') or '').strip()
+    append = (options.get('append') or '').strip()
+    dedupe_tags = bool(options.get('dedupeTags'))
+    trim = bool(options.get('trim'))
+    separator = options.get('separator') or ', '
+    split_char = separator.strip() or ','
+
+    pattern = None
+    if find:
+        flags = re.IGNORECASE if options.get('ignoreCase') else 0
+        if options.get('regex'):
+            pattern = re.compile(find, flags)
+            replacement = replace
+            try:
+                # Parse the template now (group references like \9) instead of on the first match
+                pattern.sub(replacement, '')
+            except IndexError as e:
+                raise re.error(str(e))
+        else:
+            pattern = re.compile(re.escape(find), flags)
+            replacement = lambda m: replace  # literal, no backreference expansion
+
+    def split_tags(text):
+        return [t.strip() for t in text.split(split_char)]
+
+    def transform(caption):
+        text = caption
+        if pattern is not None:
+            text = pattern.sub(replacement, text)
+
+        if prepend:
+            first = split_tags(text)[0]
+            if first.lower() != prepend.lower():
+                text = f"{prepend}{separator}{text.lstrip()}" if text.strip() else prepend
+        if append:
+            last = split_tags(text)[-1]
+            if last.lower() != append.lower():
+                text = f"{text.rstrip()}{separator}{append}" if text.strip() else append
+
+        if dedupe_tags:
+            seen = set()
+            tags = []
+            for tag in split_tags(text):
+                key = tag.lower()
+                if tag and key not in seen:
+                    seen.add(key)
+                    tags.append(tag)
+            text = separator.join(tags)
+
+        if trim:
+            lines = [re.sub(r'[ \t]+', ' ', line).strip() for line in text.splitlines()]
+            text = '\n'.join(line for line in lines if line)
+
+        return text
+
+    return transform
+
+@app.route('/api/captions/transform', methods=['POST'])
+def transform_captions():
+    """Bulk rewrite every caption in the dataset in one pass, with dry-run preview and a single undo snapshot"""
+    folder_path = request.args.get('folder', '')
+    data = request.get_json(silent=True)
+    if data is None and not request.get_data():
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    dry_run = bool(data.get('dryRun', False))
+
+    try:
+        try:
+            preview_limit = max(0, int(data.get('previewLimit', 50)))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid previewLimit'}), 400
+
+        try:
+            transform = build_caption_transform(data)
+        except re.error as e:
+            return jsonify({'error': f'Invalid find/replace pattern: {e}'}), 400
+
+        dataset_dir = resolve_dataset(folder_path)
+        img_dir = dataset_dir / 'img'
+
+        if not folder_path or not img_dir.exists():
+            return jsonify({'error': 'Image directory not found'}), 404
+
+        # Single scandir pass: read, transform and keep only captions that change
+        scanned = 0
+        changes = []
+        with os.scandir(img_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.txt') or entry.name.startswith('.') or not entry.is_file():
+                    continue
+                scanned += 1
+                with open(entry.path, 'r', encoding='utf-8', newline='') as f:
+                    before = f.read()
+                metrics.inc('bytes_read', len(before.encode('utf-8')))
+                after = transform(before)
+                if after != before:
+                    changes.append((entry.name, before, after))
+
+        changes.sort(key=lambda c: c[0])
+        metrics.inc('files_scanned', scanned)
+
+        preview = []
+        for name, before, after in changes[:preview_limit]:
+            diff = difflib.unified_diff(before.splitlines(), after.splitlines(), lineterm='', n=0)
+            preview.append({
+                'filename': name,
+                'before': before,
+                'after': after,
+                'diff': [line for line in diff if not line.startswith(('---', '+++', '@@'))]
+            })
+
+        result = {
+            'success': True,
+            'dryRun': dry_run,
+            'scanned': scanned,
+            'changed': len(changes),
+            'preview': preview
+        }
+
+        if dry_run or not changes:
+            return jsonify(result)
+
+        # Store the original text of every caption we are about to touch (replaces any older snapshot)
+        meta_dir = dataset_dir / META_DIRNAME
+        meta_dir.mkdir(exist_ok=True)
+        snapshot = {
+            'created': time.time(),
+            'captions': {name: before for name, before, _ in changes}
+        }
+        atomic_write_text(meta_dir / 'caption_undo.json', json.dumps(snapshot, ensure_ascii=False))
+
+        for name, _, after in changes:
+            atomic_write_text(img_dir / name, after)
+            metrics.inc('bytes_written', len(after.encode('utf-8')))
+
+        result['undoAvailable'] = True
+        return jsonify(result)
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/captions/undo', methods=['POST'])
+def undo_caption_transform():
+    """Restore captions from the snapshot taken by the last bulk transform"""
+    folder_path = request.args.get('folder', '')
+
+    try:
+        dataset_dir = resolve_dataset(folder_path)
+        snapshot_path = dataset_dir / META_DIRNAME / 'caption_undo.json'
+
+        if not folder_path or not snapshot_path.exists():
+            return jsonify({'error': 'No caption transform to undo'}), 404
+
+        with open(snapshot_path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+
+        img_dir = dataset_dir / 'img'
+        for name, caption in snapshot.get('captions', {}).items():
+            atomic_write_text(img_dir / name, caption)
+
+        snapshot_path.unlink()
+
+        return jsonify({'success': True, 'restored': len(snapshot.get('captions', {}))})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Caption analytics. Tokenizers map a batch of captions to token counts; add entries
+# to CAPTION_TOKENIZERS to plug in others. "model" loads QDM_CAPTION_TOKENIZER (a
+# Hugging Face tokenizer name or path) through transformers, when installed.
+CAPTION_TOKEN_LIMIT = int(os.environ.get('QDM_CAPTION_TOKEN_LIMIT', '512'))
+CAPTION_TOKENIZER_MODEL = os.environ.get('QDM_CAPTION_TOKENIZER', '')
+CAPTION_STATS_BATCH = 256
+CAPTION_STATS_CACHE = 'caption_stats.json'
+TOKEN_PATTERN = re.compile(r"(\w+)|[^\w\s]")
+
+def approx_token_counts(texts):
+    """BPE-like estimate: one token per punctuation mark and per 4 characters of a word (tends to overcount)"""
+    return [sum((len(m.group(1)) + 3) // 4 if m.group(1) else 1 for m in TOKEN_PATTERN.finditer(text)) for text in texts]
+
+def whitespace_token_counts(texts):
+    return [len(text.split()) for text in texts]
+
+def model_token_counts(texts):
+    if not CAPTION_TOKENIZER_MODEL:
+        raise ValueError('Set QDM_CAPTION_TOKENIZER to a Hugging Face tokenizer name or path')
+    with caption_tokenizer_lock:
+        if CAPTION_TOKENIZER_MODEL not in loaded_tokenizers:
+            from transformers import AutoTokenizer
+            loaded_tokenizers[CAPTION_TOKENIZER_MODEL] = AutoTokenizer.from_pretrained(CAPTION_TOKENIZER_MODEL)
+        tokenizer = loaded_tokenizers[CAPTION_TOKENIZER_MODEL]
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)['input_ids']]
+
+CAPTION_TOKENIZERS = {
+    'approx': approx_token_counts,
+    'whitespace': whitespace_token_counts,
+    'model': model_token_counts,
+}
+loaded_tokenizers = {}
+caption_tokenizer_lock = threading.Lock()
+
+def split_caption_tags(text, split_char=','):
+    """Lowercased non-empty tags, the same way dedupeTags compares them"""
+    return [tag.strip().lower() for tag in text.split(split_char) if tag.strip()]
+
+def caption_stats_entries(dataset, tokenizer_name):
+    """{caption filename: {mtime, size, tags, tokens: {tokenizer: count}}} for all captions.
+
+    Entries are cached in .qdm/caption_stats.json and only captions whose
+    mtime or size changed are read and tokenized again, in batches.
+    """
+    cache_path = Path(dataset.path) / META_DIRNAME / CAPTION_STATS_CACHE
+    cached = {}
+    if cache_path.exists():
+        try:
+            cached = json.loads(cache_path.read_text(encoding='utf-8'))
+        except ValueError:
+            cached = {}  # unreadable cache, rebuilt below
+
+    img_dir = dataset.folder_path(IMG_FOLDER)
+    entries = {}
+    stale = []
+    for name in dataset.captions().values():
+        stat = os.stat(os.path.join(img_dir, name))
+        entry = cached.get(name)
+        if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'tags': None, 'tokens': {}}
+        entries[name] = entry
+        if entry['tags'] is None or tokenizer_name not in entry['tokens']:
+            stale.append(name)
+    changed = bool(stale) or len(entries) != len(cached)
+
+    count_tokens = CAPTION_TOKENIZERS[tokenizer_name]
+    for start in range(0, len(stale), CAPTION_STATS_BATCH):
+        batch = stale[start:start + CAPTION_STATS_BATCH]
+        texts = []
+        for name in batch:
+            with open(os.path.join(img_dir, name), 'r', encoding='utf-8', errors='replace') as f:
+                texts.append(f.read())
+            metrics.inc('bytes_read', entries[name]['size'])
+        for name, text, count in zip(batch, texts, count_tokens(texts)):
+            entries[name]['tags'] = split_caption_tags(text)
+            entries[name]['tokens'][tokenizer_name] = count
+
+    if changed:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(cache_path, json.dumps(entries, ensure_ascii=False, separators=(',', ':')))
+    return entries, len(stale)
+
+def token_histogram(counts, bins):
+    """[{start, end, count}] with equal-width bins over 0..max"""
+    if not counts:
+        return []
+    width = max(1, -(-(max(counts) + 1) // bins))
+    histogram = [0] * -(-(max(counts) + 1) // width)
+    for count in counts:
+        histogram[count // width] += 1
+    return [{'start': i * width, 'end': (i + 1) * width - 1, 'count': n} for i, n in enumerate(histogram)]
+
+@app.route('/api/captions/stats')
+def get_caption_stats():
+    """Token lengths and tag frequencies of all captions in the dataset.
+
+    Query: tokenizer (approx/whitespace/model), limit (token budget),
+    bins (histogram buckets), top (tag table size).
+    """
+    folder_path = request.args.get('folder', '')
+    tokenizer_name = request.args.get('tokenizer', 'approx')
+    limit = request.args.get('limit', CAPTION_TOKEN_LIMIT, type=int)
+    bins = min(max(request.args.get('bins', 20, type=int), 1), 200)
+    top = max(request.args.get('top', 50, type=int), 0)
+    
+    if tokenizer_name not in CAPTION_TOKENIZERS:
+        return jsonify({'error': f"tokenizer must be one of {', '.join(CAPTION_TOKENIZERS)}"}), 400
+    
+    try:
+        dataset = open_dataset(folder_path)
+        if not dataset.exists():
+            return jsonify({'error': 'Image directory not found'}), 404
+        
+        dataset.scan()
+        entries, tokenized = caption_stats_entries(dataset, tokenizer_name)
+        
+        lengths = {name: entry['tokens'][tokenizer_name] for name, entry in entries.items()}
+        counts = sorted(lengths.values())
+        over_limit = sorted(((count, name) for name, count in lengths.items() if count > limit), reverse=True)
+        
+        tag_counts = collections.Counter()
+        tags_per_caption = []
+        for entry in entries.values():
+            tags = set(entry['tags'])
+            tag_counts.update(tags)
+            tags_per_caption.append(len(tags))
+        
+        def percentile(p):
+            return counts[min(len(counts) - 1, int(len(counts) * p))] if counts else 0
+        
+        captions = dataset.captions()
+        return jsonify({
+            'tokenizer': tokenizer_name,
+            'limit': limit,
+            'captions': len(entries),
+            'tokenized': tokenized,
+            'missing': sum(1 for basename in dataset.files(IMG_FOLDER) if basename not in captions),
+            'empty': sum(1 for count in counts if count == 0),
+            'tokens': {
+                'min': counts[0] if counts else 0,
+                'max': counts[-1] if counts else 0,
+                'mean': round(sum(counts) / len(counts), 1) if counts else 0,
+                'p50': percentile(0.5),
+                'p95': percentile(0.95),
+                'histogram': token_histogram(counts, bins),
+            },
+            'overLimit': {
+                'count': len(over_limit),
+                'basenames': [{'basename': os.path.splitext(name)[0], 'tokens': count} for count, name in over_limit[:1000]],
+            },
+            'tags': {
+                'unique': len(tag_counts),
+                'perCaption': token_histogram(sorted(tags_per_caption), bins),
+                'top': [{'tag': tag, 'count': count} for tag, count in tag_counts.most_common(top)],
+            },
+        })
+    except ImportError:
+        return jsonify({'error': 'transformers library not installed. Run: pip install transformers'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Trash store: deleted or overwritten files are renamed into <dataset>/.qdm/trash/files/<entry id>/
+# (same filesystem, so no copies) and every operation gets one line in journal.jsonl.
+TRASH_MAX_BYTES = int(os.environ.get('QDM_TRASH_MAX_MB', '2048')) * 1024 * 1024
+TRASH_MAX_AGE_DAYS = float(os.environ.get('QDM_TRASH_MAX_AGE_DAYS', '30'))
+trash_lock = threading.RLock()
+
+def get_trash_dir(dataset_dir):
+    return Path(dataset_dir) / META_DIRNAME / 'trash'
+
+def read_trash_journal(dataset_dir):
+    journal_path = get_trash_dir(dataset_dir) / 'journal.jsonl'
+    if not journal_path.exists():
+        return []
+    entries = []
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return entries
+
+def write_trash_journal(dataset_dir, entries):
+    trash_dir = get_trash_dir(dataset_dir)
+    trash_dir.mkdir(parents=True, exist_ok=True)
+    atomic_write_text(trash_dir / 'journal.jsonl', ''.join(json.dumps(e) + '\n' for e in entries))
+
+def record_trash_entry(dataset_dir, action, files=None, entry_id=None, evict=True, **extra):
+    """Append an operation to the trash journal and apply the eviction limits"""
+    files = files or []
+    entry = {
+        'id': entry_id or f"{int(time.time() * 1000):x}-{uuid.uuid4().hex[:6]}",
+        'time': time.time(),
+        'action': action,
+        'files': files,
+        'size': sum(f['size'] for f in files),
+        **extra
+    }
+    with trash_lock:
+        trash_dir = get_trash_dir(dataset_dir)
+        trash_dir.mkdir(parents=True, exist_ok=True)
+        with open(trash_dir / 'journal.jsonl', 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+        if evict:
+            evict_trash(dataset_dir)
+    return entry
+
+def move_to_trash(dataset_dir, paths, action, evict=True, **extra):
+    """Rename files (absolute paths inside dataset_dir) into the trash under a single journal entry.
+
+    Returns (entry, errors); entry is None when nothing could be moved.
+    """
+    dataset_dir = Path(dataset_dir)
+    entry_id = f"{int(time.time() * 1000):x}-{uuid.uuid4().hex[:6]}"
+    entry_dir = get_trash_dir(dataset_dir) / 'files' / entry_id
+    files = []
+    errors = []
+
+    for path in paths:
+        rel = Path(path).relative_to(dataset_dir)
+        try:
+            size = os.stat(path).st_size
+            stored = entry_dir / rel
+            stored.parent.mkdir(parents=True, exist_ok=True)
+            os.rename(path, stored)
+            files.append({'path': rel.as_posix(), 'size': size})
+        except Exception as e:
+            errors.append(f"Failed to move {rel.as_posix()} to trash: {str(e)}")
+
+    if not files:
+        return None, errors
+
+    return record_trash_entry(dataset_dir, action, files, entry_id=entry_id, evict=evict, **extra), errors
+
+def purge_trash_entries(dataset_dir, entry_ids):
+    """Permanently delete trash entries and their stored files"""
+    entry_ids = set(entry_ids)
+    with trash_lock:
+        entries = read_trash_journal(dataset_dir)
+        kept = [e for e in entries if e['id'] not in entry_ids]
+        write_trash_journal(dataset_dir, kept)
+    for entry_id in entry_ids:
+        entry_dir = get_trash_dir(dataset_dir) / 'files' / entry_id
+        if entry_dir.exists():
+            shutil.rmtree(entry_dir, ignore_errors=True)
+    return len(entries) - len(kept)
+
+def evict_trash(dataset_dir):
+    """Drop entries older than TRASH_MAX_AGE_DAYS, then oldest first until under TRASH_MAX_BYTES"""
+    with trash_lock:
+        entries = sorted(read_trash_journal(dataset_dir), key=lambda e: e['time'])
+        cutoff = time.time() - TRASH_MAX_AGE_DAYS * 86400
+        evicted = [e['id'] for e in entries if e['time'] < cutoff]
+        entries = [e for e in entries if e['time'] >= cutoff]
+
+        total = sum(e['size'] for e in entries)
+        while entries and total > TRASH_MAX_BYTES:
+            oldest = entries.pop(0)
+            total -= oldest['size']
+            evicted.append(oldest['id'])
+
+        if evicted:
+            purge_trash_entries(dataset_dir, evicted)
+    return evicted
+
+def restore_trash_entry(dataset_dir, entry):
+    """Undo one journaled operation; files currently in the way are moved to the trash first"""
+    dataset_dir = Path(dataset_dir)
+    entry_dir = get_trash_dir(dataset_dir) / 'files' / entry['id']
+    restored = []
+    errors = []
+
+    # Files that were deleted or overwritten go back to their original place
+    conflicts = [dataset_dir / f['path'] for f in entry['files'] if (dataset_dir / f['path']).exists()]
+    if conflicts:
+        _, conflict_errors = move_to_trash(dataset_dir, conflicts, 'restore', evict=False, restoredFrom=entry['id'])
+        errors.extend(conflict_errors)
+
+    for f in entry['files']:
+        stored = entry_dir / f['path']
+        target = dataset_dir / f['path']
+        try:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.rename(stored, target)
+            restored.append(f['path'])
+        except Exception as e:
+            errors.append(f"Failed to restore {f['path']}: {str(e)}")
+
+    # Transfers are undone by moving the files back from the target dataset. Older entries
+    # hold absolute paths, which the joins below keep as they are.
+    target_dir = dataset_dir / entry.get('target', '')
+    for move in entry.get('moves', []):
+        src = target_dir / move['to']
+        target = dataset_dir / move['from']
+        if not src.exists():
+            errors.append(f"{move['to']} no longer exists")
+        elif target.exists():
+            errors.append(f"{move['from']} already exists")
+        else:
+            os.rename(src, target)
+            restored.append(move['from'])
+
+    # Files created by an operation (e.g. crop augment) are moved to the trash
+    created = [dataset_dir / p for p in entry.get('created', []) if (dataset_dir / p).exists()]
+    if created:
+        _, created_errors = move_to_trash(dataset_dir, created, 'restore', evict=False, restoredFrom=entry['id'])
+        errors.extend(created_errors)
+        restored.extend(entry.get('created', []))
+
+    return restored, errors
+
+@app.route('/api/trash')
+def list_trash():
+    """List trash/undo journal entries of a dataset, newest first"""
+    folder_path = request.args.get('folder', '')
+    try:
+        dataset_dir = resolve_dataset(folder_path)
+        if not folder_path or not dataset_dir.exists():
+            return jsonify({'error': 'Dataset not found'}), 404
+
+        entries = sorted(read_trash_journal(dataset_dir), key=lambda e: e['time'], reverse=True)
+        return jsonify({
+            'entries': entries,
+            'totalSizeMB': round(sum(e['size'] for e in entries) / (1024 * 1024), 2)
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/compare-datasets', methods=['POST'])
-def compare_datasets():
-    """Compare two datasets and find orphan files in linked dataset"""
+@app.route('/api/trash/restore', methods=['POST'])
+def restore_trash():
+    """Restore a trash entry (defaults to the most recent one)"""
+    folder_path = request.args.get('folder', '')
+    data = request.get_json() or {}
+    entry_id = data.get('id', '')
+
     try:
-        data = request.get_json() or {}
-        primary_folder = data.get('primaryFolder', '')
-        linked_folder = data.get('linkedFolder', '')
-        
-        if not primary_folder or not linked_folder:
-            return jsonify({'error': 'Primary and linked folders are required'}), 400
-        
-        primary_dir = DATASETS_DIR / primary_folder / 'img'
-        linked_dir = DATASETS_DIR / linked_folder / 'img'
-        
-        if not primary_dir.exists():
-            return jsonify({'error': 'Primary dataset not found'}), 404
-        if not linked_dir.exists():
-            return jsonify({'error': 'Linked dataset not found'}), 404
-        
-        # Get basenames from both datasets
-        primary_basenames = set()
-        for f in primary_dir.iterdir():
-            if f.is_file() and f.suffix.lower() in ['.png', '.jpg', '.jpeg', '.webp']:
-                primary_basenames.add(f.stem)
-        
-        linked_basenames = set()
-        for f in linked_dir.iterdir():
-            if f.is_file() and f.suffix.lower() in ['.png', '.jpg', '.jpeg', '.webp']:
-                linked_basenames.add(f.stem)
-        
-        # Find orphans (in linked but not in primary)
-        orphan_basenames = linked_basenames - primary_basenames
-        
-        # Get full filenames for orphans
-        orphans = []
-        for basename in orphan_basenames:
-            for f in linked_dir.iterdir():
-                if f.stem == basename and f.suffix.lower() in ['.png', '.jpg', '.jpeg', '.webp']:
-                    orphans.append(f.name)
-                    break
-        
+        dataset_dir = resolve_dataset(folder_path)
+        if not folder_path or not dataset_dir.exists():
+            return jsonify({'error': 'Dataset not found'}), 404
+
+        with trash_lock:
+            entries = sorted(read_trash_journal(dataset_dir), key=lambda e: e['time'])
+            if entry_id:
+                entry = next((e for e in entries if e['id'] == entry_id), None)
+            else:
+                entry = next((e for e in reversed(entries) if e['action'] != 'restore'), None)
+            if entry is None:
+                return jsonify({'error': 'Trash entry not found'}), 404
+
+            restored, errors = restore_trash_entry(dataset_dir, entry)
+            purge_trash_entries(dataset_dir, [entry['id']])
+            evict_trash(dataset_dir)
+
         return jsonify({
-            'orphans': orphans,
-            'primaryCount': len(primary_basenames),
-            'linkedCount': len(linked_basenames),
-            'orphanCount': len(orphans)
+            'success': bool(restored),
+            'id': entry['id'],
+            'action': entry['action'],
+            'restored': restored,
+            'errors': errors if errors else None
         })
-        
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/images')
-def get_images():
-    """Get list of images from the img folder"""
+@app.route('/api/trash/purge', methods=['POST'])
+def purge_trash():
+    """Permanently delete trash entries: by id, everything older than N days, or all"""
+    folder_path = request.args.get('folder', '')
+    data = request.get_json() or {}
+
+    try:
+        dataset_dir = resolve_dataset(folder_path)
+        if not folder_path or not dataset_dir.exists():
+            return jsonify({'error': 'Dataset not found'}), 404
+
+        entries = read_trash_journal(dataset_dir)
+        if data.get('all'):
+            ids = [e['id'] for e in entries]
+        elif 'olderThanDays' in data:
+            cutoff = time.time() - float(data['olderThanDays']) * 86400
+            ids = [e['id'] for e in entries if e['time'] < cutoff]
+        elif data.get('id'):
+            ids = [data['id']]
+        else:
+            return jsonify({'error': 'Specify id, olderThanDays or all'}), 400
+
+        purged = purge_trash_entries(dataset_dir, ids)
+        return jsonify({'success': True, 'purged': purged})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Snapshots: a manifest of filename -> content hash per layout folder in
+# <dataset>/.qdm/snapshots/<id>.json, with the file contents kept once per hash in a
+# content-addressed store shared by all datasets of the same root.
+SNAPSHOT_LIST_LIMIT = 1000
+
+FICLONE = 0x40049409  # Linux ioctl: share the source's extents until either file is written
+
+def clone_file(source, target):
+    """Copy source to target, as a copy-on-write clone where the filesystem supports it (btrfs, XFS)"""
+    if fcntl is not None:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(source, target)
+
+class SnapshotStore:
+    """Content-addressed blobs in <root>/.qdm/objects/<2 hex>/<hash>.
+
+    A blob is a copy of the dataset file it was taken from (a clone where the
+    filesystem supports it), so writing to a dataset file, in place or not,
+    never changes a stored blob. A blob whose mtime or size no longer matches
+    the manifest is refused on restore.
+
+    Every snapshot lists the hashes it uses in <root>/.qdm/snapshot_refs/<id>.json,
+    so garbage collection reads one folder instead of walking the root.
+
+    File hashes are cached in <root>/.qdm/hash_cache.json by (device, inode)
+    together with mtime and size, so only new or modified files are read.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = root / META_DIRNAME / 'objects'
+        self.objects_path = str(self.objects_dir)
+        self.refs_dir = root / META_DIRNAME / 'snapshot_refs'
+        self.cache_path = root / META_DIRNAME / 'hash_cache.json'
+        self.hash_cache = None  # "dev:ino" -> [mtime_ns, size, hash]
+        self.lock = threading.RLock()
+
+    def load_cache(self):
+        if self.hash_cache is None:
+            try:
+                self.hash_cache = json.loads(self.cache_path.read_text(encoding='utf-8'))
+            except (FileNotFoundError, ValueError):
+                self.hash_cache = {}
+        return self.hash_cache
+
+    def save_cache(self):
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(self.cache_path, json.dumps(self.hash_cache, separators=(',', ':')))
+
+    def cached_hash(self, stat):
+        cached = self.hash_cache.get(f"{stat.st_dev}:{stat.st_ino}")
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        return None
+
+    def file_hash(self, path, stat):
+        key = f"{stat.st_dev}:{stat.st_ino}"
+        digest = hash_file(path)
+        metrics.inc('bytes_read', stat.st_size)
+        self.hash_cache[key] = [stat.st_mtime_ns, stat.st_size, digest]
+        return digest
+
+    def blob_path(self, digest):
+        # Plain string joins: this runs once per file of every snapshot
+        return os.path.join(self.objects_path, digest[:2], digest)
+
+    def store(self, path, digest, stat):
+        """Keep path's content under digest. Returns (blob mtime_ns, whether a blob was added)"""
+        blob = self.blob_path(digest)
+        try:
+            return os.stat(blob).st_mtime_ns, False
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(blob), f".{digest}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            clone_file(path, tmp_path)
+            os.replace(tmp_path, blob)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        metrics.inc('bytes_written', stat.st_size)
+        return os.stat(blob).st_mtime_ns, True
+
+    def add_refs(self, snapshot_id, digests):
+        """Record the blobs a snapshot uses; call with the lock held"""
+        self.refs_dir.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(self.refs_dir / f"{snapshot_id}.json", json.dumps(sorted(digests)))
+
+    def remove_refs(self, snapshot_id):
+        with self.lock:
+            (self.refs_dir / f"{snapshot_id}.json").unlink(missing_ok=True)
+
+    def referenced(self):
+        """Hashes used by any snapshot in the root; call with the lock held"""
+        if not self.refs_dir.exists():
+            self.index_refs()
+        referenced = set()
+        for path in self.refs_dir.glob('*.json'):
+            referenced.update(json.loads(path.read_text(encoding='utf-8')))
+        return referenced
+
+    def index_refs(self):
+        """Build snapshot_refs from the manifests of a root whose snapshots predate it (walks the root once)"""
+        self.refs_dir.mkdir(parents=True, exist_ok=True)
+        for dirpath, dirnames, _ in os.walk(self.root):
+            for manifest_path in get_snapshots_dir(dirpath).glob('*.json'):
+                manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+                self.add_refs(manifest['id'], {entry[0] for names in manifest['files'].values() for entry in names.values()})
+            # Any folder may hold snapshots (not only complete datasets), but never inside the layout folders
+            dirnames[:] = [name for name in dirnames if not name.startswith('.') and name not in LAYOUT_FOLDERS]
+
+    def scan(self, dataset_dir, workers=IMPORT_WORKERS):
+        """[(folder, name, path, stat, hash)] of the dataset's files; uncached hashes are computed in parallel.
+
+        Returns (files, number of files read).
+        """
+        entries = []
+        for folder in LAYOUT_FOLDERS:
+            try:
+                with os.scandir(dataset_dir / folder) as it:
+                    for entry in it:
+                        if not entry.name.startswith('.') and entry.is_file():
+                            entries.append((folder, entry.name, entry.path, entry.stat()))
+            except FileNotFoundError:
+                continue
+        metrics.inc('files_scanned', len(entries))
+        self.load_cache()
+        hashes = [self.cached_hash(stat) for _, _, _, stat in entries]
+        missing = [i for i, digest in enumerate(hashes) if digest is None]
+        if missing:
+            with ThreadPoolExecutor(max(1, workers)) as pool:
+                for i, digest in zip(missing, pool.map(lambda i: self.file_hash(entries[i][2], entries[i][3]), missing)):
+                    hashes[i] = digest
+        return [entry + (digest,) for entry, digest in zip(entries, hashes)], len(missing)
+
+snapshot_stores = {}  # root -> SnapshotStore
+snapshot_stores_lock = threading.Lock()
+
+def get_snapshot_store(dataset_dir):
+    """Store of the root containing dataset_dir"""
+    dataset_dir = Path(dataset_dir)
+    roots = [root for root in get_dataset_roots().values() if dataset_dir == root or root in dataset_dir.parents]
+    root = max(roots, key=lambda r: len(r.parts)) if roots else dataset_dir.parent
+    with snapshot_stores_lock:
+        if root not in snapshot_stores:
+            snapshot_stores[root] = SnapshotStore(root)
+        return snapshot_stores[root]
+
+def get_snapshots_dir(dataset_dir):
+    return Path(dataset_dir) / META_DIRNAME / 'snapshots'
+
+def read_snapshot(dataset_dir, snapshot_id):
+    if not re.match(r'^[0-9a-f]+-[0-9a-f]+$', snapshot_id or ''):
+        return None
+    path = get_snapshots_dir(dataset_dir) / f"{snapshot_id}.json"
+    if not path.exists():
+        return None
+    return json.loads(path.read_text(encoding='utf-8'))
+
+def create_snapshot(dataset_dir, label=''):
+    """Snapshot the dataset's img/ControlN files. Returns the manifest summary."""
+    start = time.perf_counter()
+    store = get_snapshot_store(dataset_dir)
+    snapshot_id = f"{int(time.time() * 1000):x}-{uuid.uuid4().hex[:6]}"
+    with store.lock:
+        files, hashed = store.scan(dataset_dir)
+        manifest_files = {}
+        added = 0
+        if not store.refs_dir.exists():
+            # Index older snapshots first: once the folder exists, gc trusts it
+            store.index_refs()
+        for folder, name, path, stat, digest in files:
+            blob_mtime, new_blob = store.store(path, digest, stat)
+            added += new_blob
+            manifest_files.setdefault(folder, {})[name] = [digest, stat.st_size, blob_mtime]
+        # Referenced before the lock is released, so a concurrent gc keeps the new blobs
+        store.add_refs(snapshot_id, {digest for *_, digest in files})
+        if hashed:
+            store.save_cache()
+
+    manifest = {
+        'id': snapshot_id,
+        'label': label,
+        'created': time.time(),
+        'count': len(files),
+        'size': sum(stat.st_size for _, _, _, stat, _ in files),
+        'files': manifest_files,
+    }
+    snapshots_dir = get_snapshots_dir(dataset_dir)
+    snapshots_dir.mkdir(parents=True, exist_ok=True)
+    atomic_write_text(snapshots_dir / f"{manifest['id']}.json", json.dumps(manifest, separators=(',', ':')))
+    summary = {key: manifest[key] for key in ('id', 'label', 'created', 'count', 'size')}
+    summary.update({'hashed': hashed, 'newBlobs': added, 'seconds': round(time.perf_counter() - start, 2)})
+    return summary
+
+def current_snapshot_files(dataset_dir):
+    """Manifest-style {folder: {name: [hash, size, mtime]}} of the dataset as it is now"""
+    store = get_snapshot_store(dataset_dir)
+    with store.lock:
+        files, hashed = store.scan(dataset_dir)
+        if hashed:
+            store.save_cache()
+    current = {}
+    for folder, name, _, stat, digest in files:
+        current.setdefault(folder, {})[name] = [digest, stat.st_size, stat.st_mtime_ns]
+    return current
+
+def diff_snapshot_files(old, new):
+    """{folder: {added, removed, modified}} between two manifest file maps (changed folders only)"""
+    diff = {}
+    for folder in LAYOUT_FOLDERS:
+        a, b = old.get(folder, {}), new.get(folder, {})
+        changes = {
+            'added': sorted(name for name in b if name not in a),
+            'removed': sorted(name for name in a if name not in b),
+            'modified': sorted(name for name in a if name in b and a[name][0] != b[name][0]),
+        }
+        if any(changes.values()):
+            diff[folder] = changes
+    return diff
+
+def gc_snapshot_store(store):
+    """Remove blobs that no snapshot of any dataset in the store's root references"""
+    removed = freed = 0
+    with store.lock:
+        if not store.objects_dir.exists():
+            return 0, 0
+        referenced = store.referenced()
+        for blob in store.objects_dir.glob('*/*'):
+            if blob.name not in referenced and not blob.name.startswith('.'):
+                stat = blob.stat()
+                blob.unlink()
+                removed += 1
+                # Space is only freed when no dataset file shares the inode (blobs of older snapshots were hardlinks)
+                freed += stat.st_size if stat.st_nlink == 1 else 0
+    return removed, freed
+
+@app.route('/api/snapshots')
+def list_snapshots():
     folder_path = request.args.get('folder', '')
     
     try:
-        dataset_dir = DATASETS_DIR / folder_path
-        img_dir = dataset_dir / 'img'
-        
-        if not img_dir.exists():
-            return jsonify({'error': 'Image directory not found'}), 404
-        
-        images = []
-        for file in sorted(img_dir.iterdir()):
-            if file.is_file() and file.suffix.lower() in ['.png', '.jpg', '.jpeg', '.webp']:
-                images.append(file.name)
-        
-        return jsonify({'images': images})
+        dataset_dir = resolve_dataset(folder_path)
+        snapshots = []
+        snapshots_dir = get_snapshots_dir(dataset_dir)
+        if snapshots_dir.exists():
+            for path in snapshots_dir.glob('*.json'):
+                manifest = json.loads(path.read_text(encoding='utf-8'))
+                snapshots.append({key: manifest[key] for key in ('id', 'label', 'created', 'count', 'size')})
+        snapshots.sort(key=lambda x: x['created'], reverse=True)
+        return jsonify({'snapshots': snapshots})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/image/<image_type>/<filename>')
-def get_image(image_type, filename):
-    """Serve individual image from specified folder type"""
+@app.route('/api/snapshots', methods=['POST'])
+def create_snapshot_endpoint():
+    """Snapshot the dataset (JSON body: optional label)"""
     folder_path = request.args.get('folder', '')
+    data = request.get_json(silent=True) or {}
     
     try:
-        dataset_dir = DATASETS_DIR / folder_path
-        
-        # Validate image_type
-        if image_type not in ['img', 'Control1', 'Control2', 'Control3']:
-            return jsonify({'error': 'Invalid image type'}), 400
-        
-        image_dir = dataset_dir / image_type
-        image_path = image_dir / filename
+        dataset_dir = resolve_dataset(folder_path)
+        if not folder_path or not (dataset_dir / 'img').exists():
+            return jsonify({'error': 'Dataset not found'}), 404
         
-        if not image_path.exists():
-            return jsonify({'error': 'Image not found'}), 404
+        return jsonify({'success': True, **create_snapshot(dataset_dir, label=str(data.get('label', '')))})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/snapshots/diff')
+def diff_snapshots():
+    """Changes between two snapshots (from, to), or a snapshot and the current files (to=current, default)"""
+    folder_path = request.args.get('folder', '')
+    from_id = request.args.get('from', '')
+    to_id = request.args.get('to', 'current')
+    
+    try:
+        dataset_dir = resolve_dataset(folder_path)
+        old = read_snapshot(dataset_dir, from_id)
+        if old is None:
+            return jsonify({'error': 'Snapshot not found'}), 404
+        if to_id == 'current':
+            new_files = current_snapshot_files(dataset_dir)
+        else:
+            new = read_snapshot(dataset_dir, to_id)
+            if new is None:
+                return jsonify({'error': 'Snapshot not found'}), 404
+            new_files = new['files']
         
-        return send_file(image_path)
+        diff = diff_snapshot_files(old['files'], new_files)
+        totals = {kind: sum(len(changes[kind]) for changes in diff.values()) for kind in ('added', 'removed', 'modified')}
+        for changes in diff.values():
+            for kind in changes:
+                changes[kind] = changes[kind][:SNAPSHOT_LIST_LIMIT]
+        return jsonify({'from': from_id, 'to': to_id, 'totals': totals, 'folders': diff})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/caption/<filename>')
-def get_caption(filename):
-    """Get caption text for an image"""
+@app.route('/api/snapshots/<snapshot_id>/restore', methods=['POST'])
+def restore_snapshot(snapshot_id):
+    """Make the dataset match a snapshot. Replaced and extra files go to the trash (one entry)."""
     folder_path = request.args.get('folder', '')
+    
     try:
-        dataset_dir = DATASETS_DIR / folder_path
-        basename = os.path.splitext(filename)[0]
-        txt_path = dataset_dir / 'img' / f"{basename}.txt"
+        dataset_dir = resolve_dataset(folder_path)
+        manifest = read_snapshot(dataset_dir, snapshot_id)
+        if manifest is None:
+            return jsonify({'error': 'Snapshot not found'}), 404
         
-        if not txt_path.exists():
-            return jsonify({'caption': ''})
+        store = get_snapshot_store(dataset_dir)
+        # No ingest or other restore may add files meanwhile, and no gc may drop the blobs being copied
+        with dataset_lock(dataset_dir), store.lock:
+            current = current_snapshot_files(dataset_dir)
+            diff = diff_snapshot_files(current, manifest['files'])
             
-        with open(txt_path, 'r', encoding='utf-8') as f:
-            caption = f.read()
+            # Check every blob first so a damaged snapshot leaves the dataset untouched
+            to_copy = []
+            for folder, changes in diff.items():
+                for name in changes['added'] + changes['modified']:
+                    digest, size, mtime = manifest['files'][folder][name]
+                    blob = store.blob_path(digest)
+                    try:
+                        stat = os.stat(blob)
+                    except FileNotFoundError:
+                        return jsonify({'error': f'Snapshot data missing for {folder}/{name}'}), 409
+                    if stat.st_size != size or stat.st_mtime_ns != mtime:
+                        return jsonify({'error': f'Snapshot data for {folder}/{name} was modified in place'}), 409
+                    to_copy.append((blob, dataset_dir / folder / name))
             
-        return jsonify({'caption': caption})
+            to_trash = [dataset_dir / folder / name for folder, changes in diff.items()
+                        for name in changes['removed'] + changes['modified']]
+            entry, errors = move_to_trash(dataset_dir, to_trash, 'snapshot-restore', snapshot=snapshot_id) if to_trash else (None, [])
+            if errors:
+                return jsonify({'error': 'Could not move files to the trash', 'errors': errors}), 500
+            
+            for folder in LAYOUT_FOLDERS:
+                (dataset_dir / folder).mkdir(parents=True, exist_ok=True)
+            for blob, target in to_copy:
+                # A copy, not a link: later writes to the restored file must not reach the blob
+                tmp_path = target.with_name(f".{target.name}.{uuid.uuid4().hex[:8]}.tmp")
+                try:
+                    clone_file(blob, tmp_path)
+                    os.replace(tmp_path, target)
+                except BaseException:
+                    tmp_path.unlink(missing_ok=True)
+                    raise
+                metrics.inc('bytes_written', os.path.getsize(target))
+        
+        return jsonify({
+            'success': True,
+            'restored': len(to_copy),
+            'removed': sum(len(changes['removed']) for changes in diff.values()),
+            'trashId': entry['id'] if entry else None,
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/caption/<filename>', methods=['POST'])
-def save_caption(filename):
-    """Save caption text for an image"""
+@app.route('/api/snapshots/<snapshot_id>', methods=['DELETE'])
+def delete_snapshot(snapshot_id):
+    """Delete a snapshot and the blobs no other snapshot in the same root needs"""
     folder_path = request.args.get('folder', '')
+    
     try:
-        data = request.get_json() or {}
-        caption = data.get('caption', '')
-        
-        dataset_dir = DATASETS_DIR / folder_path
-        basename = os.path.splitext(filename)[0]
-        txt_path = dataset_dir / 'img' / f"{basename}.txt"
-        
-        # Ensure img directory exists
-        (dataset_dir / 'img').mkdir(parents=True, exist_ok=True)
-        
-        with open(txt_path, 'w', encoding='utf-8') as f:
-            f.write(caption)
-            
-        return jsonify({'success': True})
+        dataset_dir = resolve_dataset(folder_path)
+        if read_snapshot(dataset_dir, snapshot_id) is None:
+            return jsonify({'error': 'Snapshot not found'}), 404
+        store = get_snapshot_store(dataset_dir)
+        (get_snapshots_dir(dataset_dir) / f"{snapshot_id}.json").unlink()
+        store.remove_refs(snapshot_id)
+        removed, freed = gc_snapshot_store(store)
+        return jsonify({'success': True, 'blobsRemoved': removed, 'freedMB': round(freed / (1024 * 1024), 2)})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/delete/<filename>', methods=['DELETE'])
 def delete_image(filename):
-    """Delete all related files (img, Control1-3, txt) with the same filename, optionally from linked dataset too"""
+    """Delete all related files (img, Control1-3, txt) with the same filename, optionally from linked dataset too.
+
+    Files are moved to the dataset trash and can be brought back with /api/trash/restore.
+    """
     folder_path = request.args.get('folder', '')
     linked_folder = request.args.get('linkedFolder', '')
     
@@ -255,33 +3479,24 @@ def delete_image(filename):
         deleted_files = []
         errors = []
         
-        # Helper function to delete from a single dataset
+        trash_ids = []
+        
+        # Helper function to move a sample of a single dataset to its trash
         def delete_from_dataset(dataset_path, prefix=''):
-            dataset_dir = DATASETS_DIR / dataset_path
-            folders_to_check = ['img', 'Control1', 'Control2', 'Control3']
-            basename = os.path.splitext(filename)[0]
-            txt_filename = f"{basename}.txt"
-            
-            # Delete txt file from img folder
-            txt_path = dataset_dir / 'img' / txt_filename
-            if txt_path.exists():
-                try:
-                    txt_path.unlink()
-                    deleted_files.append(f"{prefix}img/{txt_filename}")
-                except Exception as e:
-                    errors.append(f"Failed to delete {prefix}img/{txt_filename}: {str(e)}")
+            dataset = open_dataset(dataset_path)
+            dataset_dir = Path(dataset.path)
             
-            # Delete image files
-            for folder_name in folders_to_check:
-                folder = dataset_dir / folder_name
-                file_path = folder / filename
-                
-                if file_path.exists():
-                    try:
-                        file_path.unlink()
-                        deleted_files.append(f"{prefix}{folder_name}/{filename}")
-                    except Exception as e:
-                        errors.append(f"Failed to delete {prefix}{folder_name}/{filename}: {str(e)}")
+            # Images in img/Control1-3 with the same basename, plus the caption
+            paths = [Path(path) for _, path in dataset.sample_files(filename)]
+            
+            if not paths:
+                return
+            
+            entry, trash_errors = move_to_trash(dataset_dir, paths, 'delete')
+            errors.extend(f"{prefix}{err}" for err in trash_errors)
+            if entry:
+                trash_ids.append(entry['id'])
+                deleted_files.extend(f"{prefix}{f['path']}" for f in entry['files'])
         
         # Delete from primary dataset
         delete_from_dataset(folder_path)
@@ -294,6 +3509,7 @@ def delete_image(filename):
             return jsonify({
                 'success': True,
                 'deleted': deleted_files,
+                'trashIds': trash_ids,
                 'errors': errors if errors else None
             })
         else:
@@ -321,7 +3537,7 @@ def transfer_image(filename):
         return jsonify({'error': 'Source and target folders must be different'}), 400
     
     try:
-        target_dir = DATASETS_DIR / target_folder
+        target_dir = resolve_dataset(target_folder)
         
         # Verify target exists
         if not target_dir.exists():
@@ -329,74 +3545,54 @@ def transfer_image(filename):
         if not (target_dir / 'img').exists():
             return jsonify({'error': 'Target is not a valid dataset (no img folder)'}), 400
         
-        # Get basename without extension
-        basename = os.path.splitext(filename)[0]
         original_ext = os.path.splitext(filename)[1]
         
-        # Generate unique 8-character name for target
-        import string
-        chars = string.ascii_lowercase + string.digits
-        
-        def generate_unique_name(target_dataset_dir):
-            """Generate a unique name that doesn't exist in target dataset"""
-            existing_names = set()
-            target_img_dir = target_dataset_dir / 'img'
-            if target_img_dir.exists():
-                for f in target_img_dir.iterdir():
-                    existing_names.add(f.stem)
-            
-            while True:
-                import random
-                name = ''.join(random.choices(chars, k=8))
-                if name not in existing_names:
-                    return name
-        
-        def transfer_from_dataset(src_folder, target_dataset_dir, src_basename):
+        def transfer_from_dataset(src_folder, target_dataset_dir, src_filename):
             """Transfer files from source to target with new unique name"""
-            source_dir = DATASETS_DIR / src_folder
+            source = open_dataset(src_folder)
+            source_dir = Path(source.path)
             
             if not source_dir.exists():
                 return [], f"Source directory {src_folder} not found"
             
-            new_basename = generate_unique_name(target_dataset_dir)
-            folders_to_process = ['img', 'Control1', 'Control2', 'Control3']
+            # Generate unique 8-character name for target
+            new_basename = Dataset(target_dataset_dir).unique_basename()
             
+            # Images in img/Control1-3 with this basename (any extension) and the caption
             files_to_transfer = []
-            for folder_name in folders_to_process:
-                source_subfolder = source_dir / folder_name
+            for folder_name, source_path in source.sample_files(src_filename):
+                source_file = Path(source_path)
                 target_subfolder = target_dataset_dir / folder_name
-                
-                if not source_subfolder.exists():
-                    continue
-                
-                # Check for image files with this basename
-                for ext in ['.png', '.jpg', '.jpeg', '.webp']:
-                    source_file = source_subfolder / f"{src_basename}{ext}"
-                    if source_file.exists():
-                        target_subfolder.mkdir(parents=True, exist_ok=True)
-                        target_file = target_subfolder / f"{new_basename}{ext}"
-                        files_to_transfer.append((source_file, target_file))
-                
-                # Check for txt caption file (only in img folder)
-                if folder_name == 'img':
-                    txt_source = source_subfolder / f"{src_basename}.txt"
-                    if txt_source.exists():
-                        txt_target = target_subfolder / f"{new_basename}.txt"
-                        files_to_transfer.append((txt_source, txt_target))
+                target_subfolder.mkdir(parents=True, exist_ok=True)
+                files_to_transfer.append((source_file, target_subfolder / f"{new_basename}{source_file.suffix}"))
             
             # Move all files
             transferred = []
+            moves = []
             for source_file, target_file in files_to_transfer:
                 shutil.move(str(source_file), str(target_file))
                 transferred.append({
-                    'from': str(source_file.relative_to(BASE_DIR)),
-                    'to': str(target_file.relative_to(BASE_DIR))
+                    'from': display_path(source_file),
+                    'to': display_path(target_file)
+                })
+                moves.append({
+                    'from': source_file.relative_to(source_dir).as_posix(),
+                    'to': target_file.relative_to(target_dataset_dir).as_posix()
                 })
             
+            # Journal the move so the transfer can be undone from the source dataset's trash. The target
+            # is stored relative to the source, so the journal survives moving the dataset root.
+            if moves:
+                try:
+                    target = Path(os.path.relpath(target_dataset_dir, source_dir)).as_posix()
+                except ValueError:  # another drive on Windows
+                    target = str(target_dataset_dir.resolve())
+                record_trash_entry(source_dir, 'transfer', moves=moves, target=target)
+            
             return transferred, new_basename
         
         # Transfer from primary dataset
-        primary_transferred, primary_new_name = transfer_from_dataset(source_folder, target_dir, basename)
+        primary_transferred, primary_new_name = transfer_from_dataset(source_folder, target_dir, filename)
         
         if not primary_transferred:
             return jsonify({'error': 'No files found to transfer'}), 404
@@ -409,7 +3605,7 @@ def transfer_image(filename):
         
         # Transfer from linked dataset if provided
         if linked_folder:
-            linked_transferred, linked_new_name = transfer_from_dataset(linked_folder, target_dir, basename)
+            linked_transferred, linked_new_name = transfer_from_dataset(linked_folder, target_dir, filename)
             result['linkedTransferred'] = linked_transferred
             result['linkedNewFilename'] = f"{linked_new_name}{original_ext}" if linked_new_name else None
         
@@ -424,44 +3620,25 @@ def reshuffle_dataset():
     folder_path = request.args.get('folder', '')
     
     try:
-        dataset_dir = DATASETS_DIR / folder_path
-        img_dir = dataset_dir / 'img'
+        dataset = open_dataset(folder_path)
         
-        if not img_dir.exists():
+        if not dataset.exists():
             return jsonify({'error': 'Image directory not found'}), 404
+        
+        # ?snapshot=1: keep a snapshot of the dataset to restore if the result is unwanted
+        snapshot = create_snapshot(Path(dataset.path), label='before reshuffle') if request.args.get('snapshot') else None
             
         # 1. Build a mapping of basenames to their file locations
-        # Structure: {basename: {folder_name: [extensions]}}
-        file_structure = {}
-        folders_to_process = ['img', 'Control1', 'Control2', 'Control3']
-        
-        # Scan img folder to get primary basenames (only image files, not txt)
-        primary_basenames = set()
-        for file in img_dir.iterdir():
-            if file.is_file() and file.suffix.lower() in ['.png', '.jpg', '.jpeg', '.webp']:
-                primary_basenames.add(file.stem)
+        # Structure: {basename: [paths of its images in img/Control1-3 and its caption]}
+        # One listing per folder, then every lookup is served from memory
+        dataset.scan()
+        primary_basenames = dataset.files(IMG_FOLDER)
         
         if not primary_basenames:
             return jsonify({'error': 'No images found'}), 404
         
-        # For each basename, record which extensions exist in which folders
-        for basename in primary_basenames:
-            file_structure[basename] = {}
-            
-            for folder_name in folders_to_process:
-                folder = dataset_dir / folder_name
-                if not folder.exists():
-                    continue
-                
-                extensions = []
-                # Check for image and txt files with this basename
-                for ext in ['.png', '.jpg', '.jpeg', '.webp', '.txt']:
-                    file_path = folder / f"{basename}{ext}"
-                    if file_path.exists():
-                        extensions.append(ext)
-                
-                if extensions:
-                    file_structure[basename][folder_name] = extensions
+        file_structure = {basename: [Path(path) for _, path in dataset.sample_files(filename)]
+                          for basename, filename in primary_basenames.items()}
         
         # 2. Create random permutation of basenames
         basenames_list = list(file_structure.keys())
@@ -486,17 +3663,251 @@ def reshuffle_dataset():
             new_basename = generate_unique_name()
             
             # Rename all files in this set to use the new random basename
-            for folder_name, extensions in file_structure[basename].items():
-                folder = dataset_dir / folder_name
-                for ext in extensions:
-                    old_path = folder / f"{basename}{ext}"
-                    new_path = folder / f"{new_basename}{ext}"
-                    if old_path.exists():
-                        old_path.rename(new_path)
-                        rename_count += 1
+            for old_path in file_structure[basename]:
+                new_path = old_path.with_name(f"{new_basename}{old_path.suffix}")
+                if old_path.exists():
+                    old_path.rename(new_path)
+                    rename_count += 1
+        
+        return jsonify({'success': True, 'count': len(basenames_list), 'files_renamed': rename_count,
+                        'snapshotId': snapshot['id'] if snapshot else None})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Deterministic splits: every sample gets a position in [0, 1) from a seeded hash of its
+# basename (or img content), so the same seed always yields the same partitions
+SPLIT_MODES = ('percent', 'kfold', 'sample')
+SPLIT_NAME = re.compile(r'^[a-zA-Z0-9_-]+$')
+RESOLUTION_BUCKET = 64
+
+def split_position(seed, key):
+    digest = hashlib.sha1(f"{seed}:{key}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+def split_stratum(sample, stratify, tags):
+    """Stratum of a sample: its resolution bucket or a caption tag"""
+    if stratify == 'resolution':
+        from PIL import Image
+        with Image.open(sample.img_path) as img:  # only reads the header
+            width, height = img.size
+        width, height = (max(1, round(size / RESOLUTION_BUCKET)) * RESOLUTION_BUCKET for size in (width, height))
+        return f"{width}x{height}"
+    caption_tags = [tag.strip().lower() for tag in sample.read_caption().split(',') if tag.strip()]
+    if tags:
+        # First of the requested tags found in the caption
+        return next((tag for tag in tags if tag in caption_tags), 'other')
+    return caption_tags[0] if caption_tags else ''
+
+def largest_remainder(total, sizes):
+    """Split total into integers proportional to sizes"""
+    whole = sum(sizes)
+    if not whole:
+        return [0] * len(sizes)
+    exact = [total * size / whole for size in sizes]
+    counts = [int(x) for x in exact]
+    for i in sorted(range(len(sizes)), key=lambda i: exact[i] - counts[i], reverse=True)[:total - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+def plan_split(samples, options):
+    """Assign samples to partitions. Returns ({partition: [samples]}, {stratum: {partition: count}}).
+
+    percent: named weights; without stratification a sample's partition only
+    depends on its own hash, so adding samples never moves existing ones. With
+    stratification each stratum is cut by hash rank for exact proportions.
+    kfold: folds of equal size by hash rank, as foldN_train/foldN_val.
+    sample: count (or percent) samples with the lowest hashes, allocated
+    proportionally to the strata.
+    """
+    mode = options.get('mode', 'percent')
+    seed = options.get('seed', 0)
+    stratify = options.get('stratify')
+    tags = [tag.strip().lower() for tag in options.get('tags') or [] if tag.strip()]
+
+    strata = {}
+    for sample in samples:
+        key = hash_file(sample.img_path) if options.get('hashBy') == 'content' else sample.basename
+        stratum = split_stratum(sample, stratify, tags) if stratify else ''
+        strata.setdefault(stratum, []).append((split_position(seed, key), sample.basename, sample))
+    for members in strata.values():
+        members.sort(key=lambda member: member[:2])
+
+    partitions = {}
+    if mode == 'percent':
+        weights = options.get('splits') or {'train': 90, 'val': 10}
+        names = list(weights)
+        total = sum(float(weights[name]) for name in names)
+        bounds = list(itertools.accumulate(float(weights[name]) / total for name in names))
+        for name in names:
+            partitions[name] = []
+        for members in strata.values():
+            for rank, (position, _, sample) in enumerate(members):
+                if stratify:
+                    position = (rank + 0.5) / len(members)
+                index = next((i for i, bound in enumerate(bounds) if position < bound), len(names) - 1)
+                partitions[names[index]].append(sample)
+    elif mode == 'kfold':
+        folds = int(options.get('folds') or 5)
+        if folds < 2:
+            raise ValueError('folds must be at least 2')
+        for fold in range(1, folds + 1):
+            partitions[f"fold{fold}_train"] = []
+            partitions[f"fold{fold}_val"] = []
+        # Ranks continue across strata, so every fold gets its share of each stratum
+        rank = 0
+        for members in strata.values():
+            for _, _, sample in members:
+                val_fold = rank % folds + 1
+                for fold in range(1, folds + 1):
+                    partitions[f"fold{fold}_{'val' if fold == val_fold else 'train'}"].append(sample)
+                rank += 1
+    else:
+        name = options.get('name') or 'sample'
+        if options.get('count') is not None:
+            count = int(options['count'])
+        else:
+            count = round(len(samples) * float(options.get('percent', 10)) / 100)
+        count = max(0, min(count, len(samples)))
+        allocation = largest_remainder(count, [len(members) for members in strata.values()])
+        partitions[name] = [sample for members, n in zip(strata.values(), allocation) for _, _, sample in members[:n]]
+
+    names_by_sample = {}
+    for name, members in partitions.items():
+        for sample in members:
+            names_by_sample.setdefault(sample.basename, []).append(name)
+    stratum_counts = {}
+    for stratum, members in strata.items():
+        counts = stratum_counts.setdefault(stratum, {})
+        for _, basename, _ in members:
+            for name in names_by_sample.get(basename, ()):
+                counts[name] = counts.get(name, 0) + 1
+    return partitions, stratum_counts
+
+def link_sample_files(files, target_dir):
+    """Hardlink a sample's files into another dataset under the same names. Returns the number linked."""
+    linked = 0
+    for folder, path in files:
+        target = target_dir / folder / os.path.basename(path)
+        try:
+            os.link(path, target)
+            linked += 1
+        except FileExistsError:
+            if not os.path.samefile(path, target):
+                raise FileExistsError(f"{display_path(target)} already exists")
+    return linked
+
+def stale_split_files(files, target_dir):
+    """Files in an existing partition dataset that are not (the same file as) one of `files`.
+
+    files: [(folder, path)] of every sample in the new partition.
+    """
+    wanted = {(folder, os.path.basename(path)): path for folder, path in files}
+    stale = []
+    for folder in LAYOUT_FOLDERS:
+        try:
+            with os.scandir(target_dir / folder) as it:
+                for entry in it:
+                    if entry.name.startswith('.') or not entry.is_file():
+                        continue
+                    source = wanted.get((folder, entry.name))
+                    if source is None or not os.path.samefile(source, entry.path):
+                        stale.append(entry.path)
+        except FileNotFoundError:
+            continue
+    return stale
+
+@app.route('/api/split', methods=['POST'])
+def split_dataset():
+    """Partition the dataset deterministically into train/val splits, k folds or a sample.
+
+    JSON body: mode (percent/kfold/sample), seed, hashBy (name/content),
+    stratify (resolution/tag) with optional tags, splits ({name: weight}),
+    folds, count/percent/name for sampling, output (hardlink/manifest), dryRun.
+    Hardlinked partitions become datasets named <folder>_<partition>; existing
+    ones holding other files are refused unless replace is set, which moves
+    those files to the partition's trash.
+    """
+    folder_path = request.args.get('folder', '')
+    options = request.get_json(silent=True) or {}
+    
+    try:
+        mode = options.get('mode', 'percent')
+        output = options.get('output', 'hardlink')
+        if mode not in SPLIT_MODES:
+            return jsonify({'error': f"mode must be one of {', '.join(SPLIT_MODES)}"}), 400
+        if output not in ('hardlink', 'manifest'):
+            return jsonify({'error': 'output must be hardlink or manifest'}), 400
+        if options.get('stratify') not in (None, 'resolution', 'tag'):
+            return jsonify({'error': 'stratify must be resolution or tag'}), 400
+        invalid = [name for name in (options.get('splits') or {}) if not SPLIT_NAME.match(name)]
+        if mode == 'sample' and options.get('name') and not SPLIT_NAME.match(options['name']):
+            invalid.append(options['name'])
+        if invalid:
+            return jsonify({'error': f"Invalid partition names: {', '.join(invalid)}"}), 400
+        
+        dataset = open_dataset(folder_path)
+        if not folder_path or not dataset.exists():
+            return jsonify({'error': 'Dataset not found'}), 404
+        
+        # One listing per folder; the partitions and file lookups below are served from memory
+        dataset.scan()
+        samples = dataset.samples()
+        partitions, strata = plan_split(samples, options)
         
-        return jsonify({'success': True, 'count': len(basenames_list), 'files_renamed': rename_count})
+        result = {
+            'success': True,
+            'mode': mode,
+            'total': len(samples),
+            'partitions': {name: {'count': len(members)} for name, members in partitions.items()},
+            'strata': strata if options.get('stratify') else None,
+        }
+        if options.get('dryRun'):
+            return jsonify(result)
+        
+        if output == 'manifest':
+            manifest_dir = Path(dataset.path) / META_DIRNAME / 'splits'
+            manifest_dir.mkdir(parents=True, exist_ok=True)
+            manifest_name = options.get('manifestName') or f"{mode}-{options.get('seed', 0)}"
+            if not SPLIT_NAME.match(manifest_name):
+                return jsonify({'error': f'Invalid manifest name: {manifest_name}'}), 400
+            manifest_path = manifest_dir / f"{manifest_name}.json"
+            atomic_write_text(manifest_path, json.dumps({
+                'options': options,
+                'created': time.time(),
+                'partitions': {name: [sample.filename for sample in members] for name, members in partitions.items()},
+            }, indent=2))
+            result['manifest'] = display_path(manifest_path)
+            return jsonify(result)
         
+        files = {sample.basename: dataset.sample_files(sample.filename) for sample in samples}
+        # Leftovers of an earlier split (other seed or weights) would leak samples across partitions
+        stale = {name: stale_split_files([f for sample in members for f in files[sample.basename]],
+                                         resolve_dataset(f"{folder_path}_{name}"))
+                 for name, members in partitions.items()}
+        conflicts = {f"{folder_path}_{name}": len(paths) for name, paths in stale.items() if paths}
+        if conflicts and not options.get('replace'):
+            return jsonify({
+                'error': 'Partition datasets already hold other files (pass "replace": true to move them to the trash)',
+                'conflicts': conflicts,
+            }), 409
+        
+        for name, members in partitions.items():
+            target_folder = f"{folder_path}_{name}"
+            target = Dataset(resolve_dataset(target_folder))
+            target.ensure_layout()
+            removed = 0
+            if stale[name]:
+                entry, errors = move_to_trash(target.path, stale[name], 'split-replace')
+                if errors:
+                    return jsonify({'error': f"Could not clear {target_folder}", 'errors': errors}), 500
+                removed = len(entry['files']) if entry else 0
+            linked = sum(link_sample_files(files[sample.basename], Path(target.path)) for sample in members)
+            result['partitions'][name].update({'folder': target_folder, 'linked': linked, 'removed': removed})
+        
+        return jsonify(result)
+    except ImportError:
+        return jsonify({'error': 'Pillow library not installed. Run: pip install Pillow'}), 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -508,38 +3919,46 @@ def compress_dataset():
     try:
         from PIL import Image
         
-        dataset_dir = DATASETS_DIR / folder_path
-        folders_to_process = ['img', 'Control1', 'Control2', 'Control3']
+        dataset_dir = resolve_dataset(folder_path)
+        snapshot = create_snapshot(dataset_dir, label='before compress') if request.args.get('snapshot') else None
         
         compressed_count = 0
         original_size = 0
         new_size = 0
+        errors = []
         
-        for folder_name in folders_to_process:
+        for folder_name in LAYOUT_FOLDERS:
             folder = dataset_dir / folder_name
             if not folder.exists():
                 continue
             
-            for file_path in folder.iterdir():
+            for file_path in list(folder.iterdir()):
                 if file_path.is_file() and file_path.suffix.lower() == '.png':
+                    tmp_path = file_path.with_name(f".{file_path.name}.{uuid.uuid4().hex[:8]}.tmp")
                     try:
-                        original_size += file_path.stat().st_size
+                        size = file_path.stat().st_size
                         
                         # Open and re-save with compression
-                        img = Image.open(file_path)
-                        
-                        # Convert to RGB if necessary (PNG can have alpha)
-                        if img.mode in ('RGBA', 'LA', 'P'):
-                            # Keep alpha channel
-                            img.save(file_path, 'PNG', optimize=True, compress_level=9)
-                        else:
-                            img.save(file_path, 'PNG', optimize=True, compress_level=9)
+                        with Image.open(file_path) as img:
+                            img.load()
+                            metrics.inc('images_decoded')
+                            metrics.inc('bytes_read', size)
+                            
+                            # Re-save into a temp file and swap it in, so hardlinks of the old
+                            # file (splits) keep their content
+                            img.save(tmp_path, 'PNG', optimize=True, compress_level=9)
+                        os.replace(tmp_path, file_path)
                         
+                        original_size += size
                         new_size += file_path.stat().st_size
+                        metrics.inc('bytes_written', file_path.stat().st_size)
                         compressed_count += 1
                         
                     except Exception as e:
-                        print(f"Failed to compress {file_path}: {e}")
+                        tmp_path.unlink(missing_ok=True)
+                        rel = file_path.relative_to(dataset_dir).as_posix()
+                        logger.warning("Compress of %s: %s failed: %s", dataset_dir, rel, e)
+                        errors.append(f"Failed to compress {rel}: {e}")
         
         # Calculate savings
         savings_mb = (original_size - new_size) / (1024 * 1024)
@@ -550,8 +3969,10 @@ def compress_dataset():
             'compressed': compressed_count,
             'originalSizeMB': round(original_size / (1024 * 1024), 2),
             'newSizeMB': round(new_size / (1024 * 1024), 2),
-        'savingsMB': round(savings_mb, 2),
-            'savingsPercent': round(savings_percent, 1)
+            'savingsMB': round(savings_mb, 2),
+            'savingsPercent': round(savings_percent, 1),
+            'snapshotId': snapshot['id'] if snapshot else None,
+            'errors': errors if errors else None
         })
         
     except ImportError:
@@ -559,6 +3980,91 @@ def compress_dataset():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/storage-policy')
+def get_storage_policy():
+    """Encoding settings applied when images are written to the dataset"""
+    folder_path = request.args.get('folder', '')
+    
+    try:
+        dataset_dir = resolve_dataset(folder_path)
+        if not folder_path or not (dataset_dir / 'img').exists():
+            return jsonify({'error': 'Dataset not found'}), 404
+        
+        return jsonify({
+            'policy': StoragePolicy.load(dataset_dir).settings,
+            'custom': os.path.isfile(StoragePolicy.path_for(dataset_dir)),
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/storage-policy', methods=['POST'])
+def set_storage_policy():
+    """Update the storage policy (JSON body: any of format, compressLevel, quality, lossless, maxSize)"""
+    folder_path = request.args.get('folder', '')
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        dataset_dir = resolve_dataset(folder_path)
+        if not folder_path or not (dataset_dir / 'img').exists():
+            return jsonify({'error': 'Dataset not found'}), 404
+        
+        try:
+            policy = StoragePolicy({**StoragePolicy.load(dataset_dir).settings, **data})
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        policy.save(dataset_dir)
+        
+        return jsonify({'success': True, 'policy': policy.settings})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/pack', methods=['POST'])
+def pack_dataset_files():
+    """Pack the dataset's loose files into its append-only pack (img, controls and caption per record).
+
+    JSON body: removeFiles (delete loose files once packed), rebuild (start a fresh pack).
+    Packing again only appends new or changed samples.
+    """
+    folder_path = request.args.get('folder', '')
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        dataset_dir = resolve_dataset(folder_path)
+        if not folder_path or not (dataset_dir / 'img').exists():
+            return jsonify({'error': 'Dataset not found'}), 404
+        
+        start = time.perf_counter()
+        size_before = (dataset_dir / PACK_DATA).stat().st_size if has_pack(dataset_dir) and not data.get('rebuild') else 0
+        packed = pack_dataset(dataset_dir, remove_files=bool(data.get('removeFiles')), rebuild=bool(data.get('rebuild')))
+        pack = get_pack(dataset_dir)
+        metrics.inc('bytes_written', pack.data_size - size_before)
+        
+        return jsonify({
+            'success': True,
+            'packed': packed,
+            'samples': len(pack.records),
+            'sizeMB': round(pack.data_size / (1024 * 1024), 2),
+            'seconds': round(time.perf_counter() - start, 2)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/unpack', methods=['POST'])
+def unpack_dataset_files():
+    """Write the packed samples back to img/Control1-3 (JSON body: overwrite existing files)"""
+    folder_path = request.args.get('folder', '')
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        dataset_dir = resolve_dataset(folder_path)
+        if not folder_path or not has_pack(dataset_dir):
+            return jsonify({'error': 'Dataset has no pack'}), 404
+        
+        written = unpack_dataset(dataset_dir, overwrite=bool(data.get('overwrite')))
+        return jsonify({'success': True, 'written': written})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/export', methods=['POST'])
 def export_dataset():
     """Export dataset to AI-Toolkit format with separate folders per control type"""
@@ -572,8 +4078,8 @@ def export_dataset():
         return jsonify({'error': 'Export path is required'}), 400
     
     try:
-        dataset_dir = DATASETS_DIR / folder_path
-        dataset_name = folder_path.replace('/', '_')
+        dataset_dir = resolve_dataset(folder_path)
+        dataset_name = re.sub(r'[\\/:]+', '_', folder_path)
         export_base = Path(export_path)
         
         if not dataset_dir.exists():
@@ -616,6 +4122,9 @@ def export_dataset():
                      # Fallback if metadata copy fails (e.g. invalid argument on exFAT)
                     shutil.copy(str(file_path), str(dest_path))
                 copied_count += 1
+                copied_bytes = dest_path.stat().st_size
+                metrics.inc('bytes_read', copied_bytes)
+                metrics.inc('bytes_written', copied_bytes)
             
             exported[src_folder] = {
                 'folder': str(export_folder),
@@ -650,7 +4159,8 @@ def augment_crop():
         if not crop_data or 'x' not in crop_data or 'w' not in crop_data:
             return jsonify({'error': 'Invalid crop data'}), 400
             
-        dataset_dir = DATASETS_DIR / folder_path
+        dataset = open_dataset(folder_path)
+        dataset_dir = Path(dataset.path)
         if not dataset_dir.exists():
             return jsonify({'error': 'Dataset not found'}), 404
             
@@ -664,45 +4174,28 @@ def augment_crop():
             return jsonify({'error': 'Invalid crop dimensions'}), 400
             
         # Generate new unique basename
-        import string
-        chars = string.ascii_lowercase + string.digits
-        
-        def generate_unique_name():
-            existing_names = set()
-            img_dir = dataset_dir / 'img'
-            if img_dir.exists():
-                for f in img_dir.iterdir():
-                    existing_names.add(f.stem)
-            
-            while True:
-                name = ''.join(random.choices(chars, k=8))
-                if name not in existing_names:
-                    return name
-                    
-        new_basename = generate_unique_name()
+        new_basename = dataset.unique_basename()
         
         # Process each folder
         from PIL import Image
         
-        folders_to_process = ['img', 'Control1', 'Control2', 'Control3']
+        # New samples are encoded per the dataset's storage policy (cropped files only, copies stay as they are)
+        policy = StoragePolicy.load(dataset_dir)
         processed_files = []
+        created_files = []
+        errors = []
         
         basename = os.path.splitext(filename)[0]
-        original_ext = os.path.splitext(filename)[1]
         
-        for folder_name in folders_to_process:
+        for folder_name in LAYOUT_FOLDERS:
             src_folder = dataset_dir / folder_name
             
             # Find the file in this folder (might have different extension)
-            src_file = None
-            for ext in ['.png', '.jpg', '.jpeg', '.webp']:
-                temp_path = src_folder / f"{basename}{ext}"
-                if temp_path.exists():
-                    src_file = temp_path
-                    break
+            src_file = dataset.find_file(folder_name, filename)
             
             if not src_file:
                 continue
+            src_file = Path(src_file)
                 
             # Determine logic: Copy original OR Crop & Resize
             # If folder matches source_exception, we keep original (COPY)
@@ -717,6 +4210,8 @@ def augment_crop():
                 # Normal case: Crop and Resize
                 try:
                     img = Image.open(src_file)
+                    metrics.inc('images_decoded')
+                    metrics.inc('bytes_read', src_file.stat().st_size)
                     original_size = img.size # (width, height)
                     
                     # Validate crop bounds
@@ -730,24 +4225,27 @@ def augment_crop():
                          # Fallback to copy if crop is invalid
                          shutil.copy2(src_file, dest_file)
                     else:
+                        dest_file = src_folder / policy.filename(dest_file.name)
                         # Crop
                         cropped_img = img.crop((cx, cy, cx + cw_crop, cy + ch_crop))
                         
                         # Resize back to original size
                         resized_img = cropped_img.resize(original_size, Image.Resampling.LANCZOS)
                         
-                        # Save
-                        # Preservation of format is handled by save() based on extension or img.format
-                        # If original was PNG with P mode (palette), we might want to convert to RGB/RGBA first to avoid issues with resizing?
-                        # But Image.open usually handles it.
-                        
-                        resized_img.save(dest_file)
+                        # Save (format and encoder options from the storage policy); no maxSize
+                        # downscale, the sourceException folder keeps the full size
+                        policy.write(resized_img, dest_file, resize=False)
+                        metrics.inc('bytes_written', dest_file.stat().st_size)
                 except Exception as e:
-                    print(f"Error processing {src_file}: {e}")
-                    # Fallback copy on error?
+                    # Keep the sample complete with an uncropped copy, and report it
+                    rel = src_file.relative_to(dataset_dir).as_posix()
+                    logger.warning("Crop augment of %s: %s failed, copied it uncropped: %s", dataset_dir, rel, e)
+                    errors.append(f"Failed to crop {rel}, copied it uncropped: {e}")
+                    dest_file = src_folder / f"{new_basename}{src_file.suffix}"
                     shutil.copy2(src_file, dest_file)
             
-            processed_files.append(str(dest_file.relative_to(BASE_DIR)))
+            processed_files.append(display_path(dest_file))
+            created_files.append(dest_file.relative_to(dataset_dir).as_posix())
             
             # Handle Caption (only for img folder)
             if folder_name == 'img':
@@ -755,19 +4253,25 @@ def augment_crop():
                 if txt_src.exists():
                     txt_dest = src_folder / f"{new_basename}.txt"
                     shutil.copy2(txt_src, txt_dest)
+                    created_files.append(txt_dest.relative_to(dataset_dir).as_posix())
+
+        # Journal the new set so restoring this entry removes the augment again
+        entry = record_trash_entry(dataset_dir, 'crop', created=created_files) if created_files else None
 
         return jsonify({
             'success': True,
             'newBasename': new_basename,
-            'processed': processed_files
+            'processed': processed_files,
+            'trashId': entry['id'] if entry else None,
+            'errors': errors if errors else None
         })
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Crop augment failed")
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     print(f"Starting Dataset Manager...")
     print(f"Base directory: {BASE_DIR}")
     print(f"Open http://localhost:5001 in your browser")
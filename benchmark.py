@@ -0,0 +1,373 @@
+"""
+Benchmark suite for the dataset manager and the ComfyUI nodes.
+
+Generates synthetic datasets at several scales in a temp dir, times the app.py
+endpoints through Flask's test client plus the loader/saver nodes (with a
+stubbed folder_paths), and writes machine-readable JSON that can be compared
+between runs:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+from PIL import Image
+
+BASE_DIR = Path(__file__).parent
+sys.path.insert(0, str(BASE_DIR))
+
+RESOLUTIONS = [(64, 64), (96, 128), (128, 96), (160, 160)]
+LINKED_ORPHANS = 10
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS counter so the next reading is per-operation (Linux only)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS bytes
+        return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+    return None
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def encoded_samples():
+    """Pre-encode one target/control PNG per resolution so generation is pure file I/O"""
+    samples = []
+    for i, (w, h) in enumerate(RESOLUTIONS):
+        target = Image.new('RGB', (w, h), (40 * i, 120, 200))
+        control = Image.new('RGB', (w, h), (0, 40 * i, 0))
+        encoded = []
+        for img in (target, control):
+            buf = io.BytesIO()
+            img.save(buf, 'PNG', compress_level=0)
+            encoded.append(buf.getvalue())
+        samples.append(encoded)
+    return samples
+
+
+def generate_dataset(dataset_dir, count, samples):
+    """Write a Qwen-layout dataset with `count` basenames, varied resolutions and captions"""
+    for sub in ('img', 'Control1', 'Control2', 'Control3'):
+        (dataset_dir / sub).mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        name = f"image_{i:06d}"
+        target, control = samples[i % len(samples)]
+        (dataset_dir / 'img' / f"{name}.png").write_bytes(target)
+        (dataset_dir / 'img' / f"{name}.txt").write_text(f"trigger, sample {i}, tag{i % 17}", encoding='utf-8')
+        (dataset_dir / 'Control1' / f"{name}.png").write_bytes(control)
+        if i % 2 == 0:
+            (dataset_dir / 'Control2' / f"{name}.png").write_bytes(control)
+        if i % 5 == 0:
+            (dataset_dir / 'Control3' / f"{name}.png").write_bytes(control)
+
+
+def generate_linked_dataset(linked_dir, primary_dir, count, samples):
+    """A second dataset sharing all but a few basenames, for compare-datasets"""
+    (linked_dir / 'img').mkdir(parents=True, exist_ok=True)
+    for sub in ('Control1', 'Control2', 'Control3'):
+        (linked_dir / sub).mkdir(exist_ok=True)
+    for i in range(LINKED_ORPHANS, count):
+        name = f"image_{i:06d}.png"
+        try:
+            os.link(primary_dir / 'img' / name, linked_dir / 'img' / name)
+        except OSError:
+            shutil.copy(primary_dir / 'img' / name, linked_dir / 'img' / name)
+    for i in range(LINKED_ORPHANS):
+        (linked_dir / 'img' / f"orphan_{i:06d}.png").write_bytes(samples[0][0])
+
+
+class Runner:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def measure(self, name, scale, items, fn, repeat=None, setup=None):
+        """Run fn `repeat` times and record latency percentiles, throughput and peak RSS"""
+        repeat = repeat or self.repeat
+        latencies = []
+        status = 'ok'
+        error = None
+        reset_peak_rss()
+        try:
+            for _ in range(repeat):
+                if setup:
+                    setup()
+                start = time.perf_counter()
+                fn()
+                latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            status = 'error'
+            error = f"{type(e).__name__}: {e}"
+
+        result = {
+            'name': name,
+            'scale': scale,
+            'status': status,
+            'repeat': len(latencies),
+            'items': items,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        if latencies:
+            result['latency_ms'] = {
+                'min': round(min(latencies) * 1000, 3),
+                'p50': round(percentile(latencies, 50) * 1000, 3),
+                'p90': round(percentile(latencies, 90) * 1000, 3),
+                'p99': round(percentile(latencies, 99) * 1000, 3),
+                'max': round(max(latencies) * 1000, 3),
+                'mean': round(statistics.mean(latencies) * 1000, 3),
+            }
+            result['throughput_per_s'] = round(items / statistics.median(latencies), 1)
+        if error:
+            result['error'] = error
+        self.results.append(result)
+
+        latency = result.get('latency_ms', {}).get('p50')
+        print(f"  {name:<28} n={scale:<7} p50={latency if latency is not None else '-':>10} ms  "
+              f"rss={result['peak_rss_mb']} MB  {status if status != 'ok' else ''}", file=sys.stderr, flush=True)
+
+    def skip(self, name, scale, reason):
+        self.results.append({'name': name, 'scale': scale, 'status': 'skipped', 'reason': reason})
+        print(f"  {name:<28} n={scale:<7} skipped: {reason}", file=sys.stderr, flush=True)
+
+
+def check(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return response
+
+
+def bench_endpoints(runner, client, dataset, linked, scale, export_dir, heavy_limit):
+    q = f"?folder={dataset}"
+
+    runner.measure('api_images', scale, scale, lambda: check(client.get(f'/api/images{q}')))
+    runner.measure('api_compare_datasets', scale, scale, lambda: check(client.post(
+        '/api/compare-datasets', json={'primaryFolder': dataset, 'linkedFolder': linked})))
+
+    filename = check(client.get(f'/api/images{q}')).get_json()['images'][0]
+    runner.measure('api_augment_crop', scale, 1, lambda: check(client.post('/api/augment/crop', json={
+        'folder': dataset, 'filename': filename, 'crop': {'x': 4, 'y': 4, 'w': 32, 'h': 32}})))
+
+    runner.measure('api_reshuffle', scale, scale, lambda: check(client.post(f'/api/reshuffle{q}')),
+                   repeat=min(runner.repeat, 3))
+
+    if scale > heavy_limit:
+        runner.skip('api_export', scale, f'scale above --heavy-limit {heavy_limit}')
+        runner.skip('api_compress', scale, f'scale above --heavy-limit {heavy_limit}')
+        return
+
+    def clear_export():
+        shutil.rmtree(export_dir, ignore_errors=True)
+
+    runner.measure('api_export', scale, scale, lambda: check(client.post(
+        f'/api/export{q}', json={'exportPath': str(export_dir)})), repeat=min(runner.repeat, 3), setup=clear_export)
+    clear_export()
+    runner.measure('api_compress', scale, scale, lambda: check(client.post(f'/api/compress{q}')), repeat=1)
+
+
+def load_nodes(output_dir):
+    """Import the ComfyUI node modules with a stubbed folder_paths; returns None if torch is missing"""
+    try:
+        import torch  # noqa: F401
+    except ImportError:
+        return None
+
+    stub = types.ModuleType('folder_paths')
+    stub.get_output_directory = lambda: str(output_dir)
+    sys.modules['folder_paths'] = stub
+
+    from comfyui_qwenDatasetManager.qwen_dataset_loader import QwenDatasetLoader
+    from comfyui_qwenDatasetManager.qwen_dataset_saver import QwenDatasetSaver
+    return QwenDatasetLoader, QwenDatasetSaver
+
+
+def bench_nodes(runner, nodes, output_dir, dataset_dir, scale, node_limit, saves):
+    if nodes is None:
+        runner.skip('node_loader_list', scale, 'torch not installed')
+        runner.skip('node_saver', scale, 'torch not installed')
+        return
+
+    import torch
+    loader_cls, saver_cls = nodes
+
+    if scale > node_limit:
+        runner.skip('node_loader_list', scale, f'scale above --node-limit {node_limit}')
+    else:
+        loader = loader_cls()
+        runner.measure('node_loader_list', scale, scale,
+                       lambda: loader.load_dataset(str(dataset_dir), 'List'), repeat=1)
+
+    # The saver scans the target folder for the next number, so save into a dataset of this scale
+    saver_dataset = f"bench_saver_{scale}"
+    saver_dir = Path(output_dir) / saver_dataset
+    if not saver_dir.exists():
+        shutil.copytree(dataset_dir, saver_dir, copy_function=os.link)
+    saver = saver_cls()
+    target = torch.rand(1, 128, 128, 3)
+    control = torch.rand(1, 128, 128, 3)
+    runner.measure('node_saver', scale, 1, lambda: saver.save_dataset(
+        target, saver_dataset, control1=control, caption='trigger, benchmark'), repeat=saves)
+    # Encoding runs in the background; include draining the queue as its own result
+    from comfyui_qwenDatasetManager.storage import encoder_pool
+    runner.measure('node_saver_drain', scale, saves, encoder_pool.join, repeat=1)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(current, baseline):
+    """Pair results by (name, scale) and report the p50 ratio against the baseline"""
+    previous = {(r['name'], r['scale']): r for r in baseline.get('results', [])}
+    comparison = []
+    for r in current['results']:
+        old = previous.get((r['name'], r['scale']))
+        if not old or 'latency_ms' not in r or 'latency_ms' not in old:
+            continue
+        ratio = r['latency_ms']['p50'] / old['latency_ms']['p50'] if old['latency_ms']['p50'] else None
+        comparison.append({
+            'name': r['name'],
+            'scale': r['scale'],
+            'baseline_p50_ms': old['latency_ms']['p50'],
+            'p50_ms': r['latency_ms']['p50'],
+            'ratio': round(ratio, 3) if ratio is not None else None,
+        })
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='1000,10000,100000',
+                        help='comma separated dataset sizes (basenames), default 1000,10000,100000')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions for fast operations')
+    parser.add_argument('--heavy-limit', type=int, default=10000,
+                        help='largest scale for export/compress (they touch every file)')
+    parser.add_argument('--node-limit', type=int, default=1000,
+                        help='largest scale for QwenDatasetLoader List mode (loads everything into memory)')
+    parser.add_argument('--saves', type=int, default=20, help='QwenDatasetSaver calls per scale')
+    parser.add_argument('--workdir', help='directory for generated data (default: a new temp dir, removed afterwards)')
+    parser.add_argument('--output', help='write JSON results to this file (default: stdout)')
+    parser.add_argument('--compare', help='baseline JSON from a previous run')
+    args = parser.parse_args()
+
+    scales = [int(s) for s in args.scales.split(',') if s.strip()]
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix='qdm-bench-'))
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    import app as app_module
+
+    # Point the app at the synthetic data; endpoints read these globals per request
+    datasets_dir = workdir / 'Datasets'
+    datasets_dir.mkdir(exist_ok=True)
+    app_module.DATASETS_DIR = datasets_dir
+    app_module.BASE_DIR = workdir
+    client = app_module.app.test_client()
+
+    output_dir = workdir / 'comfy_output'
+    output_dir.mkdir(exist_ok=True)
+    nodes = load_nodes(output_dir)
+
+    samples = encoded_samples()
+    runner = Runner(args.repeat)
+
+    # The nodes and the app print their own progress; keep stdout for the JSON report
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            for scale in scales:
+                dataset = f"bench_{scale}"
+                linked = f"bench_{scale}_linked"
+                dataset_dir = datasets_dir / dataset
+
+                print(f"Generating {scale} samples in {dataset_dir}", file=sys.stderr, flush=True)
+                start = time.perf_counter()
+                if not dataset_dir.exists():
+                    generate_dataset(dataset_dir, scale, samples)
+                    generate_linked_dataset(datasets_dir / linked, dataset_dir, scale, samples)
+                print(f"  generated in {time.perf_counter() - start:.1f}s", file=sys.stderr, flush=True)
+
+                bench_nodes(runner, nodes, output_dir, dataset_dir, scale, args.node_limit, args.saves)
+                bench_endpoints(runner, client, dataset, linked, scale,
+                                workdir / 'export', args.heavy_limit)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'scales': scales,
+            'repeat': args.repeat,
+        },
+        'results': runner.results,
+    }
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            report['comparison'] = compare_results(report, json.load(f))
+        print('\nComparison against', args.compare, file=sys.stderr)
+        for c in report['comparison']:
+            print(f"  {c['name']:<28} n={c['scale']:<7} {c['baseline_p50_ms']:>10} -> {c['p50_ms']:>10} ms "
+                  f"(x{c['ratio']})", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"\nResults written to {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
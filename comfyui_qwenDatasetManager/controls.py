@@ -0,0 +1,174 @@
+"""
+Derived control images (edges, grayscale, blur, ...) for a dataset's empty Control slots.
+
+Rendered with NumPy; generate_control_batch runs in the web app's process pool.
+"""
+
+import os
+
+from .storage import StoragePolicy
+
+# Derived control images for empty Control slots. Each kind has its default
+# parameters; images of the same size are stacked and processed as one batch.
+CONTROL_KINDS = {
+    'edges': {},                 # Sobel gradient magnitude of the luma
+    'grayscale': {},
+    'blur': {'radius': 8},       # two box-blur passes, close to a Gaussian
+    'downscale': {'factor': 4},  # area average, scaled back up to the source size
+    'mask': {},                  # alpha channel; sources without alpha are skipped
+}
+
+
+def control_variant(kind, params):
+    """Cache folder name of a kind with its parameters, e.g. blur-radius8"""
+    return '-'.join([kind] + [f"{key}{params[key]}" for key in sorted(params)])
+
+
+def control_cache_path(cache_dir, variant, digest, extension):
+    return os.path.join(cache_dir, variant, digest[:2], digest + extension)
+
+
+def _box_blur(stack, radius, axis):
+    """Mean over a 2*radius+1 window along axis, edges repeated"""
+    import numpy as np
+
+    pad = [(0, 0)] * stack.ndim
+    pad[axis] = (radius + 1, radius)
+    sums = np.cumsum(np.pad(stack, pad, mode='edge'), axis=axis, dtype=np.float32)
+    size = stack.shape[axis]
+    upper = np.take(sums, np.arange(2 * radius + 1, 2 * radius + 1 + size), axis=axis)
+    lower = np.take(sums, np.arange(size), axis=axis)
+    return (upper - lower) / (2 * radius + 1)
+
+
+def render_controls(kind, params, pixels, alpha=None):
+    """Control images for a batch: pixels (N, H, W, 3) float32 0-255, alpha (N, H, W) or None.
+
+    Returns uint8 (N, H, W) for single-channel kinds, (N, H, W, 3) otherwise.
+    """
+    import numpy as np
+
+    params = {**CONTROL_KINDS[kind], **(params or {})}
+    if kind == 'mask':
+        out = alpha
+    elif kind == 'grayscale':
+        out = pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    elif kind == 'edges':
+        luma = np.pad(pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32), ((0, 0), (1, 1), (1, 1)), mode='edge')
+        # Separable Sobel: smooth across, differentiate along each axis
+        rows = luma[:, :-2] + 2 * luma[:, 1:-1] + luma[:, 2:]
+        cols = luma[:, :, :-2] + 2 * luma[:, :, 1:-1] + luma[:, :, 2:]
+        gx = rows[:, :, 2:] - rows[:, :, :-2]
+        gy = cols[:, 2:] - cols[:, :-2]
+        magnitude = np.hypot(gx, gy)
+        # Normalize per image so faint and strong edges both use the full range
+        peak = np.percentile(magnitude.reshape(len(magnitude), -1), 99, axis=1).reshape(-1, 1, 1)
+        out = magnitude * (255.0 / np.maximum(peak, 1e-3))
+    elif kind == 'blur':
+        radius = max(1, int(params['radius']))
+        out = pixels
+        for _ in range(2):
+            out = _box_blur(_box_blur(out, radius, 1), radius, 2)
+    elif kind == 'downscale':
+        factor = max(1, int(params['factor']))
+        n, h, w, c = pixels.shape
+        pad_h, pad_w = -h % factor, -w % factor
+        padded = np.pad(pixels, ((0, 0), (0, pad_h), (0, pad_w), (0, 0)), mode='edge')
+        small = padded.reshape(n, (h + pad_h) // factor, factor, (w + pad_w) // factor, factor, c).mean(axis=(2, 4))
+        out = small.repeat(factor, axis=1).repeat(factor, axis=2)[:, :h, :w]
+    else:
+        raise ValueError(f"Unknown control kind: {kind}")
+    return np.clip(out + 0.5, 0, 255).astype(np.uint8)
+
+
+def is_blank_image(path, max_side=256):
+    """True for all-black images, such as the placeholder controls written by the saver node"""
+    from PIL import Image
+
+    with Image.open(path) as img:
+        img.draft('RGB', (max_side, max_side))
+        return all(high == 0 for _, high in img.convert('RGB').getextrema())
+
+
+def generate_control_batch(tasks, cache_dir, policy_settings, extension):
+    """Process-pool worker: generate the requested controls of a few samples.
+
+    tasks: [{'source': img path, 'outputs': [[kind, params, existing], ...]}].
+    existing is the path of a control to replace only if it is all black, or
+    None. Each source is read once for both its sha1 and its decode; controls
+    already in the cache (by source hash) are not generated again. Returns per
+    task {'source', 'hash', 'outputs': {variant: 'generated'|'cached'|'kept'|'unsupported'|error},
+    'bytesRead', 'bytesWritten'}.
+    """
+    import hashlib
+    import io
+    import numpy as np
+    from PIL import Image
+
+    policy = StoragePolicy(policy_settings)
+    results = []
+    decoded = []  # (result, pixels, alpha, missing [(kind, params, variant)])
+    for task in tasks:
+        result = {'source': task['source'], 'hash': None, 'outputs': {}, 'bytesRead': 0, 'bytesWritten': 0}
+        results.append(result)
+        try:
+            outputs = []
+            for kind, params, existing in task['outputs']:
+                if existing and not is_blank_image(existing):
+                    result['outputs'][control_variant(kind, params)] = 'kept'
+                else:
+                    outputs.append((kind, params))
+            if not outputs:
+                continue
+            with open(task['source'], 'rb') as f:
+                data = f.read()
+            result['bytesRead'] = len(data)
+            result['hash'] = hashlib.sha1(data).hexdigest()
+            missing = []
+            for kind, params in outputs:
+                variant = control_variant(kind, params)
+                if os.path.exists(control_cache_path(cache_dir, variant, result['hash'], extension)):
+                    result['outputs'][variant] = 'cached'
+                else:
+                    missing.append((kind, params, variant))
+            if not missing:
+                continue
+            with Image.open(io.BytesIO(data)) as img:
+                alpha = None
+                if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+                    img = img.convert('RGBA')
+                    alpha = np.asarray(img.getchannel('A'), dtype=np.float32)
+                pixels = np.asarray(img.convert('RGB'), dtype=np.float32)
+            decoded.append((result, pixels, alpha, missing))
+        except Exception as e:
+            for kind, params, _ in task['outputs']:
+                result['outputs'].setdefault(control_variant(kind, params), str(e))
+
+    # Group by (variant, image size) so each group is one stacked array
+    groups = {}
+    for item in decoded:
+        result, pixels, alpha, missing = item
+        for kind, params, variant in missing:
+            if kind == 'mask' and alpha is None:
+                result['outputs'][variant] = 'unsupported'
+                continue
+            groups.setdefault((variant, pixels.shape), (kind, params, []))[2].append(item)
+
+    for (variant, _), (kind, params, items) in groups.items():
+        try:
+            alphas = np.stack([alpha for _, _, alpha, _ in items]) if kind == 'mask' else None
+            rendered = render_controls(kind, params, np.stack([pixels for _, pixels, _, _ in items]), alphas)
+        except Exception as e:
+            for result, _, _, _ in items:
+                result['outputs'][variant] = str(e)
+            continue
+        for (result, _, _, _), array in zip(items, rendered):
+            path = control_cache_path(cache_dir, variant, result['hash'], extension)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                policy.write(Image.fromarray(array), path, resize=False)
+                result['bytesWritten'] += os.path.getsize(path)
+                result['outputs'][variant] = 'generated'
+            except Exception as e:
+                result['outputs'][variant] = str(e)
+    return results
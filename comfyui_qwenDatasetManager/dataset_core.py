@@ -0,0 +1,250 @@
+"""
+Qwen dataset layout, shared by the web app and the ComfyUI nodes.
+
+A dataset folder keeps target images and their .txt captions in img/, and the
+matching control images in Control1-3/. Files belong to the same sample when
+they share a basename; the extension may differ between folders.
+"""
+
+import itertools
+import os
+import random
+import re
+import string
+import uuid
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+CAPTION_EXTENSION = '.txt'
+IMG_FOLDER = 'img'
+CONTROL_FOLDERS = ('Control1', 'Control2', 'Control3')
+LAYOUT_FOLDERS = (IMG_FOLDER,) + CONTROL_FOLDERS
+
+# Hidden per-dataset folder for manager metadata (undo snapshots, caches, ...)
+META_DIRNAME = '.qdm'
+
+# image_00001.png, or another image extension when a storage policy converts it
+NUMBERED_NAME = re.compile(r'image_(\d+)\.(?:png|jpe?g|webp)$', re.IGNORECASE)
+
+
+def is_image_name(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def atomic_write_text(path, text):
+    """Write text through a temp file + rename so readers never see a half-written file"""
+    path = os.fspath(path)
+    tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(tmp, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class Sample:
+    """One img file and the names needed to find its caption and controls"""
+
+    __slots__ = ('dataset', 'basename', 'filename')
+
+    def __init__(self, dataset, filename):
+        self.dataset = dataset
+        self.filename = filename
+        self.basename = os.path.splitext(filename)[0]
+
+    def __repr__(self):
+        return f"Sample({self.filename!r})"
+
+    @property
+    def img_path(self):
+        return os.path.join(self.dataset.path, IMG_FOLDER, self.filename)
+
+    def control_path(self, folder):
+        """Path of the control image in folder (any extension), or None"""
+        return self.dataset.find_file(folder, self.filename)
+
+    @property
+    def caption_path(self):
+        """Path of the caption file, or None when the sample has no caption"""
+        return self.dataset.caption_path(self.basename)
+
+    def read_caption(self):
+        path = self.caption_path
+        if path is None:
+            return ''
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+
+class Dataset:
+    """A dataset folder.
+
+    Each layout folder is listed with a single os.scandir() the first time it is
+    needed and kept as {basename: filename}. Single-file lookups on a folder that
+    has not been listed probe the known extensions instead of scanning it. Call
+    refresh() after modifying the folder.
+    """
+
+    def __init__(self, path, on_scan=None):
+        self.path = os.fspath(path)
+        self.on_scan = on_scan  # called with the number of directory entries read
+        self._images = {}    # folder -> {basename: filename}
+        self._variants = {}  # folder -> {basename: [every image filename with it]}
+        self._captions = None  # {basename: filename} of img/*.txt
+
+    def __repr__(self):
+        return f"Dataset({self.path!r})"
+
+    def folder_path(self, folder):
+        return os.path.join(self.path, folder)
+
+    def exists(self):
+        return os.path.isdir(self.folder_path(IMG_FOLDER))
+
+    def refresh(self):
+        self._images = {}
+        self._variants = {}
+        self._captions = None
+
+    def _scan(self, folder):
+        images = {}
+        variants = {}
+        captions = {}
+        count = 0
+        try:
+            with os.scandir(self.folder_path(folder)) as it:
+                for entry in it:
+                    count += 1
+                    name = entry.name
+                    if name.startswith('.'):
+                        continue
+                    stem, ext = os.path.splitext(name)
+                    ext = ext.lower()
+                    if ext in IMAGE_EXTENSIONS:
+                        variants.setdefault(stem, []).append(name)
+                        # Keep the first one in extension order if a basename repeats
+                        previous = images.get(stem)
+                        if previous is None or IMAGE_EXTENSIONS.index(ext) < IMAGE_EXTENSIONS.index(os.path.splitext(previous)[1].lower()):
+                            images[stem] = name
+                    elif ext == CAPTION_EXTENSION and folder == IMG_FOLDER:
+                        captions[stem] = name
+        except FileNotFoundError:
+            pass
+        if self.on_scan is not None:
+            self.on_scan(count)
+        self._images[folder] = images
+        self._variants[folder] = variants
+        if folder == IMG_FOLDER:
+            self._captions = captions
+
+    def files(self, folder):
+        """{basename: filename} of the images in folder"""
+        if folder not in self._images:
+            self._scan(folder)
+        return self._images[folder]
+
+    def captions(self):
+        """{basename: filename} of the captions in img/"""
+        if self._captions is None:
+            self._scan(IMG_FOLDER)
+        return self._captions
+
+    def scan(self):
+        """List every layout folder up front, so later lookups never touch the disk"""
+        for folder in LAYOUT_FOLDERS:
+            self.files(folder)
+        return self
+
+    def file_names(self, folder):
+        """Sorted image filenames in folder, including every extension of a repeated basename"""
+        if folder not in self._variants:
+            self._scan(folder)
+        return sorted(name for names in self._variants[folder].values() for name in names)
+
+    def image_names(self):
+        """Sorted img filenames, including every extension of a repeated basename"""
+        return self.file_names(IMG_FOLDER)
+
+    def samples(self):
+        """All samples, one per basename (the preferred extension), sorted by img filename"""
+        return [Sample(self, name) for name in sorted(self.files(IMG_FOLDER).values())]
+
+    def sample(self, name):
+        """Sample by exact img filename, else by basename; None if missing"""
+        path = self.find_file(IMG_FOLDER, name)
+        return Sample(self, os.path.basename(path)) if path else None
+
+    def find_file(self, folder, name):
+        """Path of the image in folder with name's basename (exact name first), or None"""
+        directory = self.folder_path(folder)
+        stem = os.path.splitext(name)[0]
+        listed = self._images.get(folder)
+        if listed is not None:
+            if name in self._variants[folder].get(stem, ()):
+                return os.path.join(directory, name)
+            found = listed.get(stem)
+            return os.path.join(directory, found) if found else None
+
+        if is_image_name(name) and os.path.isfile(os.path.join(directory, name)):
+            return os.path.join(directory, name)
+        for ext in IMAGE_EXTENSIONS:
+            path = os.path.join(directory, stem + ext)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def find_all(self, folder, name):
+        """Paths of every image in folder with name's basename, whatever the extension"""
+        directory = self.folder_path(folder)
+        stem = os.path.splitext(name)[0]
+        if folder in self._variants:
+            return [os.path.join(directory, found) for found in self._variants[folder].get(stem, ())]
+        return [os.path.join(directory, stem + ext) for ext in IMAGE_EXTENSIONS
+                if os.path.isfile(os.path.join(directory, stem + ext))]
+
+    def caption_path(self, name):
+        """Path of the caption for name (filename or basename), or None"""
+        stem = os.path.splitext(name)[0] if is_image_name(name) else name
+        if self._captions is not None:
+            return os.path.join(self.folder_path(IMG_FOLDER), self._captions[stem]) if stem in self._captions else None
+        path = os.path.join(self.folder_path(IMG_FOLDER), stem + CAPTION_EXTENSION)
+        return path if os.path.isfile(path) else None
+
+    def sample_files(self, name):
+        """[(folder, path)] of every file that belongs to the sample: images in all
+        layout folders (any extension) and the caption"""
+        files = []
+        for folder in LAYOUT_FOLDERS:
+            files.extend((folder, path) for path in self.find_all(folder, name))
+        caption = self.caption_path(os.path.splitext(name)[0])
+        if caption:
+            files.append((IMG_FOLDER, caption))
+        return files
+
+    def ensure_layout(self):
+        for folder in LAYOUT_FOLDERS:
+            os.makedirs(self.folder_path(folder), exist_ok=True)
+
+    def next_filename(self, reserved=()):
+        """Next free name in the image_00001.png numbering used by the saver node.
+
+        reserved: names that are taken but not on disk yet (queued writes).
+        """
+        max_num = 0
+        for name in itertools.chain(self.files(IMG_FOLDER).values(), reserved):
+            match = NUMBERED_NAME.match(name)
+            if match:
+                max_num = max(max_num, int(match.group(1)))
+        return f"image_{max_num + 1:05d}.png"
+
+    def unique_basename(self, length=8):
+        """Random basename that no img file uses yet"""
+        used = self.files(IMG_FOLDER)
+        captions = self.captions()
+        chars = string.ascii_lowercase + string.digits
+        while True:
+            name = ''.join(random.choices(chars, k=length))
+            if name not in used and name not in captions:
+                return name
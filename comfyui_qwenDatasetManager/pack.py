@@ -0,0 +1,259 @@
+"""
+Packed dataset storage, an alternative to loose files for large datasets.
+
+Used by the web app (serving, pack/unpack endpoints), pack.py and the loader node.
+"""
+
+import json
+import mmap
+import os
+import uuid
+
+from .dataset_core import CONTROL_FOLDERS, IMG_FOLDER, Dataset
+
+# Packed format: one append-only data file per dataset holding the raw bytes of every
+# sample's img, controls and caption back to back, plus a JSON-lines index of offsets.
+# A later index record for the same basename replaces the earlier one, so updating a
+# pack only appends. Files are stored as-is (no re-encoding), so slices of the data
+# file can be served directly.
+PACK_DATA = 'dataset.qdmpack'
+PACK_INDEX = 'dataset.qdmpack.idx'
+PACK_MAGIC = b'QDMPACK1'
+CAPTION_PART = 'caption'
+
+
+def has_pack(path):
+    return os.path.isfile(os.path.join(os.fspath(path), PACK_INDEX))
+
+
+class PackRecord:
+    """Index entry of one packed sample: {part: (filename, offset, length)}"""
+
+    __slots__ = ('basename', 'parts')
+
+    def __init__(self, basename, parts):
+        self.basename = basename
+        self.parts = parts
+
+    def __repr__(self):
+        return f"PackRecord({self.basename!r})"
+
+    @property
+    def filename(self):
+        return self.parts[IMG_FOLDER][0]
+
+
+class PackReader:
+    """Random access to a packed dataset through a read-only mmap of the data file.
+
+    refresh() picks up records appended since the last call: only the new part of
+    the index is parsed and the mapping is renewed when the data file grew. Views
+    handed out earlier keep their old mapping alive until they are released.
+    """
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self.data_path = os.path.join(self.path, PACK_DATA)
+        self.index_path = os.path.join(self.path, PACK_INDEX)
+        self.records = {}  # basename -> PackRecord
+        self.index_offset = 0
+        self.mmap = None
+        self.data_size = 0
+        self.identity = None  # (st_dev, st_ino) of the data file
+        self.refresh()
+
+    def close(self):
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass  # still exported through a view, released with it
+            self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def version(self):
+        """Changes whenever something is appended to the pack"""
+        return f"{self.data_size:x}-{self.index_offset:x}"
+
+    def refresh(self):
+        stat = os.stat(self.data_path)
+        size = stat.st_size
+        identity = (stat.st_dev, stat.st_ino)
+        if identity != self.identity or size < self.data_size or os.path.getsize(self.index_path) < self.index_offset:
+            # New or rebuilt pack: start over
+            self.records = {}
+            self.index_offset = 0
+            self.mmap = None
+            self.identity = identity
+        if size != self.data_size or self.mmap is None:
+            with open(self.data_path, 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if mapping[:len(PACK_MAGIC)] != PACK_MAGIC:
+                mapping.close()
+                raise ValueError(f"Not a dataset pack: {self.data_path}")
+            self.mmap = mapping
+            self.data_size = size
+
+        with open(self.index_path, 'rb') as f:
+            f.seek(self.index_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # record still being written
+                self.index_offset += len(line)
+                self._apply(json.loads(line))
+
+    def _apply(self, entry):
+        basename = entry['name']
+        if entry.get('deleted'):
+            self.records.pop(basename, None)
+            return
+        parts = {part: tuple(value) for part, value in entry['parts'].items()}
+        if any(offset + length > self.data_size for _, offset, length in parts.values()):
+            return  # index written ahead of a data file that was cut short
+        self.records[basename] = PackRecord(basename, parts)
+
+    def image_names(self):
+        return sorted(record.filename for record in self.records.values())
+
+    def get(self, name):
+        """Record by img filename or basename, or None"""
+        record = self.records.get(name)
+        if record is None and '.' in name:
+            record = self.records.get(os.path.splitext(name)[0])
+        return record
+
+    def view(self, record, part):
+        """Zero-copy memoryview of a stored file, or None if the record lacks it"""
+        entry = record.parts.get(part)
+        if entry is None:
+            return None
+        _, offset, length = entry
+        return memoryview(self.mmap)[offset:offset + length]
+
+    def read_caption(self, record):
+        view = self.view(record, CAPTION_PART)
+        return bytes(view).decode('utf-8') if view is not None else ''
+
+
+class PackWriter:
+    """Appends sample records to a dataset pack (created on first use)"""
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        data_path = os.path.join(self.path, PACK_DATA)
+        new = not os.path.exists(data_path) or os.path.getsize(data_path) == 0
+        self.data_file = open(data_path, 'ab')
+        if new:
+            self.data_file.write(PACK_MAGIC)
+        self.index_file = open(os.path.join(self.path, PACK_INDEX), 'ab')
+
+    def close(self):
+        self.data_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, basename, files):
+        """Append one sample; files is {part: (filename, bytes)} with part img/ControlN/caption"""
+        parts = {}
+        for part, (filename, data) in files.items():
+            offset = self.data_file.tell()
+            self.data_file.write(data)
+            parts[part] = [filename, offset, len(data)]
+        # Data must be on disk before the index points at it
+        self.data_file.flush()
+        self._write_index({'name': basename, 'parts': parts})
+
+    def delete(self, basename):
+        self._write_index({'name': basename, 'deleted': True})
+
+    def _write_index(self, entry):
+        self.index_file.write((json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8'))
+        self.index_file.flush()
+
+
+def _is_packed(record, paths):
+    """Whether record already holds these files (same names and sizes)"""
+    if record is None or record.parts.keys() != paths.keys():
+        return False
+    return all(record.parts[part][0] == os.path.basename(path) and record.parts[part][2] == os.path.getsize(path)
+               for part, path in paths.items())
+
+
+def pack_dataset(path, remove_files=False, rebuild=False):
+    """Pack the loose files of a dataset. Returns the number of samples written.
+
+    Samples already packed with the same file sizes are skipped, so packing again
+    only appends new or edited samples. remove_files deletes the loose files once
+    they are packed; rebuild starts a fresh pack.
+    """
+    dataset = Dataset(path).scan()
+    if rebuild:
+        for name in (PACK_DATA, PACK_INDEX):
+            target = os.path.join(dataset.path, name)
+            if os.path.exists(target):
+                os.remove(target)
+    existing = {}
+    if has_pack(dataset.path):
+        with PackReader(dataset.path) as pack:
+            existing = pack.records
+
+    written = 0
+    with PackWriter(dataset.path) as writer:
+        for sample in dataset.samples():
+            paths = {IMG_FOLDER: sample.img_path}
+            for folder in CONTROL_FOLDERS:
+                control = sample.control_path(folder)
+                if control:
+                    paths[folder] = control
+            caption = sample.caption_path
+            if caption:
+                paths[CAPTION_PART] = caption
+
+            if not _is_packed(existing.get(sample.basename), paths):
+                files = {}
+                for part, file_path in paths.items():
+                    with open(file_path, 'rb') as f:
+                        files[part] = (os.path.basename(file_path), f.read())
+                writer.add(sample.basename, files)
+                written += 1
+
+            if remove_files:
+                for file_path in paths.values():
+                    os.remove(file_path)
+    return written
+
+
+def unpack_dataset(path, overwrite=False):
+    """Write every packed sample back to img/Control1-3. Returns the number of files written."""
+    dataset = Dataset(path)
+    dataset.ensure_layout()
+    written = 0
+    with PackReader(dataset.path) as pack:
+        for record in pack.records.values():
+            for part, (filename, _, _) in record.parts.items():
+                folder = IMG_FOLDER if part == CAPTION_PART else part
+                target = os.path.join(dataset.folder_path(folder), filename)
+                if os.path.exists(target) and not overwrite:
+                    continue
+                tmp = os.path.join(os.path.dirname(target), f".{filename}.{uuid.uuid4().hex[:8]}.tmp")
+                try:
+                    with open(tmp, 'wb') as f:
+                        f.write(pack.view(record, part))
+                    os.replace(tmp, target)
+                except BaseException:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+                written += 1
+    return written
@@ -0,0 +1,74 @@
+"""
+Cheap per-image quality metrics, scored in batches by the web app's process pool.
+"""
+
+import os
+
+# Image quality metrics, computed on downscaled grayscale decodes:
+#   sharpness   variance of the Laplacian (low = blurry)
+#   brightness  mean luma, 0-255
+#   contrast    standard deviation of the luma
+#   dark/bright fraction of pixels at most 8 / at least 247
+#   entropy     of the luma histogram in bits, 0-8 (low = nearly constant)
+QUALITY_METRICS = ('sharpness', 'brightness', 'contrast', 'dark', 'bright', 'entropy')
+
+
+def quality_metrics(stack):
+    """{metric: float32 (N,)} for a batch of luma images, uint8 (N, H, W)"""
+    import numpy as np
+
+    n = len(stack)
+    luma = stack.astype(np.float32)
+    laplacian = (luma[:, 1:-1, :-2] + luma[:, 1:-1, 2:] + luma[:, :-2, 1:-1] + luma[:, 2:, 1:-1]
+                 - 4 * luma[:, 1:-1, 1:-1])
+    # One bincount for the whole batch: image i's values are offset by i * 256
+    offsets = (np.arange(n, dtype=np.int64) * 256).reshape(-1, 1, 1)
+    histograms = np.bincount((stack + offsets).ravel(), minlength=n * 256).reshape(n, 256)
+    p = histograms / histograms.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = 0.0 - np.where(p > 0, p * np.log2(p), 0).sum(axis=1)
+    flat = luma.reshape(n, -1)
+    return {
+        'sharpness': laplacian.reshape(n, -1).var(axis=1) if laplacian.size else np.zeros(n),
+        'brightness': flat.mean(axis=1),
+        'contrast': flat.std(axis=1),
+        'dark': p[:, :9].sum(axis=1),
+        'bright': p[:, 247:].sum(axis=1),
+        'entropy': entropy,
+    }
+
+
+def score_image_batch(paths, max_side=256):
+    """Process-pool worker: quality metrics of a few images.
+
+    Images are decoded at reduced size (JPEG draft mode, then a box
+    downscale) so the longest side is at most max_side. Returns per path
+    {metric: value} or {'error': message}, plus the bytes read.
+    """
+    import numpy as np
+    from PIL import Image
+
+    results = [None] * len(paths)
+    bytes_read = 0
+    groups = {}  # downscaled size -> [(index, luma array)]
+    for i, path in enumerate(paths):
+        try:
+            bytes_read += os.path.getsize(path)
+            with Image.open(path) as img:
+                img.draft('L', (max_side, max_side))
+                if 'A' in img.mode or (img.mode == 'P' and 'transparency' in img.info):
+                    # Judge what is visible: transparent areas count as black
+                    img = img.convert('RGBA')
+                    img = Image.alpha_composite(Image.new('RGBA', img.size, (0, 0, 0, 255)), img)
+                img = img.convert('L')
+                img.thumbnail((max_side, max_side), Image.Resampling.BOX)
+                array = np.asarray(img, dtype=np.uint8)
+            groups.setdefault(array.shape, []).append((i, array))
+        except Exception as e:
+            results[i] = {'error': str(e)}
+
+    for items in groups.values():
+        metrics = quality_metrics(np.stack([array for _, array in items]))
+        for row, (i, _) in enumerate(items):
+            results[i] = {name: round(float(values[row]), 4) for name, values in metrics.items()}
+    return results, bytes_read
@@ -1,14 +1,20 @@
+import io
 import os
+import time
 import torch
 import numpy as np
 from PIL import Image, ImageOps
 
 import folder_paths
 
+from .dataset_core import CONTROL_FOLDERS, IMG_FOLDER, Dataset
+from .pack import PackReader, has_pack
+
 class QwenDatasetLoader:
     """
     ComfyUI node for loading Qwen dataset images and captions.
     Supports Manual (single image) and List (all images) modes.
+    Reads loose files or the dataset's pack (dataset.qdmpack), see source.
     """
     
     def __init__(self):
@@ -21,6 +27,10 @@ class QwenDatasetLoader:
                 "dataset_path": ("STRING", {"default": "", "multiline": False}),
                 "mode": (["Manual", "List"],),
                 "manual_filename": ("STRING", {"default": "image_00001.png"}),
+            },
+            "optional": {
+                # Auto: loose files when img/ has any, otherwise the pack
+                "source": (["Auto", "Files", "Pack"],),
             }
         }
     
@@ -42,8 +52,18 @@ class QwenDatasetLoader:
         """Create a black tensor of specified size (W, H)"""
         img = Image.new('RGB', size, (0, 0, 0))
         return self.pil_to_tensor(img)
+    
+    def open_rgb(self, source):
+        """Open an image from a path or packed bytes, upright and in RGB"""
+        if not isinstance(source, (str, os.PathLike)):
+            source = io.BytesIO(source)
+        pil_img = ImageOps.exif_transpose(Image.open(source))
+        if pil_img.mode != 'RGB':
+            pil_img = pil_img.convert('RGB')
+        return pil_img
         
-    def load_dataset(self, dataset_path, mode, manual_filename="image_00001.png"):
+    def load_dataset(self, dataset_path, mode, manual_filename="image_00001.png", source="Auto"):
+        start_time = time.perf_counter()
         dataset_path = dataset_path.strip()
         
         # 1. Try absolute path
@@ -55,44 +75,36 @@ class QwenDatasetLoader:
             else:
                  raise ValueError(f"Dataset path not found: '{dataset_path}' (checked absolute and relative to output)")
             
-        img_dir = os.path.join(dataset_path, "img")
-        control1_dir = os.path.join(dataset_path, "Control1")
-        control2_dir = os.path.join(dataset_path, "Control2")
-        control3_dir = os.path.join(dataset_path, "Control3")
+        dataset = Dataset(dataset_path)
+        img_dir = dataset.folder_path(IMG_FOLDER)
         
-        if not os.path.exists(img_dir):
+        if source == "Auto":
+            source = "Pack" if has_pack(dataset_path) and not dataset.image_names() else "Files"
+        pack = PackReader(dataset_path) if source == "Pack" else None
+        
+        if pack is None and not dataset.exists():
              raise ValueError(f"'img' folder not found at: {img_dir}")
              
-        # collect all image files in img_dir
-        all_files = []
-        for f in os.listdir(img_dir):
-            if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-                all_files.append(f)
-        
-        all_files.sort()
+        # collect all image files in img_dir (or the pack)
+        all_files = pack.image_names() if pack is not None else dataset.image_names()
         
         if not all_files:
-            raise ValueError(f"No images found in {img_dir}")
-        
-        files_to_process = []
+            raise ValueError(f"No images found in {img_dir if pack is None else pack.data_path}")
         
         if mode == "Manual":
             manual_filename = manual_filename.strip()
-            if manual_filename in all_files:
-                files_to_process = [manual_filename]
-            else:
-                 # Try finding it without extension if user didn't provide it
-                 found = False
-                 for f in all_files:
-                     if os.path.splitext(f)[0] == os.path.splitext(manual_filename)[0]:
-                         files_to_process = [f]
-                         found = True
-                         break
-                 if not found:
-                     print(f"Available files: {all_files[:5]}...") # Debug info
-                     raise ValueError(f"Filename '{manual_filename}' not found in dataset. Ensure exact match.")
+            # Exact match, or the same basename with any extension
+            sample = pack.get(manual_filename) if pack is not None else dataset.sample(manual_filename)
+            if sample is None:
+                print(f"Available files: {all_files[:5]}...") # Debug info
+                raise ValueError(f"Filename '{manual_filename}' not found in dataset. Ensure exact match.")
+            samples = [sample]
+        elif pack is not None:
+            samples = sorted(pack.records.values(), key=lambda record: record.filename)
         else: # List mode
-            files_to_process = all_files
+            # One listing per folder, so the per-sample lookups below never hit the disk
+            dataset.scan()
+            samples = dataset.samples()
             
         images_list = []
         c1_list = []
@@ -100,62 +112,55 @@ class QwenDatasetLoader:
         c3_list = []
         captions_list = []
         
-        print(f"Processing {len(files_to_process)} files from {dataset_path}")
+        print(f"Processing {len(samples)} files from {dataset_path}" + (" (pack)" if pack is not None else ""))
         
-        for filename in files_to_process:
+        for sample in samples:
             # Load Target Image
-            img_path = os.path.join(img_dir, filename)
             try:
-                pil_img = Image.open(img_path)
                 # Ensure RGB
-                pil_img = ImageOps.exif_transpose(pil_img)
-                if pil_img.mode != 'RGB':
-                    pil_img = pil_img.convert('RGB')
+                pil_img = self.open_rgb(pack.view(sample, IMG_FOLDER) if pack is not None else sample.img_path)
                 
                 target_tensor = self.pil_to_tensor(pil_img)
                 target_size = pil_img.size # (W, H)
                 
             except Exception as e:
-                print(f"Error loading image {filename}: {e}")
+                print(f"Error loading image {sample.filename}: {e}")
                 continue # Skip this file if target fails
                 
             images_list.append(target_tensor)
             
             # Load Caption
-            basename = os.path.splitext(filename)[0]
-            caption_path = os.path.join(img_dir, f"{basename}.txt")
             caption_text = ""
-            if os.path.exists(caption_path):
-                try:
-                    with open(caption_path, 'r', encoding='utf-8') as f:
-                        caption_text = f.read().strip()
-                except:
-                    pass
+            try:
+                caption_text = (pack.read_caption(sample) if pack is not None else sample.read_caption()).strip()
+            except:
+                pass
             captions_list.append(caption_text)
             
             # Helper to load control or black
-            def load_control(ctrl_dir):
-                c_path = os.path.join(ctrl_dir, filename)
-                if os.path.exists(c_path):
+            def load_control(ctrl_folder):
+                c_source = pack.view(sample, ctrl_folder) if pack is not None else sample.control_path(ctrl_folder)
+                if c_source:
                     try:
-                        c_img = Image.open(c_path)
-                        c_img = ImageOps.exif_transpose(c_img)
-                        if c_img.mode != 'RGB':
-                            c_img = c_img.convert('RGB')
-                        return self.pil_to_tensor(c_img)
+                        return self.pil_to_tensor(self.open_rgb(c_source))
                     except:
                          return self.create_black_image(target_size)
                 else:
                     return self.create_black_image(target_size)
 
-            c1_list.append(load_control(control1_dir))
-            c2_list.append(load_control(control2_dir))
-            c3_list.append(load_control(control3_dir))
+            c1_list.append(load_control(CONTROL_FOLDERS[0]))
+            c2_list.append(load_control(CONTROL_FOLDERS[1]))
+            c3_list.append(load_control(CONTROL_FOLDERS[2]))
+        
+        if pack is not None:
+            pack.close()
             
         if not images_list:
             raise ValueError(f"Failed to load any images from the selection.")
             
-        print(f"QwenDatasetLoader: Successfully loaded {len(images_list)} items.")
+        elapsed = time.perf_counter() - start_time
+        print(f"QwenDatasetLoader: Successfully loaded {len(images_list)} items in {elapsed:.2f}s "
+              f"({len(images_list) / elapsed:.1f} items/s).")
         
         return (images_list, c1_list, c2_list, c3_list, captions_list)
 
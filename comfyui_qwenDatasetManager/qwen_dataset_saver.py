@@ -1,15 +1,108 @@
+import http.client
+import io
+import json
 import os
-import re
+import threading
+import time
+import urllib.parse
+import uuid
 import torch
 import numpy as np
 from PIL import Image
 import folder_paths
 
+from .dataset_core import CONTROL_FOLDERS, IMG_FOLDER, Dataset, atomic_write_text
+from .storage import StoragePolicy, encoder_pool
+
+
+class IngestClient:
+    """Posts samples to a Dataset Manager's /api/ingest.
+
+    Keeps one persistent HTTP connection per thread (the encoder pool's
+    workers), reconnecting when the server closes it. Retries reuse the same
+    idempotency key, so a sample is never added twice.
+    """
+
+    RETRIES = 3
+
+    def __init__(self, server_url, timeout=120):
+        url = urllib.parse.urlsplit(server_url if '://' in server_url else f"http://{server_url}")
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.base_path = url.path.rstrip('/')
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connection_class(self.netloc, timeout=self.timeout)
+        return conn
+
+    def post_sample(self, dataset_name, files, caption=""):
+        """files: [(part, filename, bytes)] with part img/Control1-3. Returns the server's sample info."""
+        boundary = uuid.uuid4().hex
+        body = io.BytesIO()
+        for part, filename, data in files:
+            body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{part}"; filename="{filename}"\r\n'
+                       f'Content-Type: application/octet-stream\r\n\r\n'.encode('utf-8'))
+            body.write(data)
+            body.write(b'\r\n')
+        if caption:
+            body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="caption"\r\n\r\n'.encode('utf-8'))
+            body.write(caption.encode('utf-8') + b'\r\n')
+        body.write(f'--{boundary}--\r\n'.encode('utf-8'))
+        body = body.getvalue()
+
+        path = f"{self.base_path}/api/ingest?folder={urllib.parse.quote(dataset_name)}&create=1"
+        headers = {
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+            'Content-Length': str(len(body)),
+            'X-Idempotency-Key': uuid.uuid4().hex,
+        }
+        for attempt in range(self.RETRIES):
+            conn = self.connection()
+            try:
+                conn.request('POST', path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                self.local.conn = None
+                if attempt == self.RETRIES - 1:
+                    raise
+                time.sleep(2 ** attempt)
+                continue
+            try:
+                result = json.loads(data or b'{}')
+            except ValueError:
+                result = {}
+            # 409: the first attempt is still being processed. A partial failure is final,
+            # the server answers every retry with it.
+            retry = response.status == 409 or (response.status >= 500 and not result.get('partial'))
+            if retry and attempt < self.RETRIES - 1:
+                time.sleep(2 ** attempt)
+                continue
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}: {result.get('error', data[:200])}")
+            return result['samples'][0]
+
+
+ingest_clients = {}  # server URL -> IngestClient
+ingest_clients_lock = threading.Lock()
+
+def get_ingest_client(server_url):
+    with ingest_clients_lock:
+        if server_url not in ingest_clients:
+            ingest_clients[server_url] = IngestClient(server_url)
+        return ingest_clients[server_url]
+
 
 class QwenDatasetSaver:
     """
     ComfyUI node for saving images in Qwen dataset format.
-    Saves target image and optional control images with automatic numbering.
+    Saves target image and optional control images with automatic numbering,
+    encoded per the dataset's storage policy in background threads.
     """
     
     def __init__(self):
@@ -27,6 +120,8 @@ class QwenDatasetSaver:
                 "control2": ("IMAGE",),
                 "control3": ("IMAGE",),
                 "caption": ("STRING", {"multiline": True, "default": ""}),
+                # e.g. http://192.168.1.10:5001 - push to a Dataset Manager instead of the output folder
+                "server_url": ("STRING", {"default": ""}),
             }
         }
     
@@ -51,52 +146,38 @@ class QwenDatasetSaver:
         """Create a black image of specified size"""
         return Image.new('RGB', size, (0, 0, 0))
     
-    def get_next_filename(self, directory):
-        """Find the next available filename in format image_XXXXX.png"""
-        if not os.path.exists(directory):
-            return "image_00001.png"
-        
-        # Find all image files
-        pattern = re.compile(r'image_(\d+)\.png')
-        max_num = 0
-        
-        for filename in os.listdir(directory):
-            match = pattern.match(filename)
-            if match:
-                num = int(match.group(1))
-                max_num = max(max_num, num)
-        
-        # Return next number
-        next_num = max_num + 1
-        return f"image_{next_num:05d}.png"
-    
-    def save_dataset(self, target, dataset_name, control1=None, control2=None, control3=None, caption=None):
-        """Save images in Qwen dataset format"""
+    def save_dataset(self, target, dataset_name, control1=None, control2=None, control3=None, caption=None,
+                     server_url=""):
+        """Queue images in Qwen dataset format; encoding runs in the background encoder pool"""
+        start_time = time.perf_counter()
+        
+        # Fail this node run if an earlier sample could not be written or posted
+        encoder_pool.raise_failures()
+        
+        if server_url and server_url.strip():
+            return self.save_remote(server_url.strip(), target, dataset_name, control1, control2, control3, caption)
         
         # Create dataset directory structure
-        dataset_path = os.path.join(self.output_dir, dataset_name)
-        img_dir = os.path.join(dataset_path, "img")
-        control1_dir = os.path.join(dataset_path, "Control1")
-        control2_dir = os.path.join(dataset_path, "Control2")
-        control3_dir = os.path.join(dataset_path, "Control3")
-        
-        # Create directories
-        for directory in [img_dir, control1_dir, control2_dir, control3_dir]:
-            os.makedirs(directory, exist_ok=True)
-        
-        # Get next filename
-        filename = self.get_next_filename(img_dir)
+        dataset = Dataset(os.path.join(self.output_dir, dataset_name))
+        dataset.ensure_layout()
+        img_dir = dataset.folder_path(IMG_FOLDER)
+        control1_dir, control2_dir, control3_dir = (dataset.folder_path(folder) for folder in CONTROL_FOLDERS)
+        policy = StoragePolicy.load(dataset.path)
+        
+        # Get next filename (queued saves count as taken; read them before listing the folder
+        # so a save finishing in between is seen on disk)
+        reserved = encoder_pool.reserved_names(img_dir)
+        filename = policy.filename(dataset.next_filename(reserved))
         basename = os.path.splitext(filename)[0]
         
-        # Convert target to PIL and save
+        # Convert target to PIL
         target_image = self.tensor_to_pil(target)
         target_path = os.path.join(img_dir, filename)
-        target_image.save(target_path, "PNG", compress_level=0)
         
         # Check if any control images are provided
         has_control = control1 is not None or control2 is not None or control3 is not None
         
-        # Save control1 (or black image if no control images provided)
+        # Control1 (or black image if no control images provided)
         if control1 is not None:
             control1_image = self.tensor_to_pil(control1)
         elif not has_control:
@@ -105,39 +186,74 @@ class QwenDatasetSaver:
         else:
             control1_image = None
         
+        controls = []
         if control1_image is not None:
-            control1_path = os.path.join(control1_dir, filename)
-            control1_image.save(control1_path, "PNG", compress_level=0)
-        
-        # Save control2 if provided
+            controls.append((control1_image, os.path.join(control1_dir, filename)))
         if control2 is not None:
-            control2_image = self.tensor_to_pil(control2)
-            control2_path = os.path.join(control2_dir, filename)
-            control2_image.save(control2_path, "PNG", compress_level=0)
-        
-        # Save control3 if provided
+            controls.append((self.tensor_to_pil(control2), os.path.join(control2_dir, filename)))
         if control3 is not None:
-            control3_image = self.tensor_to_pil(control3)
-            control3_path = os.path.join(control3_dir, filename)
-            control3_image.save(control3_path, "PNG", compress_level=0)
+            controls.append((self.tensor_to_pil(control3), os.path.join(control3_dir, filename)))
         
-        # Save caption if provided
-        if caption and caption.strip():
-            caption_path = os.path.join(img_dir, f"{basename}.txt")
-            with open(caption_path, 'w', encoding='utf-8') as f:
-                f.write(caption.strip())
+        caption_text = caption.strip() if caption else ""
+        caption_path = os.path.join(img_dir, f"{basename}.txt")
         
-        print(f"✅ Saved dataset entry: {filename}")
+        def write_sample():
+            # Controls and caption first, so the sample is complete once img appears
+            for image, path in controls:
+                policy.write(image, path)
+            if caption_text:
+                # Replace, never rewrite in place: snapshot blobs may be hardlinks of an older caption
+                atomic_write_text(caption_path, caption_text)
+            policy.write(target_image, target_path)
+        
+        encoder_pool.submit(write_sample, reserve=[target_path])
+        
+        print(f"✅ Queued dataset entry: {filename}")
         print(f"   Dataset: {dataset_name}")
         print(f"   Target: {target_path}")
         if control1_image:
-            print(f"   Control1: saved")
+            print(f"   Control1: queued")
         if control2 is not None:
-            print(f"   Control2: saved")
+            print(f"   Control2: queued")
         if control3 is not None:
-            print(f"   Control3: saved")
-        if caption and caption.strip():
-            print(f"   Caption: saved")
+            print(f"   Control3: queued")
+        if caption_text:
+            print(f"   Caption: queued")
+        print(f"   Time: {time.perf_counter() - start_time:.3f}s")
+        
+        return ()
+
+
+    def save_remote(self, server_url, target, dataset_name, control1, control2, control3, caption):
+        """Encode and post the sample to a Dataset Manager in the background; it allocates the name"""
+        start_time = time.perf_counter()
+        client = get_ingest_client(server_url)
+        
+        target_image = self.tensor_to_pil(target)
+        images = [("img", target_image)]
+        for part, control in (("Control1", control1), ("Control2", control2), ("Control3", control3)):
+            if control is not None:
+                images.append((part, self.tensor_to_pil(control)))
+        if len(images) == 1:
+            # No control images at all - black Control1 like a local save
+            images.append(("Control1", self.create_black_image(target_image.size)))
+        caption_text = caption.strip() if caption else ""
+        
+        def post_sample():
+            files = []
+            for part, image in images:
+                buffer = io.BytesIO()
+                # Fast PNG; the server applies the dataset's storage policy
+                image.save(buffer, "PNG", compress_level=1)
+                files.append((part, f"{part}.png", buffer.getvalue()))
+            sample = client.post_sample(dataset_name, files, caption_text)
+            print(f"✅ Ingested dataset entry: {sample['filename']} ({dataset_name} on {server_url})")
+        
+        encoder_pool.submit(post_sample)
+        
+        print(f"✅ Queued dataset entry for {server_url}")
+        print(f"   Dataset: {dataset_name}")
+        print(f"   Time: {time.perf_counter() - start_time:.3f}s")
         
         return ()
 
@@ -0,0 +1,209 @@
+"""
+How a dataset's image files are encoded when they are written, and the
+background pool that encodes them off the request or node thread.
+"""
+
+import atexit
+import json
+import os
+import queue
+import threading
+import uuid
+
+from .dataset_core import META_DIRNAME
+
+# Pillow format and default encoder options for each dataset image extension
+IMAGE_SAVE_FORMATS = {
+    '.png': ('PNG', {'compress_level': 6}),
+    '.jpg': ('JPEG', {'quality': 95}),
+    '.jpeg': ('JPEG', {'quality': 95}),
+    '.webp': ('WEBP', {'quality': 95}),
+}
+
+
+class StoragePolicy:
+    """How a dataset's image files are encoded when they are written.
+
+    Stored in .qdm/storage_policy.json:
+      format         keep (the writer's extension), png, webp or jpg; new samples only
+      compressLevel  PNG zlib level, 0-9
+      quality        JPEG and lossy WebP quality, 1-100
+      lossless       encode WebP losslessly
+      maxSize        longest side of new samples in pixels, 0 for no limit
+    """
+
+    FILENAME = 'storage_policy.json'
+    FORMATS = {'keep': None, 'png': '.png', 'webp': '.webp', 'jpg': '.jpg'}
+    DEFAULTS = {'format': 'keep', 'compressLevel': 6, 'quality': 95, 'lossless': True, 'maxSize': 0}
+
+    def __init__(self, settings=None):
+        self.settings = dict(self.DEFAULTS)
+        for key, value in (settings or {}).items():
+            if key not in self.DEFAULTS:
+                raise ValueError(f"Unknown storage policy setting: {key}")
+            self.settings[key] = value
+        s = self.settings
+        if s['format'] not in self.FORMATS:
+            raise ValueError(f"format must be one of {', '.join(self.FORMATS)}")
+        s['compressLevel'] = int(s['compressLevel'])
+        s['quality'] = int(s['quality'])
+        s['lossless'] = bool(s['lossless'])
+        s['maxSize'] = int(s['maxSize'] or 0)
+        if not 0 <= s['compressLevel'] <= 9 or not 1 <= s['quality'] <= 100 or s['maxSize'] < 0:
+            raise ValueError('compressLevel must be 0-9, quality 1-100 and maxSize >= 0')
+
+    def __repr__(self):
+        return f"StoragePolicy({self.settings!r})"
+
+    @classmethod
+    def path_for(cls, dataset_path):
+        return os.path.join(os.fspath(dataset_path), META_DIRNAME, cls.FILENAME)
+
+    @classmethod
+    def load(cls, dataset_path):
+        """Policy of a dataset, or the defaults when it has none"""
+        try:
+            with open(cls.path_for(dataset_path), 'r', encoding='utf-8') as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, dataset_path):
+        path = self.path_for(dataset_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.settings, f, indent=2)
+        os.replace(tmp, path)
+
+    def filename(self, filename):
+        """Name a new file gets under this policy (the extension follows format)"""
+        extension = self.FORMATS[self.settings['format']]
+        return os.path.splitext(filename)[0] + extension if extension else filename
+
+    def save_options(self, extension):
+        """(Pillow format, save options) for a file extension"""
+        image_format, defaults = IMAGE_SAVE_FORMATS[extension.lower()]
+        if image_format == 'PNG':
+            return image_format, {'compress_level': self.settings['compressLevel']}
+        if image_format == 'WEBP' and self.settings['lossless']:
+            return image_format, {'lossless': True}
+        return image_format, {**defaults, 'quality': self.settings['quality']}
+
+    def encode(self, img, path, extension=None, resize=False):
+        """Encode img into path (format from extension, default path's own).
+
+        resize applies maxSize; it is meant for new samples, edits keep the
+        size of their controls.
+        """
+        from PIL import Image
+
+        image_format, options = self.save_options(extension or os.path.splitext(os.fspath(path))[1])
+        max_size = self.settings['maxSize']
+        if resize and max_size and max(img.size) > max_size:
+            img = img.copy()
+            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        if image_format == 'JPEG' and img.mode not in ('RGB', 'L', 'CMYK'):
+            img = img.convert('RGB')
+        elif image_format == 'WEBP' and img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.mode else 'RGB')
+        img.save(path, image_format, **options)
+
+    def write(self, img, path, resize=True):
+        """Encode img to path through a temp file + rename; returns path"""
+        path = os.fspath(path)
+        tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            self.encode(img, tmp, extension=os.path.splitext(path)[1], resize=resize)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return path
+
+
+class EncoderPool:
+    """Background threads that run write jobs from a bounded queue.
+
+    submit() only blocks when `maxsize` jobs are already waiting, so a producer
+    such as the saver node keeps generating while images are encoded. A job is
+    one callable (e.g. all files of one sample, written in order); the paths it
+    reserves are reported by reserved_names() until it finishes, so names can be
+    allocated before the files exist. With workers=0 jobs run inline.
+
+    A failed job is recorded and re-raised by the next raise_failures() or
+    join(), so the producer learns that a sample was lost.
+    """
+
+    def __init__(self, workers, maxsize):
+        self.workers = workers
+        self.queue = queue.Queue(maxsize)
+        self.reserved = {}  # directory -> {filename: queued job count}
+        self.failures = []  # exceptions of failed jobs not reported yet
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def submit(self, job, reserve=()):
+        reserve = [os.path.split(os.fspath(path)) for path in reserve]
+        with self.lock:
+            for directory, name in reserve:
+                names = self.reserved.setdefault(directory, {})
+                names[name] = names.get(name, 0) + 1
+            if self.workers and not self.threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._work, name=f'qdm-encoder-{i}', daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+                # Finish queued writes before the interpreter exits
+                atexit.register(self.join, raise_failures=False)
+        if self.workers:
+            self.queue.put((job, reserve))
+        else:
+            try:
+                job()
+            finally:
+                self._release(reserve)
+
+    def reserved_names(self, directory):
+        with self.lock:
+            return list(self.reserved.get(os.fspath(directory), ()))
+
+    def join(self, raise_failures=True):
+        """Wait until every queued job has been written, then report failed ones"""
+        self.queue.join()
+        if raise_failures:
+            self.raise_failures()
+
+    def raise_failures(self):
+        """Raise the first failure of the jobs finished since the last call"""
+        with self.lock:
+            failures, self.failures = self.failures, []
+        if failures:
+            more = f" (and {len(failures) - 1} more)" if len(failures) > 1 else ""
+            raise RuntimeError(f"Background write failed{more}: {failures[0]}") from failures[0]
+
+    def _work(self):
+        while True:
+            job, reserve = self.queue.get()
+            try:
+                job()
+            except Exception as e:
+                print(f"❌ Background write failed: {e}")
+                with self.lock:
+                    self.failures.append(e)
+            finally:
+                self._release(reserve)
+                self.queue.task_done()
+
+    def _release(self, reserve):
+        with self.lock:
+            for directory, name in reserve:
+                names = self.reserved[directory]
+                names[name] -= 1
+                if not names[name]:
+                    del names[name]
+
+
+encoder_pool = EncoderPool(workers=int(os.environ.get('QDM_ENCODE_WORKERS', '2')),
+                           maxsize=int(os.environ.get('QDM_ENCODE_QUEUE', '32')))
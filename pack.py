@@ -0,0 +1,52 @@
+"""
+Pack a dataset into a single append-only data file plus an offset index, or
+unpack it back into img/ and Control1-3/:
+
+    python pack.py pack Datasets/MyDataset --remove-files
+    python pack.py unpack Datasets/MyDataset
+
+Packing again only appends new or changed samples; --rebuild starts over and
+drops the space held by replaced records.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from comfyui_qwenDatasetManager.pack import PACK_DATA, PackReader, has_pack, pack_dataset, unpack_dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    pack = commands.add_parser('pack', help='pack the loose files of a dataset')
+    pack.add_argument('dataset', help='dataset folder (containing img/)')
+    pack.add_argument('--remove-files', action='store_true', help='delete the loose files once packed')
+    pack.add_argument('--rebuild', action='store_true', help='write a fresh pack instead of appending')
+
+    unpack = commands.add_parser('unpack', help='write the packed samples back to img/ and Control1-3/')
+    unpack.add_argument('dataset', help='dataset folder (containing dataset.qdmpack)')
+    unpack.add_argument('--overwrite', action='store_true', help='replace files that already exist')
+
+    args = parser.parse_args()
+    start = time.perf_counter()
+
+    if args.command == 'pack':
+        if not os.path.isdir(os.path.join(args.dataset, 'img')):
+            sys.exit(f"'img' folder not found in {args.dataset}")
+        written = pack_dataset(args.dataset, remove_files=args.remove_files, rebuild=args.rebuild)
+        with PackReader(args.dataset) as reader:
+            samples = len(reader.records)
+        size_mb = os.path.getsize(os.path.join(args.dataset, PACK_DATA)) / (1024 * 1024)
+        print(f"Packed {written} samples ({samples} total, {size_mb:.1f} MB) in {time.perf_counter() - start:.2f}s")
+    else:
+        if not has_pack(args.dataset):
+            sys.exit(f"No pack found in {args.dataset}")
+        written = unpack_dataset(args.dataset, overwrite=args.overwrite)
+        print(f"Unpacked {written} files in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
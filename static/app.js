@@ -9,8 +9,11 @@ let cacheBuster = Date.now(); // For cache busting after reshuffle
 let allFolders = []; // Store all folders for target selection
 let activeControlView = null; // Which control is shown in full preview (null = original image)
 let comparisonControlView = null; // Which control is shown in comparison view (null = hidden)
+let comparisonDiff = false; // Show the img/control difference heatmap instead of the control itself
 let linkedDataset = null; // Linked dataset for synchronized operations
 let imageEditor = null; // Image editor instance
+let datasetEvents = null; // EventSource pushing live dataset changes
+const gridItems = new Map(); // filename -> grid item element
 
 // DOM elements
 const folderSelect = document.getElementById('folder-select');
@@ -30,6 +33,9 @@ const deleteBtn = document.getElementById('delete-btn');
 const reshuffleBtn = document.getElementById('reshuffle-btn');
 const compressBtn = document.getElementById('compress-btn');
 const exportBtn = document.getElementById('export-btn');
+const qualitySort = document.getElementById('quality-sort');
+const qualityFilter = document.getElementById('quality-filter');
+const scoreBtn = document.getElementById('score-btn');
 const opacitySlider = document.getElementById('opacity-slider');
 const opacityValueDisplay = document.getElementById('opacity-value');
 const targetDatasetSelect = document.getElementById('target-dataset-select');
@@ -94,11 +100,25 @@ async function loadFolders() {
         createOption.style.fontWeight = 'bold';
         folderSelect.appendChild(createOption);
 
+        // Group datasets by root when extra roots are configured
+        const groups = new Map();
         data.folders.forEach(folder => {
+            let parent = folderSelect;
+            if (data.roots && data.roots.length > 1) {
+                const label = folder.root || 'Datasets';
+                if (!groups.has(label)) {
+                    const group = document.createElement('optgroup');
+                    group.label = label;
+                    folderSelect.appendChild(group);
+                    groups.set(label, group);
+                }
+                parent = groups.get(label);
+            }
+
             const option = document.createElement('option');
             option.value = folder.path;
-            option.textContent = folder.name;
-            folderSelect.appendChild(option);
+            option.textContent = `${folder.name} (${folder.images})`;
+            parent.appendChild(option);
         });
     } catch (error) {
         console.error('Failed to load folders:', error);
@@ -139,6 +159,11 @@ async function createNewDataset() {
     }
 }
 
+// Dataset name for dropdowns outside the grouped folder select
+function folderLabel(folder) {
+    return folder.root ? `${folder.root}: ${folder.name}` : folder.name;
+}
+
 // Link Dataset Functions
 function showLinkSelector() {
     // Populate link select with other folders
@@ -147,7 +172,7 @@ function showLinkSelector() {
         if (folder.path !== currentFolder) {
             const option = document.createElement('option');
             option.value = folder.path;
-            option.textContent = folder.name;
+            option.textContent = folderLabel(folder);
             linkSelect.appendChild(option);
         }
     });
@@ -164,7 +189,8 @@ async function linkDataset(folderPath) {
     }
 
     linkedDataset = folderPath;
-    const folderName = allFolders.find(f => f.path === folderPath)?.name || folderPath;
+    const linked = allFolders.find(f => f.path === folderPath);
+    const folderName = linked ? folderLabel(linked) : folderPath;
 
     // Update UI
     linkSelect.classList.add('hidden');
@@ -237,6 +263,7 @@ async function loadImages(folder) {
     if (!folder) {
         imageGrid.innerHTML = '<div class="empty-state"><p>📁 Select a dataset folder to view images</p></div>';
         imageCount.textContent = '';
+        watchFolder('');
         return;
     }
 
@@ -247,7 +274,7 @@ async function loadImages(folder) {
     }
 
     try {
-        const response = await fetch(`/api/images?folder=${encodeURIComponent(folder)}`);
+        const response = await fetch(`/api/images?${imagesQuery(folder)}`);
         const data = await response.json();
 
         if (data.error) {
@@ -275,38 +302,165 @@ async function loadImages(folder) {
 
         renderImageGrid();
         updateImageCount();
+        watchFolder(folder);
     } catch (error) {
         console.error('Failed to load images:', error);
         imageGrid.innerHTML = '<div class="empty-state"><p>❌ Failed to load images</p></div>';
     }
 }
 
+// Query for /api/images, with the quality sort/filter keys when selected
+function imagesQuery(folder) {
+    const query = new URLSearchParams({ folder });
+    if (qualitySort.value) {
+        const [sort, order] = qualitySort.value.split(':');
+        query.set('sort', sort);
+        query.set('order', order);
+    }
+    if (qualityFilter.value) {
+        query.set('flag', qualityFilter.value);
+    }
+    return query;
+}
+
 // Render image grid
 function renderImageGrid() {
+    gridItems.clear();
+
     if (images.length === 0) {
         imageGrid.innerHTML = '<div class="empty-state"><p>📷 No images found in this folder</p></div>';
         return;
     }
 
     imageGrid.innerHTML = '';
-    images.forEach((filename, index) => {
-        const item = document.createElement('div');
-        item.className = 'image-item';
-        item.onclick = () => openPreview(index);
-
-        const img = document.createElement('img');
-        img.src = `/api/image/img/${encodeURIComponent(filename)}?folder=${encodeURIComponent(currentFolder)}&t=${cacheBuster}`;
-        img.alt = filename;
-        img.loading = 'lazy';
-
-        const filenameSpan = document.createElement('span');
-        filenameSpan.className = 'filename';
-        filenameSpan.textContent = filename;
-
-        item.appendChild(img);
-        item.appendChild(filenameSpan);
-        imageGrid.appendChild(item);
+    images.forEach(filename => {
+        imageGrid.appendChild(createImageItem(filename));
+    });
+}
+
+// Create a single grid item
+function createImageItem(filename) {
+    const item = document.createElement('div');
+    item.className = 'image-item';
+    item.dataset.filename = filename;
+    item.onclick = () => openPreview(images.indexOf(filename));
+
+    const img = document.createElement('img');
+    img.src = `/api/image/img/${encodeURIComponent(filename)}?folder=${encodeURIComponent(currentFolder)}&t=${cacheBuster}`;
+    img.alt = filename;
+    img.loading = 'lazy';
+
+    const filenameSpan = document.createElement('span');
+    filenameSpan.className = 'filename';
+    filenameSpan.textContent = filename;
+
+    item.appendChild(img);
+    item.appendChild(filenameSpan);
+    gridItems.set(filename, item);
+    return item;
+}
+
+// Remove filenames from the image list and grid without rebuilding it
+function removeGridItems(filenames) {
+    const currentName = images[currentIndex];
+    const toRemove = new Set(filenames);
+
+    toRemove.forEach(filename => {
+        const item = gridItems.get(filename);
+        if (item) {
+            item.remove();
+            gridItems.delete(filename);
+        }
+    });
+    images = images.filter(filename => !toRemove.has(filename));
+
+    // Keep the preview on the same image, or on the one that took its place
+    const newIndex = images.indexOf(currentName);
+    if (newIndex !== -1) {
+        currentIndex = newIndex;
+    } else if (currentIndex >= images.length) {
+        currentIndex = Math.max(0, images.length - 1);
+    }
+
+    if (images.length === 0) {
+        renderImageGrid();
+    }
+}
+
+// Subscribe to live changes of the selected dataset (e.g. new samples from ComfyUI)
+function watchFolder(folder) {
+    if (datasetEvents) {
+        datasetEvents.close();
+        datasetEvents = null;
+    }
+    if (!folder || !window.EventSource) return;
+
+    datasetEvents = new EventSource(`/api/events?folder=${encodeURIComponent(folder)}`);
+    datasetEvents.onmessage = (e) => {
+        if (folder !== currentFolder) return;
+        const change = JSON.parse(e.data);
+        if (change.resync) {
+            loadImages(currentFolder);
+        } else {
+            applyDatasetChanges(change);
+        }
+    };
+}
+
+// Patch the grid with a batch of {added, removed, modified} filenames
+function applyDatasetChanges({ added = [], removed = [], modified = [] }) {
+    const previewOpen = modal.classList.contains('active');
+    const currentName = images[currentIndex];
+
+    if (removed.length > 0) {
+        removeGridItems(removed.filter(filename => gridItems.has(filename)));
+        if (previewOpen && images.length === 0) {
+            closePreview();
+        } else if (previewOpen && removed.includes(currentName)) {
+            updatePreview();
+        }
+    }
+
+    if (added.length > 0 && (qualitySort.value || qualityFilter.value)) {
+        // New samples have no scores yet: let the server place (or filter) them
+        loadImages(currentFolder);
+        return;
+    }
+
+    if (added.length > 0) {
+        if (images.length === 0) {
+            imageGrid.innerHTML = '';
+        }
+        added.forEach(filename => {
+            if (gridItems.has(filename)) return;
+
+            // Binary search keeps the list in the same order as /api/images
+            let lo = 0;
+            let hi = images.length;
+            while (lo < hi) {
+                const mid = (lo + hi) >> 1;
+                if (images[mid] < filename) lo = mid + 1; else hi = mid;
+            }
+            const before = lo < images.length ? gridItems.get(images[lo]) : null;
+            images.splice(lo, 0, filename);
+            imageGrid.insertBefore(createImageItem(filename), before);
+        });
+        const newIndex = images.indexOf(currentName);
+        if (newIndex !== -1) currentIndex = newIndex;
+    }
+
+    modified.forEach(filename => {
+        const img = gridItems.get(filename)?.querySelector('img');
+        if (img) {
+            img.src = `/api/image/img/${encodeURIComponent(filename)}?folder=${encodeURIComponent(currentFolder)}&t=${Date.now()}`;
+        }
     });
+
+    if (previewOpen) {
+        prevBtn.disabled = currentIndex === 0;
+        nextBtn.disabled = currentIndex === images.length - 1;
+    }
+    updateImageCount();
 }
 
 // Update image count display
@@ -321,6 +475,7 @@ function openPreview(index) {
     targetFolder = ''; // Reset target folder
     activeControlView = null; // Reset to show original image
     comparisonControlView = null; // Reset comparison view
+    comparisonDiff = false;
     updateTargetDatasetSelect(); // Update dropdown options
     updatePreview();
     modal.classList.add('active');
@@ -334,7 +489,7 @@ function updateTargetDatasetSelect() {
         if (folder.path !== currentFolder) {
             const option = document.createElement('option');
             option.value = folder.path;
-            option.textContent = folder.name;
+            option.textContent = folderLabel(folder);
             targetDatasetSelect.appendChild(option);
         }
     });
@@ -395,9 +550,12 @@ function updatePreview() {
     // Load caption
     loadCaption(filename);
 
-    // Update comparison image src
+    // Update comparison image src (rendered server-side at display size)
     if (comparisonControlView) {
-        comparisonImg.src = `${baseUrl}/${comparisonControlView}/${encodeURIComponent(filename)}${folderParam}`;
+        const size = previewDisplaySize(imageContainer);
+        comparisonImg.src = previewUrl(filename, comparisonDiff
+            ? { mode: 'diff', control: comparisonControlView, ...size }
+            : { layer: comparisonControlView, ...size });
     } else {
         comparisonImg.src = '';
     }
@@ -422,11 +580,11 @@ function updatePreview() {
                 imageEditor.controlImageElement = controlImg;
                 imageEditor.overlayElement = previewControl;
                 imageEditor.setupCanvas();
-                imageEditor.history = [];
-                imageEditor.saveState();
+                imageEditor.resetHistory();
             }
             imageEditor.currentFilename = filename;
             imageEditor.currentFolder = currentFolder;
+            imageEditor.loadVersion(previewImg.src);
             imageEditor.updateSaveButton();
         };
     };
@@ -450,17 +608,27 @@ function updatePreview() {
     }
 }
 
+// URL of a downscaled preview/composite rendered by /api/preview
+function previewUrl(filename, params) {
+    const query = new URLSearchParams({ folder: currentFolder, ...params, t: cacheBuster });
+    return `/api/preview/${encodeURIComponent(filename)}?${query}`;
+}
+
+// Device pixel size of an element, rounded up so nearby sizes share cached previews
+function previewDisplaySize(element) {
+    const ratio = window.devicePixelRatio || 1;
+    const round = value => Math.max(64, Math.ceil(value * ratio / 128) * 128);
+    return { w: round(element.clientWidth), h: round(element.clientHeight) };
+}
+
 // Load control thumbnails and check which exist
 function loadControlThumbnails(filename) {
-    const baseUrl = `/api/image`;
-    const folderParam = `?folder=${encodeURIComponent(currentFolder)}&t=${cacheBuster}`;
-
     const controls = ['Control1', 'Control2', 'Control3'];
 
     controls.forEach(controlName => {
         const thumb = controlThumbs[controlName];
         const img = thumb.querySelector('img');
-        const imgUrl = `${baseUrl}/${controlName}/${encodeURIComponent(filename)}${folderParam}`;
+        const imgUrl = previewUrl(filename, { layer: controlName, w: 320, h: 320 });
 
         // Reset state
         thumb.classList.remove('hidden', 'active', 'comparison-active');
@@ -497,6 +665,15 @@ function showControlFullPreview(controlName) {
     updatePreview();
 }
 
+// Toggle the difference heatmap in the comparison view (defaults to Control1)
+function toggleComparisonDiff() {
+    comparisonDiff = !comparisonDiff;
+    if (comparisonDiff && !comparisonControlView) {
+        comparisonControlView = 'Control1';
+    }
+    updatePreview();
+}
+
 // Navigate to previous image
 function showPrevious() {
     if (currentIndex > 0) {
@@ -569,22 +746,16 @@ async function transferCurrentImage() {
         const data = await response.json();
 
         if (data.success) {
-            // Remove from images array (file was moved)
-            images.splice(currentIndex, 1);
+            // Remove from images array and grid (file was moved)
+            removeGridItems([filename]);
 
             // Update UI
             if (images.length === 0) {
                 closePreview();
-                renderImageGrid();
-                updateImageCount();
             } else {
-                if (currentIndex >= images.length) {
-                    currentIndex = images.length - 1;
-                }
                 updatePreview();
-                renderImageGrid();
-                updateImageCount();
             }
+            updateImageCount();
 
             console.log('Transferred:', data.transferred);
         } else {
@@ -622,23 +793,16 @@ async function deleteCurrentImage() {
         const data = await response.json();
 
         if (data.success) {
-            // Remove from images array
-            images.splice(currentIndex, 1);
+            // Remove from images array and grid
+            removeGridItems([filename]);
 
             // Update UI
             if (images.length === 0) {
                 closePreview();
-                renderImageGrid();
-                updateImageCount();
             } else {
-                // Adjust index if needed
-                if (currentIndex >= images.length) {
-                    currentIndex = images.length - 1;
-                }
                 updatePreview();
-                renderImageGrid();
-                updateImageCount();
             }
+            updateImageCount();
 
             console.log('Deleted:', data.deleted);
             if (data.errors && data.errors.length > 0) {
@@ -732,7 +896,8 @@ async function compressDataset() {
                 `Compressed ${data.compressed} images!\n\n` +
                 `Original: ${data.originalSizeMB} MB\n` +
                 `New: ${data.newSizeMB} MB\n` +
-                `Saved: ${data.savingsMB} MB (${data.savingsPercent}%)`
+                `Saved: ${data.savingsMB} MB (${data.savingsPercent}%)` +
+                (data.errors ? `\n\n${data.errors.length} failed:\n${data.errors.slice(0, 10).join('\n')}` : '')
             );
             loadImages(currentFolder);
         } else {
@@ -752,6 +917,54 @@ async function compressDataset() {
     }
 }
 
+// Score image quality in the background and report the flagged samples
+async function scoreDataset() {
+    if (!currentFolder) {
+        alert('Please select a dataset folder first.');
+        return;
+    }
+
+    const folder = currentFolder;
+    try {
+        scoreBtn.disabled = true;
+        scoreBtn.textContent = 'Scoring...';
+
+        const response = await fetch(`/api/quality/score?folder=${encodeURIComponent(folder)}`, {
+            method: 'POST'
+        });
+        let job = await response.json();
+        if (job.error) {
+            alert(`Failed to score: ${job.error}`);
+            return;
+        }
+
+        while (job.status === 'planning' || job.status === 'running') {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            job = await (await fetch(`/api/quality/score/${job.id}`)).json();
+            if (job.total) {
+                scoreBtn.textContent = `Scoring ${Math.floor(job.processed * 100 / job.total)}%`;
+            }
+        }
+        if (job.status !== 'done') {
+            alert(`Scoring ${job.status}: ${job.errors.map(e => e.error).join('\n')}`);
+            return;
+        }
+
+        const quality = await (await fetch(`/api/quality?folder=${encodeURIComponent(folder)}`)).json();
+        const flagged = Object.entries(quality.flags || {}).map(([flag, count]) => `${flag}: ${count}`).join('\n');
+        alert(`Scored ${job.scored} files (${job.cached} unchanged).\n\nSamples flagged:\n${flagged}`);
+        if (folder === currentFolder && (qualitySort.value || qualityFilter.value)) {
+            loadImages(currentFolder);
+        }
+    } catch (error) {
+        console.error('Scoring failed:', error);
+        alert('Failed to score dataset. Check console for details.');
+    } finally {
+        scoreBtn.disabled = false;
+        scoreBtn.textContent = '📊 Score';
+    }
+}
+
 // Export to AI-Toolkit format
 async function exportDataset() {
     if (!currentFolder) {
@@ -882,6 +1095,9 @@ function setupEventListeners() {
     saveCaptionBtn.addEventListener('click', saveCurrentCaption);
     reshuffleBtn.addEventListener('click', reshuffleDataset);
     compressBtn.addEventListener('click', compressDataset);
+    scoreBtn.addEventListener('click', scoreDataset);
+    qualitySort.addEventListener('change', () => loadImages(currentFolder));
+    qualityFilter.addEventListener('change', () => loadImages(currentFolder));
     exportBtn.addEventListener('click', exportDataset);
 
     // Target dataset selection
@@ -943,6 +1159,10 @@ function setupEventListeners() {
                 e.preventDefault();
                 toggleOverlay();
                 break;
+            case 'd':
+            case 'D':
+                toggleComparisonDiff();
+                break;
             case 'ArrowUp':
                 e.preventDefault();
                 if (targetFolder) {
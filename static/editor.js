@@ -28,12 +28,24 @@ class ImageEditor {
         this.isSelecting = false;
         this.selectionStart = null;
 
+        // Undo history: one entry per stroke holding only the pixels it overwrote
+        // ({x, y, imageData}), bounded by memory instead of a step count
         this.history = [];
-        this.maxHistory = 20; // Reduced from 50 to save memory
+        this.historyBytes = 0;
+        this.historyBudgetBytes = 256 * 1024 * 1024;
+        this.committedCanvas = null; // Canvas content as of the last finished stroke
+        this.committedCtx = null;
+        this.strokeRect = null; // Bounding box of the stroke in progress
         this.hasChanges = false;
         this.currentFilename = null;
         this.currentFolder = null;
 
+        // Bounding box of everything painted since the last save ({x1, y1, x2, y2}),
+        // so small touch-ups upload just that region to /api/save-patch
+        this.dirtyRect = null;
+        this.maxPatchRatio = 0.5; // Fall back to a full upload above this share of the image
+        this.version = null; // Server version of the file, returned by the last save
+
         this.lastDrawX = 0;
         this.lastDrawY = 0;
         this.lastMouseX = 0;
@@ -101,7 +113,8 @@ class ImageEditor {
 
         // Draw initial image
         this.ctx.drawImage(img, 0, 0);
-        this.saveState();
+        this.dirtyRect = null;
+        this.resetHistory();
         this.canvas.classList.add('active');
 
         // Fit to screen initially
@@ -475,8 +488,8 @@ class ImageEditor {
         // Redraw base state
         this.ctx.clearRect(0, 0, this.canvas.width, this.canvas.height);
 
-        if (this.history.length > 0) {
-            this.ctx.putImageData(this.history[this.history.length - 1], 0, 0);
+        if (this.committedCanvas) {
+            this.ctx.drawImage(this.committedCanvas, 0, 0);
         } else {
             this.ctx.drawImage(this.targetImageElement, 0, 0);
         }
@@ -492,7 +505,32 @@ class ImageEditor {
 
 
 
+    markDirty(x1, y1, x2, y2) {
+        const r = this.brushSize / 2 + 1;
+        const rect = {
+            x1: Math.max(0, Math.floor(Math.min(x1, x2) - r)),
+            y1: Math.max(0, Math.floor(Math.min(y1, y2) - r)),
+            x2: Math.min(this.canvas.width, Math.ceil(Math.max(x1, x2) + r)),
+            y2: Math.min(this.canvas.height, Math.ceil(Math.max(y1, y2) + r))
+        };
+        if (rect.x2 <= rect.x1 || rect.y2 <= rect.y1) return;
+
+        this.dirtyRect = this.unionRect(this.dirtyRect, rect);
+        this.strokeRect = this.unionRect(this.strokeRect, rect);
+    }
+
+    unionRect(a, b) {
+        if (!a) return b;
+        return {
+            x1: Math.min(a.x1, b.x1),
+            y1: Math.min(a.y1, b.y1),
+            x2: Math.max(a.x2, b.x2),
+            y2: Math.max(a.y2, b.y2)
+        };
+    }
+
     drawPoint(x, y) {
+        this.markDirty(x, y, x, y);
         this.ctx.fillStyle = this.brushColor;
         this.ctx.globalAlpha = this.brushOpacity;
         this.ctx.beginPath();
@@ -502,6 +540,7 @@ class ImageEditor {
     }
 
     drawLine(x1, y1, x2, y2) {
+        this.markDirty(x1, y1, x2, y2);
         this.ctx.strokeStyle = this.brushColor;
         this.ctx.globalAlpha = this.brushOpacity;
         this.ctx.lineWidth = this.brushSize;
@@ -516,6 +555,7 @@ class ImageEditor {
     }
 
     eraseLine(x1, y1, x2, y2) {
+        this.markDirty(x1, y1, x2, y2);
         const steps = Math.ceil(Math.hypot(x2 - x1, y2 - y1));
 
         // Use composite operation for eraser? 
@@ -539,6 +579,7 @@ class ImageEditor {
     }
 
     stampLine(x1, y1, x2, y2) {
+        this.markDirty(x1, y1, x2, y2);
         const steps = Math.ceil(Math.hypot(x2 - x1, y2 - y1));
         for (let i = 0; i <= steps; i++) {
             const t = steps > 0 ? i / steps : 0;
@@ -579,19 +620,47 @@ class ImageEditor {
         }
     }
 
+    resetHistory() {
+        // Take the current canvas as the new baseline and drop all undo steps
+        const { width, height } = this.canvas;
+        if (!this.committedCanvas || this.committedCanvas.width !== width || this.committedCanvas.height !== height) {
+            this.committedCanvas = typeof OffscreenCanvas !== 'undefined'
+                ? new OffscreenCanvas(width, height)
+                : Object.assign(document.createElement('canvas'), { width, height });
+            this.committedCtx = this.committedCanvas.getContext('2d', { willReadFrequently: true });
+        }
+        this.committedCtx.clearRect(0, 0, width, height);
+        this.committedCtx.drawImage(this.canvas, 0, 0);
+
+        this.history = [];
+        this.historyBytes = 0;
+        this.strokeRect = null;
+        this.updateUndoButton();
+        this.updateSaveButton();
+    }
+
     saveState() {
-        try {
-            const imageData = this.ctx.getImageData(0, 0, this.canvas.width, this.canvas.height);
-            this.history.push(imageData);
+        // Called when a stroke ends: keep the pixels it replaced, then commit it
+        const rect = this.strokeRect;
+        this.strokeRect = null;
+        if (!rect) return;
 
-            if (this.history.length > this.maxHistory) {
-                this.history.shift();
+        try {
+            const w = rect.x2 - rect.x1;
+            const h = rect.y2 - rect.y1;
+            const before = this.committedCtx.getImageData(rect.x1, rect.y1, w, h);
+            this.committedCtx.clearRect(rect.x1, rect.y1, w, h);
+            this.committedCtx.drawImage(this.canvas, rect.x1, rect.y1, w, h, rect.x1, rect.y1, w, h);
+
+            this.history.push({ x: rect.x1, y: rect.y1, imageData: before });
+            this.historyBytes += before.data.byteLength;
+
+            // Forget the oldest strokes once over budget (always keep the latest one)
+            while (this.historyBytes > this.historyBudgetBytes && this.history.length > 1) {
+                this.historyBytes -= this.history.shift().imageData.data.byteLength;
             }
 
-            // If we have more than 1 state (initial state + changes), we have changes
-            if (this.history.length > 1) {
-                this.hasChanges = true;
-            }
+            this.hasChanges = true;
 
             this.updateUndoButton();
             this.updateSaveButton();
@@ -601,10 +670,13 @@ class ImageEditor {
     }
 
     undo() {
-        if (this.history.length > 1) {
-            this.history.pop();
-            const imageData = this.history[this.history.length - 1];
-            this.ctx.putImageData(imageData, 0, 0);
+        if (this.history.length > 0) {
+            const { x, y, imageData } = this.history.pop();
+            this.historyBytes -= imageData.data.byteLength;
+            this.committedCtx.putImageData(imageData, x, y);
+            // The restored pixels may differ from the saved file, so they must be uploaded too
+            this.dirtyRect = this.unionRect(this.dirtyRect, { x1: x, y1: y, x2: x + imageData.width, y2: y + imageData.height });
+            this.redrawCanvas();
 
             this.updateUndoButton();
             this.updateSaveButton();
@@ -616,12 +688,12 @@ class ImageEditor {
     }
 
     reset() {
-        this.history = [];
         this.selectionRect = null; // Clear crop selection too
         this.ctx.clearRect(0, 0, this.canvas.width, this.canvas.height);
         this.ctx.drawImage(this.targetImageElement, 0, 0);
         this.hasChanges = false;
-        this.saveState();
+        this.dirtyRect = null;
+        this.resetHistory();
         this.fitToScreen();
         this.updateSaveButton();
 
@@ -630,14 +702,29 @@ class ImageEditor {
         if (applyBtn) applyBtn.disabled = true;
     }
 
+    // Version of the file just loaded (X-File-Version of /api/image), sent as baseVersion on save
+    async loadVersion(url) {
+        const filename = this.currentFilename;
+        const folder = this.currentFolder;
+        this.version = null;
+        try {
+            const response = await fetch(url, { method: 'HEAD' });
+            if (filename === this.currentFilename && folder === this.currentFolder) {
+                this.version = response.headers.get('X-File-Version');
+            }
+        } catch (e) {
+            console.error('Version check error:', e);
+        }
+    }
+
     updateUndoButton() {
         const undoBtn = document.getElementById('undo-btn');
-        if (undoBtn) undoBtn.disabled = this.history.length <= 1;
+        if (undoBtn) undoBtn.disabled = this.history.length === 0;
     }
 
     updateSaveButton() {
         const saveBtn = document.getElementById('save-edit-btn');
-        if (saveBtn) saveBtn.disabled = this.history.length <= 1;
+        if (saveBtn) saveBtn.disabled = this.history.length === 0;
     }
 
     async save() {
@@ -661,17 +748,13 @@ class ImageEditor {
             this.selectionRect = null;
             this.redrawCanvas();
 
-            const blob = await new Promise(resolve => this.canvas.toBlob(resolve));
-            const formData = new FormData();
-            formData.append('file', blob, this.currentFilename);
-
-            const response = await fetch(`/api/save/${encodeURIComponent(this.currentFilename)}?folder=${encodeURIComponent(this.currentFolder)}`, {
-                method: 'POST',
-                body: formData
-            });
+            const response = await this.uploadChanges();
 
             if (response.ok) {
+                const data = await response.json();
                 this.hasChanges = false;
+                this.dirtyRect = null;
+                this.version = data.version || null;
 
                 // Notify app to update cache and UI
                 if (window.onImageSaved) {
@@ -679,6 +762,8 @@ class ImageEditor {
                 }
 
                 alert('Image saved successfully');
+            } else if (response.status === 409) {
+                alert('Image was changed on disk since it was opened. Reload it before saving.');
             } else {
                 alert('Failed to save image');
             }
@@ -693,11 +778,41 @@ class ImageEditor {
             console.error('Save error:', e);
             alert('Error saving image');
         } finally {
-            saveBtn.disabled = this.history.length <= 1;
+            saveBtn.disabled = this.history.length === 0;
             saveBtn.innerHTML = originalText;
         }
     }
 
+    async uploadChanges() {
+        const query = `?folder=${encodeURIComponent(this.currentFolder)}`;
+        const name = encodeURIComponent(this.currentFilename);
+        const formData = new FormData();
+
+        const rect = this.dirtyRect;
+        const total = this.canvas.width * this.canvas.height;
+        if (rect && (rect.x2 - rect.x1) * (rect.y2 - rect.y1) <= total * this.maxPatchRatio) {
+            // Upload only the painted region; the server composites it into the file
+            const w = rect.x2 - rect.x1;
+            const h = rect.y2 - rect.y1;
+            const patchCanvas = document.createElement('canvas');
+            patchCanvas.width = w;
+            patchCanvas.height = h;
+            patchCanvas.getContext('2d').drawImage(this.canvas, rect.x1, rect.y1, w, h, 0, 0, w, h);
+
+            const blob = await new Promise(resolve => patchCanvas.toBlob(resolve));
+            formData.append('patch', blob, 'patch.png');
+            formData.append('rects', JSON.stringify([{ x: rect.x1, y: rect.y1 }]));
+            if (this.version) formData.append('baseVersion', this.version);
+
+            return fetch(`/api/save-patch/${name}${query}`, { method: 'POST', body: formData });
+        }
+
+        const blob = await new Promise(resolve => this.canvas.toBlob(resolve));
+        formData.append('file', blob, this.currentFilename);
+        if (this.version) formData.append('baseVersion', this.version);
+        return fetch(`/api/save/${name}${query}`, { method: 'POST', body: formData });
+    }
+
     async applyCrop() {
         if (!this.selectionRect || !this.currentFolder || !this.currentFilename) return;
 
@@ -726,7 +841,9 @@ class ImageEditor {
             const data = await response.json();
 
             if (data.success) {
-                alert('Augmented pair created successfully!');
+                alert(data.errors
+                    ? `Augmented pair created with problems:\n${data.errors.join('\n')}`
+                    : 'Augmented pair created successfully!');
                 // Reset selection
                 this.selectionRect = null;
                 this.redrawCanvas();